@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Cache Engine Microbenchmark
+
+Compares the original OrderedDict TTL cache (kept here as LegacyTTLCache, it
+is no longer used by the API) with ShardedTTLCache on a Zipf-distributed
+query workload (a few popular queries, a long tail of one-offs), the shape of
+real search traffic. Reports single-threaded operations/sec and hit rate for
+both, plus multi-threaded throughput with the cache shared across threads.
+The legacy class is not thread-safe, so its threaded run wraps it in one
+global lock - what sharing it with the encoder executor would have required.
+
+Runs in-process; no server needed.
+
+Usage:
+    python tests/benchmark_cache.py
+    python tests/benchmark_cache.py --ops 500000 --distinct 20000 --threads 8
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from toastd_search_api import ShardedTTLCache  # noqa: E402
+
+RESULT = {
+    "query": "benchmark",
+    "totalResults": 3,
+    "results": [{"id": str(i), "title": f"Product {i}", "score": 0.9} for i in range(3)],
+    "processingTimeMs": 12.5,
+    "searchMode": "advanced",
+    "cached": False
+}
+
+
+class LegacyTTLCache:
+    """The API's original TTL cache: one OrderedDict, LRU eviction, no admission"""
+
+    def __init__(self, maxsize: int = 500, ttl: int = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache: OrderedDict = OrderedDict()
+        self.timestamps = {}
+
+    def _make_key(self, query: str, limit: int, price_min: float = None, price_max: float = None) -> str:
+        key_str = f"{query.lower().strip()}|{limit}|{price_min}|{price_max}"
+        return hashlib.sha256(key_str.encode()).hexdigest()[:32]
+
+    def get(self, query: str, limit: int, price_min: float = None, price_max: float = None):
+        key = self._make_key(query, limit, price_min, price_max)
+        if key in self.cache:
+            if time.time() - self.timestamps[key] < self.ttl:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            del self.cache[key]
+            del self.timestamps[key]
+        return None
+
+    def set(self, query: str, limit: int, result, price_min: float = None, price_max: float = None):
+        key = self._make_key(query, limit, price_min, price_max)
+        if key in self.cache:
+            del self.cache[key]
+        while len(self.cache) >= self.maxsize:
+            oldest = next(iter(self.cache))
+            del self.cache[oldest]
+            del self.timestamps[oldest]
+        self.cache[key] = result
+        self.timestamps[key] = time.time()
+
+
+class LockedCache:
+    """Serializes every call to a non-thread-safe cache behind one lock"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def get(self, *args):
+        with self.lock:
+            return self.cache.get(*args)
+
+    def set(self, *args):
+        with self.lock:
+            return self.cache.set(*args)
+
+
+def zipf_workload(ops: int, distinct: int, skew: float, seed: int = 42):
+    """Query strings drawn from a Zipf distribution over `distinct` queries"""
+    rnd = random.Random(seed)
+    weights = [1 / (rank ** skew) for rank in range(1, distinct + 1)]
+    return [f"query {i}" for i in rnd.choices(range(distinct), weights=weights, k=ops)]
+
+
+def best_of(repeat: int, make_cache, workload):
+    """Best (ops/sec, hit rate) of `repeat` runs, each on a fresh cache"""
+    return max(run(make_cache(), workload) for _ in range(repeat))
+
+
+def run(cache, workload):
+    """Read-through loop: get, and set on miss. Returns (ops/sec, hit rate)"""
+    hits = 0
+    start = time.perf_counter()
+    for query in workload:
+        if cache.get(query, 10) is not None:
+            hits += 1
+        else:
+            cache.set(query, 10, RESULT)
+    elapsed = time.perf_counter() - start
+    return len(workload) / elapsed, hits / len(workload)
+
+
+def run_threaded(cache, workload, threads: int):
+    """Split the workload across threads sharing one cache. Returns ops/sec"""
+    chunks = [workload[i::threads] for i in range(threads)]
+    workers = [threading.Thread(target=run, args=(cache, chunk)) for chunk in chunks]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return len(workload) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Legacy TTL cache vs ShardedTTLCache microbenchmark")
+    parser.add_argument("--ops", type=int, default=200000)
+    parser.add_argument("--distinct", type=int, default=10000, help="Distinct queries in the workload")
+    parser.add_argument("--maxsize", type=int, default=500)
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="Single-threaded runs per engine; best is reported")
+    args = parser.parse_args()
+
+    workload = zipf_workload(args.ops, args.distinct, args.skew)
+
+    print("=" * 60)
+    print("CACHE ENGINE MICROBENCHMARK")
+    print("=" * 60)
+    print(f"Ops: {args.ops} | Distinct queries: {args.distinct} | maxsize: {args.maxsize} | Zipf s={args.skew}")
+    print("=" * 60)
+    print(f"{'engine':<32} {'ops/sec':>12} {'hit rate':>10}")
+
+    ops, hit_rate = best_of(args.repeat, lambda: LegacyTTLCache(maxsize=args.maxsize, ttl=3600), workload)
+    print(f"{'LegacyTTLCache (OrderedDict)':<32} {ops:>12,.0f} {hit_rate:>10.3f}")
+
+    ops, hit_rate = best_of(args.repeat, lambda: ShardedTTLCache(maxsize=args.maxsize, ttl=3600), workload)
+    print(f"{'ShardedTTLCache':<32} {ops:>12,.0f} {hit_rate:>10.3f}")
+
+    ops, hit_rate = best_of(
+        args.repeat, lambda: ShardedTTLCache(maxsize=args.maxsize, ttl=3600, max_bytes=64 * 1024 * 1024), workload
+    )
+    print(f"{'ShardedTTLCache (byte limit)':<32} {ops:>12,.0f} {hit_rate:>10.3f}")
+
+    ops = run_threaded(LockedCache(LegacyTTLCache(maxsize=args.maxsize, ttl=3600)), workload, args.threads)
+    print(f"{f'LegacyTTLCache + lock ({args.threads} thr)':<32} {ops:>12,.0f} {'':>10}")
+
+    sharded = ShardedTTLCache(maxsize=args.maxsize, ttl=3600, max_bytes=0)
+    ops = run_threaded(sharded, workload, args.threads)
+    print(f"{f'ShardedTTLCache ({args.threads} threads)':<32} {ops:>12,.0f} {sharded.stats()['hitRate']:>10.3f}")
+
+    print()
+    print("Sharded engine counters:", {k: v for k, v in sharded.stats().items() if k != "persistent"})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Concurrency Benchmark for Toastd Search API
+
+Fires the same batch of searches at increasing numbers of in-flight requests
+and reports throughput and latency at each level. With a non-blocking request
+path, throughput should keep rising with concurrency until the LLM/encoder
+capacity is saturated, instead of staying flat at the single-request rate.
+
+Every request gets its own priceMax (far above any product price), so identical
+queries in flight are not coalesced into one search; the LLM calls and searches
+the server still coalesced during a level are reported next to its throughput.
+
+Usage:
+    python tests/benchmark_concurrency.py
+    python tests/benchmark_concurrency.py --levels 1,4,16 --requests 32 --skip-rerank
+"""
+
+import argparse
+import concurrent.futures
+import time
+
+import requests
+
+API_URL = "http://localhost:8001"
+UNFILTERED_PRICE_MAX = 10_000_000  # Plus the request number: a distinct but non-restricting filter
+
+QUERIES = [
+    "birthday gift",
+    "skincare products",
+    "home decor items",
+    "fitness equipment",
+    "jewelry for women",
+    "gift for mom",
+    "travel accessories",
+    "hoodies under 1500",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[idx]
+
+
+def timed_search(query: str, price_max: int, skip_rerank: bool):
+    """Run one uncached search and return (ok, latency_ms)"""
+    start = time.time()
+    try:
+        r = requests.post(f"{API_URL}/search", json={
+            "query": query,
+            "limit": 10,
+            "priceMax": price_max,
+            "skipCache": True,
+            "skipRerank": skip_rerank
+        }, timeout=120)
+        return r.status_code == 200, (time.time() - start) * 1000
+    except Exception:
+        return False, (time.time() - start) * 1000
+
+
+def coalesced_counts():
+    """(search, llm) calls the server has coalesced so far, or None if unavailable"""
+    try:
+        flights = requests.get(f"{API_URL}/cache/stats", timeout=10).json()["singleflight"]
+        return flights["search"]["coalesced"], flights["llm"]["coalesced"]
+    except Exception:
+        return None
+
+
+def run_level(concurrency: int, total: int, skip_rerank: bool, first_request: int):
+    """Run `total` distinct searches with `concurrency` requests in flight"""
+    searches = [(QUERIES[i % len(QUERIES)], UNFILTERED_PRICE_MAX + first_request + i) for i in range(total)]
+    before = coalesced_counts()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.time()
+        outcomes = list(executor.map(lambda s: timed_search(s[0], s[1], skip_rerank), searches))
+        wall = time.time() - start
+    after = coalesced_counts()
+
+    latencies = [ms for ok, ms in outcomes if ok]
+    return {
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "total": total,
+        "throughput": len(latencies) / wall if wall > 0 else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "coalesced": (after[0] - before[0], after[1] - before[1]) if before and after else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Toastd search concurrency benchmark")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated in-flight request counts")
+    parser.add_argument("--requests", type=int, default=32, help="Searches per concurrency level")
+    parser.add_argument("--skip-rerank", action="store_true", help="Benchmark without LLM reranking")
+    args = parser.parse_args()
+
+    levels = [int(x) for x in args.levels.split(",") if x.strip()]
+
+    print("=" * 60)
+    print("TOASTD SEARCH API - CONCURRENCY BENCHMARK")
+    print("=" * 60)
+    print(f"API URL: {API_URL}")
+    print(f"Requests per level: {args.requests} | Rerank: {'off' if args.skip_rerank else 'on'}")
+    print("=" * 60)
+    print(f"{'in-flight':>10} {'ok':>8} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'scaling':>9} "
+          f"{'coalesced search/llm':>21}")
+
+    baseline = None
+    for n, level in enumerate(levels):
+        row = run_level(level, args.requests, args.skip_rerank, n * args.requests)
+        if baseline is None:
+            baseline = row["throughput"] or 1.0
+        scaling = row["throughput"] / baseline
+        coalesced = "%d/%d" % row["coalesced"] if row["coalesced"] else "n/a"
+        print(f"{row['concurrency']:>10} {row['ok']:>4}/{row['total']:<3} {row['throughput']:>10.2f} "
+              f"{row['p50']:>10.0f} {row['p95']:>10.0f} {scaling:>8.2f}x {coalesced:>21}")
+
+
+if __name__ == "__main__":
+    main()
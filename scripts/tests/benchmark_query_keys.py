@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Cache Key Hit-Rate Comparison
+
+Replays a query log and compares the results-cache hit rate of the original
+key (query.lower().strip() + raw priceMin/priceMax) with the canonical key
+produced by canonicalize_query(). Every distinct key is a miss the first time
+it is seen and a hit afterwards (an unbounded cache), so the difference is
+purely how many equivalent phrasings each key scheme folds together.
+
+Runs in-process; no server needed.
+
+Log format: one query per line, or JSON lines such as
+    {"query": "hoodies", "priceMax": 1000}
+
+Usage:
+    python tests/benchmark_query_keys.py
+    python tests/benchmark_query_keys.py --log queries.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from toastd_search_api import canonicalize_query  # noqa: E402
+
+# Built-in sample: the same few intents phrased the way users actually type them
+SAMPLE_LOG = [
+    {"query": "Hoodies under 1000"},
+    {"query": "hoodies  below ₹1,000"},
+    {"query": "hoodies", "priceMax": 1000},
+    {"query": "hoodie under rs 1000"},
+    {"query": "HOODIES under 1000"},
+    {"query": "gift for girlfriend"},
+    {"query": "gifts for girlfriend"},
+    {"query": "Gifts for girlfriend!"},
+    {"query": "gift for girlfriend"},
+    {"query": "t-shirts"},
+    {"query": "tshirt"},
+    {"query": "T-Shirt"},
+    {"query": "watches above 5000"},
+    {"query": "watch", "priceMin": 5000},
+    {"query": "Watches over ₹5,000"},
+    {"query": "skincare products between 500 and 2000"},
+    {"query": "skincare product", "priceMin": 500, "priceMax": 2000},
+    {"query": "birthday gift under 2000 rupees"},
+    {"query": "birthday gifts below 2000"},
+    {"query": "birthday gift", "priceMax": 2000},
+    {"query": "mom's birthday present"},
+    {"query": "moms birthday present"},
+    {"query": "sneakers"},
+    {"query": "Sneakers"},
+    {"query": "sneaker"},
+]
+
+
+def load_log(path: str):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                entries.append(json.loads(line))
+            else:
+                entries.append({"query": line})
+    return entries
+
+
+def legacy_key(entry: dict) -> str:
+    """Key scheme before canonicalization (ShardedTTLCache._make_key input)"""
+    return f"{entry['query'].lower().strip()}|{entry.get('priceMin')}|{entry.get('priceMax')}"
+
+
+def canonical_key(entry: dict) -> str:
+    return canonicalize_query(entry["query"], entry.get("priceMin"), entry.get("priceMax"))["key"]
+
+
+def replay(entries, key_fn):
+    seen = set()
+    hits = 0
+    for entry in entries:
+        key = key_fn(entry)
+        if key in seen:
+            hits += 1
+        seen.add(key)
+    return hits, len(seen)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare legacy vs canonical cache keys on a query log")
+    parser.add_argument("--log", help="Query log (plain lines or JSON lines); defaults to a built-in sample")
+    parser.add_argument("--show-keys", action="store_true", help="Print the canonical key of every query")
+    args = parser.parse_args()
+
+    entries = load_log(args.log) if args.log else SAMPLE_LOG
+
+    print("=" * 60)
+    print("CACHE KEY HIT-RATE COMPARISON")
+    print("=" * 60)
+    print(f"Queries replayed: {len(entries)} ({args.log or 'built-in sample'})")
+    print("=" * 60)
+    print(f"{'key scheme':<14} {'distinct keys':>14} {'hits':>8} {'hit rate':>10}")
+
+    for name, key_fn in (("legacy", legacy_key), ("canonical", canonical_key)):
+        hits, distinct = replay(entries, key_fn)
+        print(f"{name:<14} {distinct:>14} {hits:>8} {hits / len(entries):>10.1%}")
+
+    if args.show_keys:
+        print()
+        for entry in entries:
+            print(f"{entry['query']!r:<45} -> {canonical_key(entry)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Reranker Benchmark
+
+Runs the LLM reranker and the local cross-encoder reranker over the same
+vector-search candidates for a fixed query set, and reports per-query latency
+plus how closely the cross-encoder's ranking agrees with the LLM's:
+top-1 match and overlap of the top-k product ids.
+
+Runs in-process against the configured Qdrant collection and LLM provider
+(same environment variables as toastd_search_api.py).
+
+Usage:
+    python tests/benchmark_rerankers.py
+    python tests/benchmark_rerankers.py --backends torch,onnx-int8 --top-k 5
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import httpx  # noqa: E402
+import toastd_search_api as api  # noqa: E402
+
+QUERIES = [
+    "birthday gift for girlfriend",
+    "hoodies",
+    "skincare products",
+    "home decor items",
+    "fitness equipment",
+    "jewelry for women",
+    "gift for mom",
+    "travel accessories",
+    "tech gadgets for boyfriend",
+    "cute mugs",
+]
+
+
+async def timed_rerank(reranker, query: str, candidates, top_k: int):
+    """Rerank once and return (ids in ranked order, latency_ms)"""
+    start = time.perf_counter()
+    ranked = await reranker.rerank(query, {"search_intent": query}, candidates, top_k=top_k)
+    return [item['id'] for item in ranked], (time.perf_counter() - start) * 1000
+
+
+async def run(backends, top_k: int):
+    api.http_client = httpx.AsyncClient()
+    await api._setup_llm_provider()
+    await api._setup_qdrant_and_encoder()
+
+    rerankers = []
+    if api.USE_LLM:
+        rerankers.append(("llm", api.LLMReranker()))
+    else:
+        print("No LLM available - reporting cross-encoder latency only")
+    for backend in backends:
+        rerankers.append((f"cross-encoder ({backend})", api.CrossEncoderReranker(api.CROSS_ENCODER_MODEL, backend)))
+
+    latencies = {name: [] for name, _ in rerankers}
+    agreement = {name: {"top1": 0, "overlap": []} for name, _ in rerankers[1:]}
+
+    for query in QUERIES:
+        candidates = await api._vector_candidates(query, None, None, 30)
+        ranked = {}
+        for name, reranker in rerankers:
+            ids, ms = await timed_rerank(reranker, query, candidates, top_k)
+            ranked[name] = ids
+            latencies[name].append(ms)
+
+        if api.USE_LLM:
+            reference = ranked["llm"]
+            for name in agreement:
+                ids = ranked[name]
+                agreement[name]["top1"] += bool(reference and ids and reference[0] == ids[0])
+                if reference:
+                    agreement[name]["overlap"].append(len(set(reference) & set(ids)) / len(reference))
+
+    print(f"{'reranker':<28} {'p50 ms':>10} {'max ms':>10} {'top-1':>8} {f'overlap@{top_k}':>12}")
+    for name, _ in rerankers:
+        row = f"{name:<28} {statistics.median(latencies[name]):>10.1f} {max(latencies[name]):>10.1f}"
+        if name in agreement and api.USE_LLM:
+            overlap = agreement[name]["overlap"]
+            row += f" {agreement[name]['top1']:>4}/{len(QUERIES):<3}"
+            row += f" {statistics.mean(overlap) if overlap else 0.0:>12.2f}"
+        print(row)
+
+    await api.http_client.aclose()
+    await api.qdrant_client.close()
+    api.encoder_executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM vs cross-encoder reranker benchmark")
+    parser.add_argument("--backends", default="torch", help="Comma-separated cross-encoder backends (torch, onnx, onnx-int8)")
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+
+    print("=" * 60)
+    print("RERANKER BENCHMARK")
+    print("=" * 60)
+    print(f"Collection: {api.COLLECTION_NAME} | Queries: {len(QUERIES)} | top-k: {args.top_k}")
+    print(f"Cross-encoder: {api.CROSS_ENCODER_MODEL}")
+    print("=" * 60)
+
+    asyncio.run(run(backends, args.top_k))
+
+
+if __name__ == "__main__":
+    main()
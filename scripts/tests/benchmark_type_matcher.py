@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Product-Type Matcher Benchmark
+
+Compares the per-request string work the rerank fallback used to do (scan the
+product-type list with `in` on the query, then lowercase and join every
+candidate's title, tags and description for substring tests) with the compiled
+PhraseMatcher: one trie walk over the query and a bitmask AND against each
+candidate's type mask, precomputed once as at startup.
+
+Reports time per query over a candidate window and how many candidates each
+approach keeps.
+
+Runs in-process; no server needed.
+
+Usage:
+    python tests/benchmark_type_matcher.py
+    python tests/benchmark_type_matcher.py --candidates 30 --rounds 2000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from toastd_search_api import (  # noqa: E402
+    PRODUCT_TYPE_SYNONYMS, product_type_matcher, _product_type_text
+)
+
+# The list and checks _fallback_ranking used before the matcher
+LEGACY_TYPE_LIST = [
+    'hoodie', 'hoodies', 't-shirt', 'tshirt', 'tee', 'shirt', 'dress', 'pants', 'jeans',
+    'jacket', 'bag', 'backpack', 'shoes', 'sneakers', 'watch', 'skincare', 'makeup', 'cream'
+]
+
+QUERIES = [
+    "hoodies under 1500",
+    "cool t-shirts for my brother",
+    "birthday gift for girlfriend",
+    "leather bag for work",
+    "running sneakers",
+    "skincare products",
+    "stainless steel water bottle",
+    "smartwatch for dad",
+]
+
+ADJECTIVES = ["Cozy", "Classic", "Minimal", "Bold", "Vintage", "Oversized", "Steel", "Printed"]
+NOUNS = [t for t in PRODUCT_TYPE_SYNONYMS] + ["Mug", "Candle", "Water Bottle", "Planter", "Notebook"]
+
+
+def make_candidates(n: int, seed: int = 7):
+    rnd = random.Random(seed)
+    candidates = []
+    for i in range(n):
+        noun = rnd.choice(NOUNS)
+        candidates.append({
+            'id': str(i),
+            'score': rnd.random(),
+            'product': {
+                'title': f"{rnd.choice(ADJECTIVES)} {noun.title()} {i}",
+                'tags': f"{noun}, gift, {rnd.choice(['men', 'women', 'unisex'])}",
+                'description': f"A {rnd.choice(ADJECTIVES).lower()} {noun} that makes a thoughtful gift.",
+            }
+        })
+    return candidates
+
+
+def legacy_filter(query: str, candidates):
+    query_lower = query.lower()
+    product_types = [p.rstrip('s') for p in LEGACY_TYPE_LIST if p in query_lower]
+    kept = []
+    for candidate in candidates:
+        product = candidate['product']
+        name_lower = (product.get('title', '') or product.get('name', '') or '').lower()
+        tags = product.get('tags', '') or product.get('auto_tags', [])
+        tags_lower = ', '.join(tags).lower() if isinstance(tags, list) else str(tags).lower()
+        desc_lower = (product.get('description', '') or product.get('short_description', '') or '').lower()
+        if product_types and not any(pt in name_lower or pt in tags_lower or pt in desc_lower for pt in product_types):
+            continue
+        kept.append(candidate)
+    return kept
+
+
+def matcher_filter(query: str, candidates, masks):
+    query_mask = product_type_matcher.mask(query)
+    return [c for c in candidates if not query_mask or masks[c['id']] & query_mask]
+
+
+def timed(fn, rounds: int) -> float:
+    """Microseconds per query, averaged over rounds x QUERIES"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in QUERIES:
+            fn(query)
+    return (time.perf_counter() - start) / (rounds * len(QUERIES)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Legacy substring type checks vs compiled matcher")
+    parser.add_argument("--candidates", type=int, default=30, help="Candidates per query")
+    parser.add_argument("--rounds", type=int, default=1000)
+    parser.add_argument("--show", action="store_true", help="Print the kept candidate count per query")
+    args = parser.parse_args()
+
+    candidates = make_candidates(args.candidates)
+    start = time.perf_counter()
+    masks = {c['id']: product_type_matcher.mask(_product_type_text(c['product'])) for c in candidates}
+    precompute_us = (time.perf_counter() - start) / len(candidates) * 1e6
+
+    print("=" * 60)
+    print("PRODUCT-TYPE MATCHER BENCHMARK")
+    print("=" * 60)
+    print(f"Queries: {len(QUERIES)} | Candidates per query: {args.candidates} | Rounds: {args.rounds}")
+    print(f"Types: {len(PRODUCT_TYPE_SYNONYMS)} | Mask precompute: {precompute_us:.1f} us/product (startup)")
+    print("=" * 60)
+    print(f"{'approach':<28} {'us/query':>10} {'speedup':>9}")
+
+    legacy_us = timed(lambda q: legacy_filter(q, candidates), args.rounds)
+    matcher_us = timed(lambda q: matcher_filter(q, candidates, masks), args.rounds)
+    print(f"{'legacy substring checks':<28} {legacy_us:>10.1f} {1.0:>8.2f}x")
+    print(f"{'matcher + precomputed masks':<28} {matcher_us:>10.1f} {legacy_us / matcher_us:>8.2f}x")
+
+    if args.show:
+        print()
+        print(f"{'query':<32} {'legacy kept':>12} {'matcher kept':>13}  types")
+        for query in QUERIES:
+            print(f"{query:<32} {len(legacy_filter(query, candidates)):>12} "
+                  f"{len(matcher_filter(query, candidates, masks)):>13}  {product_type_matcher.match(query)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+In-process unit tests for the search pipeline building blocks
+
+Covers pieces that do not need a running server, Qdrant or the LLM: lexical
+search and fusion under a query intent, how the search pipeline reports a
+degraded rerank, the LLM rerank's fallback when the LLM fails, the
+cross-encoder reranker (with a fake model) and cache admission.
+
+Usage:
+    python -m pytest tests/test_search_units.py
+    python tests/test_search_units.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import toastd_search_api as api  # noqa: E402
+from toastd_search_api import (  # noqa: E402
+    BM25Index, CrossEncoderReranker, Reranker, ShardedTTLCache, StageDeadlineExceeded, _fuse_candidates
+)
+
+
+def make_catalog():
+    """Candles and mugs for mom, and more of them (tagged "gift" twice) for dad"""
+    payloads = []
+    for i in range(6):
+        payloads.append({"title": f"Lavender Candle {i}", "tags": "candle, gift", "product_type": "Candle",
+                         "recipients": ["mom"], "price": 500})
+    for i in range(12):
+        payloads.append({"title": f"Gift Candle {i}", "tags": "candle, gift, gift", "product_type": "Candle",
+                         "recipients": ["dad"], "price": 500})
+    for i in range(4):
+        payloads.append({"title": f"Gift Mug {i}", "tags": "mug, gift", "product_type": "Mug",
+                         "recipients": ["mom"], "price": 300})
+    return [str(i) for i in range(len(payloads))], payloads
+
+
+def test_lexical_search_applies_intent():
+    ids, payloads = make_catalog()
+    index = BM25Index(ids, payloads)
+    candidates, full_matches = index.search("gift candle", 5, intent={"recipients": ["mom"]}, min_results=5)
+    assert len(candidates) == 5
+    assert all("mom" in c["product"]["recipients"] for c in candidates)
+    assert all("mom" in payloads[int(i)]["recipients"] for i in full_matches)
+
+
+def test_lexical_search_relaxes_like_vector_search():
+    ids, payloads = make_catalog()
+    index = BM25Index(ids, payloads)
+    intent = {"product_type": ["Candle"], "recipients": ["mom"]}
+    candidates, _ = index.search("gift candle", 10, intent=intent, min_results=10)
+    # The 6 mom candles first, then recipients is dropped (INTENT_RELAX_ORDER) and dad candles fill up
+    assert [c["product"]["recipients"] for c in candidates[:6]] == [["mom"]] * 6
+    assert all(c["product"]["product_type"] == "Candle" for c in candidates)
+    assert len(candidates) == 10
+
+    # Without min_results the strict level is kept even when it is short
+    candidates, _ = index.search("gift candle", 10, intent=intent)
+    assert len(candidates) == 6
+
+
+def test_fused_candidates_stay_on_intent():
+    ids, payloads = make_catalog()
+    index = BM25Index(ids, payloads)
+    intent = {"recipients": ["mom"]}
+    vector_candidates = [
+        {"product": payloads[i], "score": 0.9 - i / 100, "id": ids[i]}
+        for i, p in enumerate(payloads) if "mom" in p["recipients"]
+    ]
+    lexical_candidates, _ = index.search("gift", 10, intent=intent, min_results=10)
+    fused = _fuse_candidates([vector_candidates, lexical_candidates], 10)
+    assert len(fused) == 10
+    assert all("mom" in c["product"]["recipients"] for c in fused)
+
+
+class DeadlineMissReranker(Reranker):
+    """Always runs out of its deadline and hands back the candidates in order"""
+    
+    async def rerank(self, user_query, expanded_query, candidates, top_k=10, deadline_ms=None):
+        fallback = [{"product": c["product"], "relevance_score": c["score"], "reasoning": "fallback",
+                     "original_score": c["score"], "id": c["id"]} for c in candidates[:top_k]]
+        raise StageDeadlineExceeded("rerank", fallback)
+
+
+def test_rerank_deadline_miss_is_skipped_and_not_cached():
+    ids, payloads = make_catalog()
+    candidates = [{"product": p, "score": 0.9 - i / 100, "id": ids[i]} for i, p in enumerate(payloads[:5])]
+    
+    async def vector_candidates(*args, **kwargs):
+        return candidates
+    
+    saved = {name: getattr(api, name) for name in ("reranker", "lexical_index", "USE_LLM", "_vector_candidates")}
+    api.reranker = DeadlineMissReranker()
+    api.lexical_index = None
+    api.USE_LLM = False
+    api._vector_candidates = vector_candidates
+    try:
+        request = api.SearchRequest(query="rerank deadline test candle", limit=3)
+        data = asyncio.run(api._search_and_cache(request))
+        assert "rerank" in data["skippedStages"]
+        assert "rerank" not in data["stages"]
+        assert len(data["results"]) == 3
+        text, limit, price_min, price_max = api._search_cache_args(request)
+        assert api.search_results_cache.get(text, limit, price_min, price_max) is None
+    finally:
+        for name, value in saved.items():
+            setattr(api, name, value)
+
+
+class FakeCrossEncoder:
+    """Scores a (query, text) pair by the relevance given in the text's title; optionally slow"""
+    
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+    
+    def predict(self, pairs, batch_size=None):
+        time.sleep(self.delay)
+        return [float(text.split("relevance ")[1].split()[0]) for _, text in pairs]
+
+
+def make_cross_encoder(delay: float = 0.0, min_score: float = 0.3) -> CrossEncoderReranker:
+    reranker = CrossEncoderReranker.__new__(CrossEncoderReranker)  # Skip loading a real model
+    reranker.model = FakeCrossEncoder(delay)
+    reranker.backend = "torch"
+    reranker.max_candidates = 30
+    reranker.min_score = min_score
+    reranker.logits = False
+    return reranker
+
+
+def make_apparel_candidates():
+    products = [("Zip Hoodie", "hoodie", 0.9), ("Graphic Tee", "t-shirt", 0.95), ("Fleece Hoodie", "hoodie", 0.5),
+                ("Pullover Hoodie", "hoodie", 0.1)]
+    return [
+        {"product": {"title": f"{title} relevance {relevance}", "tags": tags, "product_type": tags},
+         "score": 0.5, "id": f"apparel-{i}"}
+        for i, (title, tags, relevance) in enumerate(products)
+    ]
+
+
+def test_cross_encoder_applies_type_mask_and_score_floor():
+    results = asyncio.run(make_cross_encoder().rerank("hoodie", {}, make_apparel_candidates(), top_k=10))
+    # The tee scores highest but is not a hoodie; the last hoodie is below the floor
+    assert [r["id"] for r in results] == ["apparel-0", "apparel-2"]
+    assert all(isinstance(r["reasoning"], str) and r["reasoning"] for r in results)
+
+
+def test_cross_encoder_deadline_falls_back():
+    reranker = make_cross_encoder(delay=0.5)
+    try:
+        asyncio.run(reranker.rerank("hoodie", {}, make_apparel_candidates(), top_k=10, deadline_ms=50))
+    except StageDeadlineExceeded as e:
+        assert e.stage == "rerank"
+        assert e.fallback and all("hoodie" in r["product"]["product_type"] for r in e.fallback)
+    else:
+        raise AssertionError("rerank did not report the missed deadline")
+
+
+def test_llm_rerank_failure_keeps_cached_scores():
+    candidates = make_apparel_candidates()
+    score_text = api.canonicalize_query("hoodie")["text"]
+    api.rerank_score_cache.set(f"{score_text}|apparel-2", 0, (0.95, "Warm fleece hoodie"))
+    api.rerank_score_cache.set(f"{score_text}|apparel-0", 0, (0.0, None))
+    
+    async def failing_llm(*args, **kwargs):
+        return ""
+    
+    saved = api.call_llm
+    api.call_llm = failing_llm
+    try:
+        results = asyncio.run(api.rerank_with_llm("hoodie", {}, candidates, top_k=10))
+    finally:
+        api.call_llm = saved
+        api.rerank_score_cache.clear_memory()
+    # The cached score ranks first; of the unscored candidates only the hoodie survives the fallback
+    assert [r["id"] for r in results] == ["apparel-2", "apparel-3"]
+    assert results[0]["relevance_score"] == 0.95
+
+
+def test_hot_cache_entry_survives_a_scan():
+    cache = ShardedTTLCache(maxsize=2, ttl=60, shards=1)
+    assert cache.get("hot", 10) is None
+    cache.set("hot", 10, {"results": ["hot"]})
+    for _ in range(50):
+        assert cache.get("hot", 10) is not None
+    # Each one-off key is looked up once (a miss) and then cached, like a search
+    for i in range(5):
+        assert cache.get(f"one-off {i}", 10) is None
+        cache.set(f"one-off {i}", 10, {"results": [i]})
+    assert cache.get("hot", 10) == {"results": ["hot"]}
+
+
+if __name__ == "__main__":
+    tests = [(name, fn) for name, fn in sorted(globals().items()) if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn()
+            print(f"✅ PASS: {name}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ FAIL: {name} {e}")
+    print(f"{len(tests) - failed}/{len(tests)} passed")
+    sys.exit(1 if failed else 0)
@@ -16,20 +16,30 @@ Supports: OpenAI, Ollama (local), or fallback to simple search
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Awaitable
+from abc import ABC, abstractmethod
+import asyncio
 import time
 import json
 import os
 import hashlib
-from collections import OrderedDict
+import importlib.util
+import sqlite3
+import unicodedata
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import requests
+import httpx
+import numpy as np
 import re
 import random
+import shutil
 
-from qdrant_client import QdrantClient
-from sentence_transformers import SentenceTransformer
+from qdrant_client import AsyncQdrantClient, models
+from sentence_transformers import SentenceTransformer, CrossEncoder
 
 # Load environment variables
 load_dotenv()
@@ -61,15 +71,188 @@ else:
 
 USE_LLM = LLM_PROVIDER != "none"
 
+# Concurrency Configuration
+# The encoder is CPU-bound, so it runs in a small thread pool instead of on the event loop
+ENCODER_WORKERS = int(os.getenv("ENCODER_WORKERS", "2"))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "60"))  # Seconds, for complex prompts
+
+# Ollama connection pool and model residency
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "16"))
+OLLAMA_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_KEEPALIVE_CONNECTIONS", "8"))  # Idle connections kept open
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "120"))  # Seconds an idle connection is kept
+# How long Ollama keeps the model loaded: a duration ("30m") or seconds (-1 = forever). Ollama
+# reads strings as Go durations, so bare integers are sent as numbers
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE) if OLLAMA_KEEP_ALIVE.lstrip("-").isdigit() else OLLAMA_KEEP_ALIVE
+OLLAMA_WARMUP = os.getenv("OLLAMA_WARMUP", "true").lower() == "true"  # Load the model at startup
+OLLAMA_COLD_LOAD_MS = float(os.getenv("OLLAMA_COLD_LOAD_MS", "500"))  # load_duration above this = model was loaded
+
+# Hedged LLM calls: if the primary provider has not answered after the stage's
+# hedge delay, the other provider is started too and the first valid answer wins.
+# Every stage also has a hard deadline, after which the caller falls back.
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+LLM_HEDGE_AUTO = os.getenv("LLM_HEDGE_AUTO", "true").lower() == "true"  # Tune delay to primary's p95
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "250"))
+LLM_HEDGE_DELAY_MS = {
+    "expansion": float(os.getenv("LLM_HEDGE_DELAY_EXPANSION_MS", "2000")),
+    "rerank": float(os.getenv("LLM_HEDGE_DELAY_RERANK_MS", "3000")),
+}
+LLM_DEADLINE_MS = {
+    "expansion": float(os.getenv("LLM_DEADLINE_EXPANSION_MS", "10000")),
+    "rerank": float(os.getenv("LLM_DEADLINE_RERANK_MS", "15000")),
+}
+LLM_DEFAULT_DEADLINE_MS = float(os.getenv("LLM_DEADLINE_MS", "20000"))  # Stages without their own setting
+# Budget deadlines are rounded down to this step so calls with similar deadlines still coalesce
+LLM_DEADLINE_BUCKET_MS = float(os.getenv("LLM_DEADLINE_BUCKET_MS", "250"))
+# Stop streamed generation once the caller has what it needs (rerank top_k, semantic_expansion)
+LLM_EARLY_STOP = os.getenv("LLM_EARLY_STOP", "true").lower() == "true"
+
+# Raw-query search runs alongside LLM expansion; both candidate lists are fused with RRF
+RAW_QUERY_FUSION = os.getenv("RAW_QUERY_FUSION", "true").lower() == "true"
+RRF_K = int(os.getenv("RRF_K", "60"))  # Reciprocal-rank fusion constant
+
+# Rerank prompt: compact per-product lines precomputed at startup, packed up to a token budget
+RERANK_TOKEN_BUDGET = int(os.getenv("RERANK_TOKEN_BUDGET", "1200"))  # Tokens for the product lines
+RERANK_MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", "15"))
+RERANK_REASONS = os.getenv("RERANK_REASONS", "false").lower() == "true"  # Ask for [i, s, "reason"]
+
+# Reranker backend: "llm" (default when an LLM is available), "cross-encoder" or "none"
+RERANKER = os.getenv("RERANKER", "")
+CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+CROSS_ENCODER_BACKEND = os.getenv("CROSS_ENCODER_BACKEND", "torch")  # torch, onnx or onnx-int8
+CROSS_ENCODER_ONNX_FILE = os.getenv("CROSS_ENCODER_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")  # For onnx-int8
+CROSS_ENCODER_MAX_CANDIDATES = int(os.getenv("CROSS_ENCODER_MAX_CANDIDATES", "30"))
+CROSS_ENCODER_MIN_SCORE = float(os.getenv("CROSS_ENCODER_MIN_SCORE", "0.1"))  # Relevance floor, in [0, 1]
+
+# Popularity normalization from a periodic full-collection scan
+POPULARITY_REFRESH_INTERVAL = float(os.getenv("POPULARITY_REFRESH_INTERVAL", "3600"))  # Seconds
+POPULARITY_PERCENTILE = float(os.getenv("POPULARITY_PERCENTILE", "99"))  # Counts above this percentile saturate
+POPULARITY_SCALING = os.getenv("POPULARITY_SCALING", "log")  # log or linear
+
+# Final ranking: weights of LLM relevance and normalized popularity, and the minimum final score
+SCORE_WEIGHT_RELEVANCE = float(os.getenv("SCORE_WEIGHT_RELEVANCE", "0.70"))
+SCORE_WEIGHT_VOTES = float(os.getenv("SCORE_WEIGHT_VOTES", "0.20"))
+SCORE_WEIGHT_VIEWS = float(os.getenv("SCORE_WEIGHT_VIEWS", "0.10"))
+FINAL_SCORE_MIN = float(os.getenv("FINAL_SCORE_MIN", "0"))
+
+# /search/batch: queries per request, and short expansions packed into one LLM call
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "50"))
+EXPANSION_BATCH_SIZE = int(os.getenv("EXPANSION_BATCH_SIZE", "8"))
+
+# Per-request latency budget (SearchRequest.latencyBudgetMs overrides; 0 = unlimited).
+# Expansion and rerank are skipped when live estimates say they would not fit.
+SEARCH_LATENCY_BUDGET_MS = float(os.getenv("SEARCH_LATENCY_BUDGET_MS", "0"))
+STAGE_LATENCY_DEFAULTS_MS = {  # Used until enough live samples exist
+    "expansion": 1500.0,
+    "vector_search": 100.0,
+    "rerank": 2500.0,
+}
+
+# Vector search backend: "qdrant", or "local" for brute-force search over a memory-mapped
+# snapshot of the collection (Qdrant stays the source of truth and the fallback)
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "qdrant")
+LOCAL_INDEX_REFRESH_INTERVAL = float(os.getenv("LOCAL_INDEX_REFRESH_INTERVAL", "3600"))  # Seconds between exports
+LOCAL_INDEX_IVF_LISTS = int(os.getenv("LOCAL_INDEX_IVF_LISTS", "0"))  # k-means partitions; 0 = exact search
+LOCAL_INDEX_IVF_PROBE = int(os.getenv("LOCAL_INDEX_IVF_PROBE", "8"))  # Partitions scanned per query
+
+# Lexical (BM25) search fused with the vector results; short keyword queries that enough
+# products match on every term skip LLM expansion and rerank
+LEXICAL_SEARCH = os.getenv("LEXICAL_SEARCH", "true").lower() == "true"
+LEXICAL_SKIP_LLM = os.getenv("LEXICAL_SKIP_LLM", "true").lower() == "true"
+LEXICAL_STRONG_MAX_TERMS = int(os.getenv("LEXICAL_STRONG_MAX_TERMS", "2"))
+LEXICAL_STRONG_MIN_IDF = float(os.getenv("LEXICAL_STRONG_MIN_IDF", "1.5"))  # BM25 IDF; 1.5 ~ in under 25% of products
+LEXICAL_INDEX_REFRESH_INTERVAL = float(os.getenv("LEXICAL_INDEX_REFRESH_INTERVAL", "3600"))  # Seconds
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Query intent (product type, recipient, aesthetic) compiled into the vector-search filter.
+# While fewer than the requested results match, conditions are dropped in INTENT_RELAX_ORDER.
+INTENT_FILTERS = os.getenv("INTENT_FILTERS", "true").lower() == "true"
+INTENT_RELAX_ORDER = ["aesthetics", "recipients", "product_type"]
+INTENT_VOCABULARY_REFRESH_INTERVAL = float(os.getenv("INTENT_VOCABULARY_REFRESH_INTERVAL", "3600"))  # Seconds
+INTENT_VOCABULARY_LIMIT = 1000  # Distinct product_type / aesthetics values read from the collection
+INTENT_IGNORED_VALUES = {"general"}  # Catch-all labels that say nothing about the product
+PAYLOAD_INDEXES = {  # Created at startup if missing
+    "price": models.PayloadSchemaType.FLOAT,
+    "product_type": models.PayloadSchemaType.KEYWORD,
+    "recipients": models.PayloadSchemaType.KEYWORD,
+    "aesthetics": models.PayloadSchemaType.KEYWORD,
+}
+
+# Query embedding micro-batching: concurrent encode calls arriving within the
+# window (or until the batch is full) share a single encoder forward pass
+ENCODER_BATCH_WINDOW_MS = float(os.getenv("ENCODER_BATCH_WINDOW_MS", "3"))  # 0 disables batching
+ENCODER_MAX_BATCH = int(os.getenv("ENCODER_MAX_BATCH", "32"))
+
 # Cache Configuration
 CACHE_SIZE = 500  # Number of queries to cache
 CACHE_TTL = 3600  # Cache TTL in seconds (1 hour)
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
 
-# Product types for filtering (used in reranking and fallback)
-PRODUCT_TYPE_LIST = [
-    'hoodie', 'hoodies', 't-shirt', 'tshirt', 'tee', 'shirt', 'dress', 'pants', 'jeans',
-    'jacket', 'bag', 'backpack', 'shoes', 'sneakers', 'watch', 'skincare', 'makeup', 'cream'
-]
+# Query embedding cache: search_text -> vector, memory-mapped so it survives restarts
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "5000"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(CACHE_DIR, "query_embeddings"))  # "" = memory only
+EMBEDDING_CACHE_SYNC_INTERVAL = float(os.getenv("EMBEDDING_CACHE_SYNC_INTERVAL", "30"))  # Max seconds between saves
+
+# Persistent (SQLite, WAL mode) tier behind the TTL caches - survives deploys and crashes
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", os.path.join(CACHE_DIR, "search_cache.db"))
+CACHE_SNAPSHOT_DIR = os.getenv("CACHE_SNAPSHOT_DIR", os.path.join(CACHE_DIR, "snapshots"))
+PERSIST_EXPANSION_CACHE = os.getenv("PERSIST_EXPANSION_CACHE", "true").lower() == "true"
+PERSIST_RESULTS_CACHE = os.getenv("PERSIST_RESULTS_CACHE", "false").lower() == "true"
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(CACHE_DIR, "local_index"))
+PERSISTENT_CACHE_MAX_ROWS = int(os.getenv("PERSISTENT_CACHE_MAX_ROWS", "10000"))  # Per cache
+
+# Semantic expansion cache: reuse an expansion for near-duplicate queries
+# ("gift for girlfriend" ~ "girlfriend gifts") instead of calling the LLM again
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))  # Cosine similarity
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+
+# Search results: serve stale entries for a grace period while recomputing in the
+# background, and refresh frequently-hit entries shortly before they expire
+SEARCH_STALE_TTL = int(os.getenv("SEARCH_STALE_TTL", "600"))  # Seconds past TTL an entry may be served
+REFRESH_AHEAD_FRACTION = float(os.getenv("REFRESH_AHEAD_FRACTION", "0.8"))  # Of TTL elapsed
+REFRESH_AHEAD_MIN_HITS = int(os.getenv("REFRESH_AHEAD_MIN_HITS", "3"))  # Hits in the current TTL
+
+# Cache engine: lock-striped shards, frequency-based admission, byte-size limits
+CACHE_SHARDS = int(os.getenv("CACHE_SHARDS", "8"))
+EXPANSION_CACHE_MAX_BYTES = int(os.getenv("EXPANSION_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))  # 0 = no byte limit
+RESULTS_CACHE_MAX_BYTES = int(os.getenv("RESULTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", "1.0"))  # Seconds between expiry sweeps
+
+# Per-(canonical query, product id) LLM rerank scores; only unscored candidates are sent to the LLM
+RERANK_SCORE_CACHE_SIZE = int(os.getenv("RERANK_SCORE_CACHE_SIZE", "20000"))
+RERANK_SCORE_CACHE_TTL = int(os.getenv("RERANK_SCORE_CACHE_TTL", "1800"))
+
+# Product types for filtering (used in reranking and fallback): canonical type -> other
+# spellings. Matched on whole normalized tokens, so plurals and hyphenation are implied.
+PRODUCT_TYPE_SYNONYMS = {
+    'hoodie': ['hoody', 'hooded sweatshirt'],
+    't-shirt': ['tee', 'tee shirt'],
+    'shirt': [],
+    'dress': ['gown'],
+    'pants': ['trousers', 'joggers', 'chinos'],
+    'jeans': ['denims'],
+    'jacket': ['blazer'],
+    'bag': ['handbag', 'tote', 'sling bag', 'purse'],
+    'backpack': ['rucksack'],
+    'shoes': ['footwear', 'loafers'],
+    'sneakers': ['trainers'],
+    'watch': ['wristwatch', 'smartwatch'],
+    'skincare': ['skin care', 'serum', 'moisturizer', 'moisturiser', 'sunscreen'],
+    'makeup': ['make up', 'lipstick', 'mascara', 'eyeliner'],
+    'cream': ['lotion'],
+}
+
+# Recipient payload values (upsert_toastd.py RECIPIENT_MAP) -> how queries name them
+RECIPIENT_SYNONYMS = {
+    'boyfriends': ['boyfriend', 'bf'],
+    'girlfriends': ['girlfriend', 'gf'],
+    'mom': ['mother', 'mum', 'mummy', 'mommy'],
+    'dad': ['father', 'papa', 'daddy'],
+    'friend': ['best friend', 'bestie', 'bff'],
+    'colleague': ['coworker', 'co-worker'],
+}
 
 app = FastAPI(
     title="Toastd Advanced Search API",
@@ -92,9 +275,23 @@ app.add_middleware(
 # Global instances
 qdrant_client = None
 encoder = None
+embedding_cache = None
+semantic_expansion_cache = None
+encoder_executor = None
+http_client = None
 openai_client = None
-max_views = 1
-max_votes = 1
+cache_sweeper_task = None
+reranker = None
+popularity_task = None
+local_index = None
+local_index_task = None
+lexical_index = None
+lexical_index_task = None
+intent_vocabulary_task = None
+ollama_warmup_task = None
+product_repr_task = None
+product_llm_reprs: Dict[str, str] = {}  # product id -> compact line for rerank prompts
+product_type_masks: Dict[str, int] = {}  # product id -> PhraseMatcher bitmask
 ollama_available = False
 
 
@@ -102,65 +299,784 @@ ollama_available = False
 # TTL Cache Implementation (faster than Redis for single server)
 # ============================================================
 
-class TTLCache:
-    """Simple TTL cache with LRU eviction"""
+def _json_default(value):
+    """JSON encoder fallback for Pydantic models stored in cached results"""
+    if hasattr(value, 'model_dump'):
+        return value.model_dump()
+    if hasattr(value, 'dict'):
+        return value.dict()
+    raise TypeError(f"Not JSON serializable: {type(value).__name__}")
+
+
+class SQLiteCacheTier:
+    """On-disk tier for one TTL cache, stored in a shared SQLite database (WAL mode).
+    
+    Every SQLite call blocks, so none of them run on the event loop: put() only
+    queues the row (write-behind) and flush() - run in a thread by the cache
+    sweeper - writes the queue in one transaction and compacts every
+    compact_every writes. Reads go through get(), which callers run in a thread
+    (ShardedTTLCache.get_entry_async); rows still queued are served from the queue.
+    
+    The connection is opened lazily on first use, so startup never waits on the
+    file. Rows keep their original timestamp so TTLs carry across restarts, and
+    compaction drops expired rows before trimming the oldest ones down to max_rows.
+    """
+    
+    def __init__(self, path: str, namespace: str, ttl: int, max_rows: int = 10000, compact_every: int = 200):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.compact_every = compact_every
+        self._conn = None
+        self._lock = threading.Lock()          # Connection
+        self._pending_lock = threading.Lock()  # Write-behind queue
+        self._pending: Dict[str, tuple] = {}   # key -> (value, stored_at), latest write wins
+        self._writes = 0
+        self.rows = 0
+        self.reads = 0
+        self.hits = 0
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "stored_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_age ON cache_entries (namespace, stored_at)")
+            conn.commit()
+            self._conn = conn
+            self._compact_locked()
+            self._count_rows_locked()
+        return self._conn
+    
+    def get(self, key: str) -> Optional[tuple]:
+        """Return (value, stored_at) for a live entry, or None (blocking)"""
+        with self._pending_lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            row = pending
+        else:
+            with self._lock:
+                self.reads += 1
+                row = self._connection().execute(
+                    "SELECT value, stored_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                ).fetchone()
+            if row is not None:
+                row = (json.loads(row[0]), row[1])
+        if row is None or time.time() - row[1] >= self.ttl:
+            return None
+        self.hits += 1
+        return row
+    
+    def put(self, key: str, value: Any, stored_at: float):
+        """Queue a row for the next flush() (no I/O)"""
+        with self._pending_lock:
+            self._pending[key] = (value, stored_at)
+    
+    def flush(self) -> int:
+        """Write queued rows in one transaction, compacting when due (blocking); returns rows written"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        with self._lock:
+            conn = self._connection()
+            if pending:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, value, stored_at) VALUES (?, ?, ?, ?)",
+                    [(self.namespace, key, json.dumps(value, default=_json_default), stored_at)
+                     for key, (value, stored_at) in pending.items()]
+                )
+                conn.commit()
+                previous = self._writes
+                self._writes += len(pending)
+                if self._writes // self.compact_every > previous // self.compact_every:
+                    self._compact_locked()
+                self._count_rows_locked()
+        return len(pending)
+    
+    def discard_pending(self):
+        """Drop queued rows without writing them"""
+        with self._pending_lock:
+            self._pending.clear()
+    
+    def recount(self):
+        """Refresh the row count, e.g. after another tier restored the shared file (blocking)"""
+        with self._lock:
+            self._connection()
+            self._count_rows_locked()
+    
+    def _count_rows_locked(self):
+        self.rows = self._conn.execute(
+            "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+    
+    def compact(self) -> int:
+        """Drop expired rows and trim to max_rows; returns rows removed (blocking)"""
+        with self._lock:
+            self._connection()
+            return self._compact_locked()
+    
+    def _compact_locked(self) -> int:
+        conn = self._conn
+        removed = conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND stored_at < ?",
+            (self.namespace, time.time() - self.ttl)
+        ).rowcount
+        removed += conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+            "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_rows)
+        ).rowcount
+        conn.commit()
+        return removed
+    
+    def clear(self):
+        """Drop queued and stored rows (blocking)"""
+        with self._pending_lock:
+            self._pending.clear()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+            conn.commit()
+            self.rows = 0
+    
+    def snapshot(self, dest_path: str):
+        """Copy the whole cache database to dest_path (consistent online backup, blocking).
+        
+        Only this tier's queue is flushed first; see _snapshot_tiers for the shared file.
+        """
+        self.flush()
+        with self._lock:
+            dest = sqlite3.connect(dest_path)
+            try:
+                self._connection().backup(dest)
+            finally:
+                dest.close()
+    
+    def restore(self, src_path: str):
+        """Replace the whole cache database with the contents of src_path (blocking).
+        
+        Other tiers on the same file must drop their queues first; see _restore_tiers.
+        """
+        self.discard_pending()
+        with self._lock:
+            src = sqlite3.connect(src_path)
+            try:
+                src.backup(self._connection())
+            finally:
+                src.close()
+            self._count_rows_locked()
+    
+    def close(self):
+        """Flush queued rows and close the connection (blocking)"""
+        self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def stats(self) -> Dict:
+        """Counters only (row count as of the last flush); never touches the database"""
+        return {
+            "path": self.path,
+            "rows": self.rows,
+            "pendingWrites": len(self._pending),
+            "maxRows": self.max_rows,
+            "reads": self.reads,
+            "hits": self.hits
+        }
+
+
+_HALVE_COUNTERS = bytes(count >> 1 for count in range(256))
+SKETCH_HIT_SAMPLE = 4  # Cache hits feed the frequency sketch once per this many hits of a shard
+
+
+class FrequencySketch:
+    """Count-min sketch of key access frequency (TinyLFU admission).
+    
+    Four rows of 4-bit saturating counters (bytearrays, one 16-bit slice of the
+    key hash per row); every counter is halved once sample_size increments have
+    been recorded, so old popularity fades. Every miss is counted, and a sample of
+    hits (one in SKETCH_HIT_SAMPLE per shard), so an entry that is read often
+    outranks one-off keys without every hit paying for the sketch update.
+    """
+    
+    def __init__(self, capacity: int):
+        width = 1 << max(4, (max(capacity, 1) * 4 - 1).bit_length())
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in range(4)]
+        self.sample_size = max(capacity, 1) * 10
+        self.additions = 0
+    
+    def increment(self, key: str):
+        h = hash(key)
+        mask = self.mask
+        r0, r1, r2, r3 = self.rows
+        i0, i1, i2, i3 = h & mask, (h >> 16) & mask, (h >> 32) & mask, (h >> 48) & mask
+        if r0[i0] < 15:
+            r0[i0] += 1
+        if r1[i1] < 15:
+            r1[i1] += 1
+        if r2[i2] < 15:
+            r2[i2] += 1
+        if r3[i3] < 15:
+            r3[i3] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [row.translate(_HALVE_COUNTERS) for row in self.rows]
+            self.additions //= 2
+    
+    def estimate(self, key: str) -> int:
+        h = hash(key)
+        mask = self.mask
+        r0, r1, r2, r3 = self.rows
+        return min(r0[h & mask], r1[(h >> 16) & mask], r2[(h >> 32) & mask], r3[(h >> 48) & mask])
+
+
+class _CacheShard:
+    """One lock-protected stripe of a ShardedTTLCache"""
+    
+    def __init__(self, max_items: int, max_bytes: int):
+        self.lock = threading.Lock()
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()   # key -> [value, timestamp, size, hits], LRU order
+        self.inserted: OrderedDict = OrderedDict()  # key -> timestamp, insertion (= expiry) order
+        self.bytes = 0
+        self.sketch = FrequencySketch(max_items)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+    
+    def insert(self, key: str, value: Any, timestamp: float, size: int, hits: int) -> bool:
+        """Insert under the lock; returns False if admission rejected the entry"""
+        if key in self.entries:
+            self.remove(key)
+        if self.max_bytes and size > self.max_bytes:
+            self.rejections += 1
+            return False
+        
+        # TinyLFU: a newcomer only displaces the LRU victim if it is at least as popular
+        if self.entries and self._over_limit(size):
+            victim = next(iter(self.entries))
+            if self.sketch.estimate(key) < self.sketch.estimate(victim):
+                self.rejections += 1
+                return False
+            while self.entries and self._over_limit(size):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+        
+        self.entries[key] = [value, timestamp, size, hits]
+        self.inserted[key] = timestamp
+        self.bytes += size
+        return True
+    
+    def _over_limit(self, size: int) -> bool:
+        return len(self.entries) >= self.max_items or bool(self.max_bytes and self.bytes + size > self.max_bytes)
+    
+    def remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.inserted.pop(key, None)
+        self.bytes -= entry[2]
     
-    def __init__(self, maxsize: int = 500, ttl: int = 3600):
+    def expire(self, now: float, max_age: float, budget: int) -> int:
+        """Drop expired entries from the oldest end, scanning at most `budget`"""
+        removed = 0
+        while self.inserted and removed < budget:
+            key, timestamp = next(iter(self.inserted.items()))
+            if now - timestamp < max_age:
+                break
+            self.remove(key)
+            removed += 1
+        self.expirations += removed
+        return removed
+    
+    def clear(self):
+        self.entries.clear()
+        self.inserted.clear()
+        self.bytes = 0
+
+
+def _estimate_size(value: Any) -> int:
+    """Approximate memory cost of a cached value (its JSON size in bytes)"""
+    try:
+        return len(json.dumps(value, default=_json_default))
+    except (TypeError, ValueError):
+        return len(str(value))
+
+
+class ShardedTTLCache:
+    """TTL cache engine with lock-striped shards and TinyLFU-style admission.
+    
+    Optional persistent tier and stale grace period: with stale_ttl > 0, expired
+    entries are kept for that long so callers using get_entry() can serve them
+    stale while refreshing in the background. Safe to share with executor threads.
+    maxsize and max_bytes are split exactly across the shards, so the per-shard
+    limits never add up to more than the global ones. The byte limit is enforced
+    per shard: a single entry larger than max_bytes / shards is never admitted,
+    even into an empty cache (stats() reports it as maxEntryBytes). Expired entries are
+    reclaimed by expire(), which the background sweeper calls with a small
+    per-shard budget so the cost is amortized.
+    
+    get_entry()/get() only look at memory; the async variants also read through
+    to the persistent tier, off the event loop.
+    """
+    
+    def __init__(self, maxsize: int = 500, ttl: int = 3600, store: Optional[SQLiteCacheTier] = None,
+                 stale_ttl: int = 0, max_bytes: int = 0, shards: int = 8):
         self.maxsize = maxsize
         self.ttl = ttl
-        self.cache: OrderedDict = OrderedDict()
-        self.timestamps: Dict[str, float] = {}
+        self.stale_ttl = stale_ttl
+        self.store = store
+        self.max_bytes = max_bytes
+        num_shards = max(1, min(shards, maxsize))
+        # The first maxsize % num_shards shards take one extra entry; the sum is exactly maxsize
+        self.shards = [
+            _CacheShard(maxsize // num_shards + (i < maxsize % num_shards), max_bytes // num_shards)
+            for i in range(num_shards)
+        ]
     
     def _make_key(self, query: str, limit: int, price_min: float = None, price_max: float = None) -> str:
         """Create cache key from search parameters"""
         key_str = f"{query.lower().strip()}|{limit}|{price_min}|{price_max}"
         return hashlib.sha256(key_str.encode()).hexdigest()[:32]
     
+    def _shard(self, key: str) -> _CacheShard:
+        # Keys are hex digests; use bits the frequency sketch does not index by
+        return self.shards[int(key[-4:], 16) % len(self.shards)]
+    
     def get(self, query: str, limit: int, price_min: float = None, price_max: float = None) -> Optional[Dict]:
-        """Get cached result if exists and not expired"""
+        """Get cached result if exists and not expired (memory only).
+        
+        Kept separate from get_entry(): rerank scores are looked up once per candidate.
+        """
+        key = self._make_key(query, limit, price_min, price_max)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                shard.entries.move_to_end(key)
+                entry[3] += 1
+                shard.hits += 1
+                if shard.hits % SKETCH_HIT_SAMPLE == 0:
+                    shard.sketch.increment(key)
+                return entry[0]
+            shard.sketch.increment(key)
+            shard.misses += 1
+        return None
+    
+    def get_entry(self, query: str, limit: int, price_min: float = None, price_max: float = None) -> Optional[tuple]:
+        """Get (value, state, age_seconds, hits) where state is "fresh" or "stale" """
         key = self._make_key(query, limit, price_min, price_max)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None:
+                age = time.time() - entry[1]
+                if age < self.ttl + self.stale_ttl:
+                    shard.entries.move_to_end(key)
+                    entry[3] += 1
+                    shard.hits += 1
+                    if shard.hits % SKETCH_HIT_SAMPLE == 0:
+                        shard.sketch.increment(key)
+                    return entry[0], "fresh" if age < self.ttl else "stale", age, entry[3]
+                shard.remove(key)
+                shard.expirations += 1
+            shard.sketch.increment(key)
+            shard.misses += 1
+        return None
+    
+    async def get_entry_async(self, query: str, limit: int, price_min: float = None,
+                              price_max: float = None) -> Optional[tuple]:
+        """get_entry() that reads through to the persistent tier on a memory miss.
         
-        if key in self.cache:
-            # Check TTL
-            if time.time() - self.timestamps[key] < self.ttl:
-                # Move to end (most recently used)
-                self.cache.move_to_end(key)
-                return self.cache[key]
-            else:
-                # Expired, remove
-                del self.cache[key]
-                del self.timestamps[key]
+        The SQLite read runs in a worker thread; live rows are promoted to memory.
+        """
+        entry = self.get_entry(query, limit, price_min, price_max)
+        if entry is not None or self.store is None:
+            return entry
+        key = self._make_key(query, limit, price_min, price_max)
+        stored = await asyncio.to_thread(self.store.get, key)
+        if stored is None:
+            return None
+        value, stored_at = stored
+        self._insert(key, value, stored_at, hits=1)
+        return value, "fresh", time.time() - stored_at, 1
+    
+    async def get_async(self, query: str, limit: int, price_min: float = None, price_max: float = None) -> Optional[Dict]:
+        """get() that reads through to the persistent tier (see get_entry_async)"""
+        entry = await self.get_entry_async(query, limit, price_min, price_max)
+        if entry and entry[1] == "fresh":
+            return entry[0]
         return None
     
     def set(self, query: str, limit: int, result: Dict, price_min: float = None, price_max: float = None):
-        """Cache a result"""
+        """Cache a result (subject to admission); the persistent copy is written behind"""
         key = self._make_key(query, limit, price_min, price_max)
+        now = time.time()
+        self._insert(key, result, now)
         
-        # Evict oldest if at capacity
-        while len(self.cache) >= self.maxsize:
-            oldest_key = next(iter(self.cache))
-            del self.cache[oldest_key]
-            del self.timestamps[oldest_key]
-        
-        self.cache[key] = result
-        self.timestamps[key] = time.time()
+        if self.store is not None:
+            self.store.put(key, result, now)
+    
+    def _insert(self, key: str, result: Any, timestamp: float, hits: int = 0) -> bool:
+        size = _estimate_size(result) if self.max_bytes else 0
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.insert(key, result, timestamp, size, hits)
+    
+    def expire(self, budget_per_shard: int = 64) -> int:
+        """Reclaim expired-but-unread entries; returns how many were dropped"""
+        now = time.time()
+        removed = 0
+        for shard in self.shards:
+            with shard.lock:
+                removed += shard.expire(now, self.ttl + self.stale_ttl, budget_per_shard)
+        return removed
     
     def clear(self):
         """Clear all cached results"""
-        self.cache.clear()
-        self.timestamps.clear()
+        self.clear_memory()
+        if self.store is not None:
+            self.store.clear()
+    
+    def clear_memory(self):
+        """Clear only the in-memory tier (e.g. after restoring the persistent tier)"""
+        for shard in self.shards:
+            with shard.lock:
+                shard.clear()
     
     def stats(self) -> Dict:
         """Get cache statistics"""
+        totals = {"size": 0, "bytes": 0, "hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "rejections": 0}
+        for shard in self.shards:
+            with shard.lock:
+                totals["size"] += len(shard.entries)
+                totals["bytes"] += shard.bytes
+                totals["hits"] += shard.hits
+                totals["misses"] += shard.misses
+                totals["evictions"] += shard.evictions
+                totals["expirations"] += shard.expirations
+                totals["rejections"] += shard.rejections
+        lookups = totals["hits"] + totals["misses"]
         return {
-            "size": len(self.cache),
+            **totals,
+            "hitRate": round(totals["hits"] / lookups, 3) if lookups else 0.0,
             "maxsize": self.maxsize,
-            "ttl": self.ttl
+            "maxBytes": self.max_bytes,
+            "maxEntryBytes": self.shards[0].max_bytes,
+            "shards": len(self.shards),
+            "ttl": self.ttl,
+            "staleTtl": self.stale_ttl,
+            "persistent": self.store.stats() if self.store is not None else None
         }
 
+
+class EmbeddingCache:
+    """LRU cache of search_text -> float32 query vector.
+    
+    Vectors live in one preallocated (capacity x dim) float32 array; the LRU index
+    only maps keys to row numbers. With a path, the array is a memory-mapped .npy
+    file and the index is saved next to it, so warm embeddings survive restarts.
+    set() only marks the cache dirty; persist() is called by the background
+    sweeper and does the msync and index write in a worker thread.
+    """
+    
+    def __init__(self, capacity: int = 5000, dim: int = 384, path: Optional[str] = None, sync_every: int = 100,
+                 sync_interval: float = 30.0):
+        self.capacity = capacity
+        self.dim = dim
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.slots: OrderedDict = OrderedDict()  # key -> row, least recently used first
+        self.free_rows = list(range(capacity - 1, -1, -1))
+        self.hits = 0
+        self.misses = 0
+        self._dirty = 0
+        self._saved_at = time.time()
+        self._save_lock = threading.Lock()  # One writer of the index file at a time
+        self.vectors = self._open_vectors()
+    
+    def _open_vectors(self):
+        """Allocate the vector array, reopening a persisted one when it matches"""
+        if not self.path:
+            return np.zeros((self.capacity, self.dim), dtype=np.float32)
+        
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        vectors_file = f"{self.path}.npy"
+        try:
+            if os.path.exists(vectors_file) and os.path.exists(f"{self.path}.json"):
+                vectors = np.load(vectors_file, mmap_mode="r+")
+                if vectors.shape == (self.capacity, self.dim) and vectors.dtype == np.float32:
+                    self._load_index()
+                    return vectors
+                print(f"Embedding cache shape changed, rebuilding {vectors_file}")
+        except Exception as e:
+            print(f"Embedding cache load failed, rebuilding: {e}")
+        
+        self.slots.clear()
+        self.free_rows = list(range(self.capacity - 1, -1, -1))
+        return np.lib.format.open_memmap(vectors_file, mode="w+", dtype=np.float32, shape=(self.capacity, self.dim))
+    
+    def _load_index(self):
+        with open(f"{self.path}.json") as f:
+            index = json.load(f)
+        used = set()
+        for key, row in index.get("slots", []):
+            if 0 <= row < self.capacity and row not in used:
+                self.slots[key] = row
+                used.add(row)
+        self.free_rows = [row for row in range(self.capacity - 1, -1, -1) if row not in used]
+    
+    def _make_key(self, text: str) -> str:
+        return hashlib.sha256(text.strip().encode()).hexdigest()[:32]
+    
+    def get(self, text: str):
+        """Return a copy of the cached vector, or None"""
+        key = self._make_key(text)
+        row = self.slots.get(key)
+        if row is None:
+            self.misses += 1
+            return None
+        self.slots.move_to_end(key)
+        self.hits += 1
+        return np.array(self.vectors[row])
+    
+    def set(self, text: str, vector):
+        """Store a vector, evicting the least recently used row if full"""
+        key = self._make_key(text)
+        row = self.slots.get(key)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                _, row = self.slots.popitem(last=False)
+        self.vectors[row] = np.asarray(vector, dtype=np.float32)
+        self.slots[key] = row
+        self.slots.move_to_end(key)
+        self._dirty += 1
+    
+    def _write(self, slots: List[tuple]):
+        """Flush vectors and write the given LRU index snapshot atomically (blocking)"""
+        with self._save_lock:
+            self.vectors.flush()
+            tmp_file = f"{self.path}.json.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"dim": self.dim, "slots": slots}, f)
+            os.replace(tmp_file, f"{self.path}.json")
+    
+    async def persist(self, force: bool = False):
+        """Persist in a worker thread once sync_every inserts or sync_interval seconds have accumulated.
+        
+        The index is snapshotted on the event loop, so set() never waits on disk I/O.
+        """
+        if not self.path or not self._dirty:
+            return
+        if not force and self._dirty < self.sync_every and time.time() - self._saved_at < self.sync_interval:
+            return
+        dirty, self._dirty = self._dirty, 0
+        self._saved_at = time.time()
+        try:
+            await asyncio.to_thread(self._write, list(self.slots.items()))
+        except Exception:
+            self._dirty += dirty
+            raise
+    
+    def clear(self):
+        self.slots.clear()
+        self.free_rows = list(range(self.capacity - 1, -1, -1))
+        self._dirty += 1
+    
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.slots),
+            "maxsize": self.capacity,
+            "dim": self.dim,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / total, 3) if total else 0.0,
+            "persistent": bool(self.path)
+        }
+
+
+class SemanticExpansionCache:
+    """Small in-memory vector index of expanded queries.
+    
+    Stores the normalized embedding of every query that went through LLM expansion
+    in a preallocated matrix. A new query whose cosine similarity to a stored one is
+    at least `threshold` reuses that expansion, provided both have the same intent
+    signature: "gifts for mom" and "gifts for dad" embed close together but must
+    not share an expansion. Slots are reused oldest-first.
+    """
+    
+    def __init__(self, dim: int = 384, capacity: int = 1000, threshold: float = 0.9, ttl: int = 3600):
+        self.dim = dim
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.entries: List[Optional[tuple]] = [None] * capacity  # (query, expansion, stored_at, signature)
+        self.size = 0
+        self.next_slot = 0
+        self.lookups = 0
+        self.hits = 0
+        self.intent_mismatches = 0
+        self.similarity_sum = 0.0
+    
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+    
+    def lookup(self, vector, signature: Optional[tuple] = None) -> Optional[tuple]:
+        """Return (expansion, similarity, matched_query) for the closest live match with the same signature"""
+        self.lookups += 1
+        if self.size == 0:
+            return None
+        
+        similarities = self.vectors[:self.size] @ self._normalize(vector)
+        now = time.time()
+        # Walk candidates best-first until one is both above threshold and unexpired
+        for idx in np.argsort(-similarities):
+            similarity = float(similarities[idx])
+            if similarity < self.threshold:
+                break
+            query, expansion, stored_at, stored_signature = self.entries[idx]
+            if stored_signature != signature:
+                self.intent_mismatches += 1
+                continue
+            if now - stored_at < self.ttl:
+                self.hits += 1
+                self.similarity_sum += similarity
+                return expansion, similarity, query
+        return None
+    
+    def add(self, query: str, vector, expansion: Dict, signature: Optional[tuple] = None):
+        slot = self.next_slot
+        self.vectors[slot] = self._normalize(vector)
+        self.entries[slot] = (query, expansion, time.time(), signature)
+        self.next_slot = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+    
+    def clear(self):
+        self.entries = [None] * self.capacity
+        self.size = 0
+        self.next_slot = 0
+    
+    def stats(self) -> Dict:
+        return {
+            "size": self.size,
+            "maxsize": self.capacity,
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "intentMismatches": self.intent_mismatches,
+            "llmCallsSaved": self.hits,
+            "hitRate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+            "avgHitSimilarity": round(self.similarity_sum / self.hits, 4) if self.hits else None
+        }
+
+
 # Global cache instances
-query_expansion_cache = TTLCache(maxsize=200, ttl=3600)  # 1 hour TTL
-search_results_cache = TTLCache(maxsize=500, ttl=300)     # 5 min TTL (products may change)
+query_expansion_cache = ShardedTTLCache(
+    maxsize=200, ttl=3600,  # 1 hour TTL
+    max_bytes=EXPANSION_CACHE_MAX_BYTES,
+    shards=CACHE_SHARDS,
+    store=SQLiteCacheTier(CACHE_DB_PATH, "expansion", ttl=3600, max_rows=PERSISTENT_CACHE_MAX_ROWS) if PERSIST_EXPANSION_CACHE else None
+)
+search_results_cache = ShardedTTLCache(
+    maxsize=500, ttl=300,  # 5 min TTL (products may change)
+    stale_ttl=SEARCH_STALE_TTL,
+    max_bytes=RESULTS_CACHE_MAX_BYTES,
+    shards=CACHE_SHARDS,
+    store=SQLiteCacheTier(CACHE_DB_PATH, "results", ttl=300, max_rows=PERSISTENT_CACHE_MAX_ROWS) if PERSIST_RESULTS_CACHE else None
+)
+rerank_score_cache = ShardedTTLCache(  # (score, reason) per query text + product id
+    maxsize=RERANK_SCORE_CACHE_SIZE, ttl=RERANK_SCORE_CACHE_TTL,
+    max_bytes=0,
+    shards=CACHE_SHARDS
+)
+
+
+async def _cache_sweeper():
+    """Amortized background expiry for the TTL caches, and write-behind flushes
+    (with compaction) of their persistent tiers in a worker thread"""
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        for cache in (query_expansion_cache, search_results_cache, rerank_score_cache):
+            try:
+                cache.expire()
+                if cache.store is not None:
+                    await asyncio.to_thread(cache.store.flush)
+            except Exception as e:
+                print(f"Cache sweep failed: {e}")
+        if embedding_cache is not None:
+            try:
+                await embedding_cache.persist()
+            except Exception as e:
+                print(f"Embedding cache save failed: {e}")
+
+
+# ============================================================
+# Single-flight request coalescing
+# ============================================================
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one execution.
+    
+    The first caller for a key starts the work as its own task; every identical
+    call that arrives while it is in flight awaits that same task. The work is
+    shielded, so a cancelled (or timed-out) caller does not cancel it for the others.
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.executions = 0
+        self.coalesced = 0
+    
+    async def do(self, key: str, fn, timeout: Optional[float] = None):
+        """Run fn() once per in-flight key and share its result.
+        
+        timeout (seconds) bounds the wait of a caller that joins work already in flight
+        (the starting caller's fn is expected to bound itself); asyncio.TimeoutError is
+        raised when it expires and the shared work carries on.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            if timeout is not None:
+                return await asyncio.wait_for(asyncio.shield(task), max(timeout, 0))
+        return await asyncio.shield(task)
+    
+    def in_flight(self, key: str) -> bool:
+        return key in self._inflight
+    
+    def stats(self) -> Dict:
+        return {
+            "inFlight": len(self._inflight),
+            "executions": self.executions,
+            "coalesced": self.coalesced
+        }
+
+
+search_flight = SingleFlight()  # Identical /search and chat searches
+llm_flight = SingleFlight()     # Identical expansion / rerank prompts
 
 
 class SearchRequest(BaseModel):
@@ -170,6 +1086,15 @@ class SearchRequest(BaseModel):
     priceMax: Optional[float] = Field(None, ge=0)
     skipCache: bool = Field(False, description="Skip cache for fresh results")
     skipRerank: bool = Field(False, description="Skip LLM reranking for faster results")
+    latencyBudgetMs: Optional[float] = Field(None, ge=0, description="Latency budget; stages that would not fit are skipped (0 = unlimited)")
+
+
+class BatchSearchRequest(BaseModel):
+    searches: List[SearchRequest] = Field(..., min_length=1, max_length=BATCH_MAX_QUERIES)
+
+
+class CacheSnapshotRequest(BaseModel):
+    name: Optional[str] = Field(None, description="Snapshot file name inside CACHE_SNAPSHOT_DIR")
 
 
 class ProductResult(BaseModel):
@@ -197,114 +1122,1198 @@ class SearchResponse(BaseModel):
     processingTimeMs: float
     searchMode: str = "simple"
     cached: bool = False
+    stages: List[str] = []
+    skippedStages: List[str] = []
+
+
+class BatchSearchResponse(BaseModel):
+    results: List[SearchResponse]
+    totalQueries: int
+    cachedQueries: int
+    processingTimeMs: float
+
+
+# ============================================================
+# Ollama Helper Functions
+# ============================================================
+
+class OllamaPoolStats:
+    """Connection reuse (from httpx trace events) and model cold loads (from load_duration)"""
+    
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.cold_loads = 0
+        self.warm_calls = 0
+        self.last_load_ms: Optional[float] = None
+        self.warmed_up = False
+    
+    def trace(self) -> "_ConnectionTrace":
+        return _ConnectionTrace(self)
+    
+    def record_load(self, load_duration_ns: Optional[int]):
+        if load_duration_ns is None:
+            return
+        load_ms = load_duration_ns / 1e6
+        if load_ms >= OLLAMA_COLD_LOAD_MS:
+            self.cold_loads += 1
+            self.last_load_ms = round(load_ms, 1)
+        else:
+            self.warm_calls += 1
+    
+    def stats(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "newConnections": self.new_connections,
+            "reusedConnections": self.requests - self.new_connections,
+            "coldLoads": self.cold_loads,
+            "warmCalls": self.warm_calls,
+            "lastColdLoadMs": self.last_load_ms,
+            "keepAlive": OLLAMA_KEEP_ALIVE,
+            "warmedUp": self.warmed_up
+        }
+
+
+class _ConnectionTrace:
+    """httpx "trace" extension for one request: notes whether a new TCP connection was opened"""
+    
+    def __init__(self, stats: OllamaPoolStats):
+        self.stats = stats
+        stats.requests += 1
+    
+    async def __call__(self, event_name: str, info: Dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.stats.new_connections += 1
+
+
+ollama_stats = OllamaPoolStats()
+
+
+def _create_http_client() -> httpx.AsyncClient:
+    """Pooled keep-alive client shared by all Ollama calls"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY
+        ),
+        timeout=OLLAMA_TIMEOUT
+    )
+
+
+async def warm_up_ollama():
+    """Load the model into Ollama memory (an empty prompt only loads it) and keep it resident"""
+    try:
+        resp = await http_client.post(
+            f"{OLLAMA_URL}/api/generate",
+            json={"model": OLLAMA_MODEL, "prompt": "", "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE},
+            timeout=OLLAMA_TIMEOUT,
+            extensions={"trace": ollama_stats.trace()}
+        )
+        if resp.status_code == 200:
+            ollama_stats.record_load(resp.json().get("load_duration"))
+            ollama_stats.warmed_up = True
+            print(f"Ollama model {OLLAMA_MODEL} loaded (keep_alive={OLLAMA_KEEP_ALIVE})")
+    except Exception as e:
+        print(f"Ollama warm-up failed: {e}")
+
+
+async def check_ollama_available() -> bool:
+    """Check if Ollama is running and model is available"""
+    try:
+        resp = await http_client.get(f"{OLLAMA_URL}/api/tags", timeout=2,
+                                     extensions={"trace": ollama_stats.trace()})
+        if resp.status_code == 200:
+            models = resp.json().get("models", [])
+            model_names = [m.get("name", "").split(":")[0] for m in models]
+            return OLLAMA_MODEL.split(":")[0] in model_names
+    except Exception:
+        # Silently fail - Ollama not available is a valid state, will fall back to OpenAI or simple search
+        pass
+    return False
+
+
+async def pull_ollama_model():
+    """Pull Ollama model if not available"""
+    try:
+        print(f"Pulling Ollama model: {OLLAMA_MODEL}...")
+        resp = await http_client.post(
+            f"{OLLAMA_URL}/api/pull",
+            json={"name": OLLAMA_MODEL},
+            timeout=300,  # 5 min timeout for download
+            extensions={"trace": ollama_stats.trace()}
+        )
+        return resp.status_code == 200
+    except Exception as e:
+        print(f"Failed to pull model: {e}")
+        return False
+
+
+# ============================================================
+# LLM Functions - Optimized for Speed
+# ============================================================
+
+class LatencyTracker:
+    """Rolling latency samples per (provider, stage) with p50/p95 and outcome counters"""
+    
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.samples: Dict[tuple, deque] = {}
+        self.counters: Dict[tuple, Dict[str, int]] = {}
+    
+    def _counters(self, provider: str, stage: str) -> Dict[str, int]:
+        return self.counters.setdefault((provider, stage), {
+            "ok": 0, "failed": 0, "cancelled": 0, "hedged": 0, "wins": 0, "stopped": 0
+        })
+    
+    def record(self, provider: str, stage: str, latency_ms: float, ok: bool):
+        self._counters(provider, stage)["ok" if ok else "failed"] += 1
+        if ok:
+            self.samples.setdefault((provider, stage), deque(maxlen=self.window)).append(latency_ms)
+    
+    def count(self, provider: str, stage: str, outcome: str):
+        self._counters(provider, stage)[outcome] += 1
+    
+    def percentile(self, provider: str, stage: str, pct: float) -> Optional[float]:
+        values = self.samples.get((provider, stage))
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+    
+    def stats(self) -> Dict:
+        result: Dict[str, Dict] = {}
+        for (provider, stage), counters in self.counters.items():
+            samples = self.samples.get((provider, stage)) or []
+            result.setdefault(provider, {})[stage] = {
+                **counters,
+                "samples": len(samples),
+                "p50Ms": self.percentile(provider, stage, 50),
+                "p95Ms": self.percentile(provider, stage, 95)
+            }
+        return result
+
+
+llm_latency = LatencyTracker()
+llm_deadline_misses: Dict[str, int] = {}
+stage_latency = LatencyTracker()  # Search pipeline stages, recorded under provider "pipeline"
+
+
+def _stage_estimate_ms(stage: str) -> float:
+    """Expected stage latency: live p90 once there are enough samples, else the default"""
+    values = stage_latency.samples.get(("pipeline", stage))
+    if values and len(values) >= 5:
+        return stage_latency.percentile("pipeline", stage, 90)
+    return STAGE_LATENCY_DEFAULTS_MS.get(stage, 0.0)
+
+
+class LatencyBudget:
+    """Remaining time of one request's latency budget (budget_ms <= 0 means unlimited)"""
+    
+    def __init__(self, budget_ms: float, start_time: float):
+        self.budget_ms = budget_ms
+        self.start_time = start_time
+    
+    def remaining_ms(self) -> Optional[float]:
+        if self.budget_ms <= 0:
+            return None
+        return self.budget_ms - (time.time() - self.start_time) * 1000
+    
+    def deadline_ms(self, stage: str, *reserve: str) -> Optional[float]:
+        """Deadline for `stage` that keeps time for the `reserve` stages after it.
+        
+        None means unlimited; 0 means the stage's estimate does not fit and it should be skipped.
+        """
+        remaining = self.remaining_ms()
+        if remaining is None:
+            return None
+        available = remaining - sum(_stage_estimate_ms(s) for s in reserve)
+        return available if available >= _stage_estimate_ms(stage) else 0.0
+
+
+class StageDeadlineExceeded(Exception):
+    """A pipeline stage ran out of its deadline; `fallback` is the degraded result to use instead.
+    
+    The caller lists the stage in skippedStages, so the degraded response is not cached.
+    """
+    
+    def __init__(self, stage: str, fallback: Any = None):
+        super().__init__(f"{stage} deadline exceeded")
+        self.stage = stage
+        self.fallback = fallback
+
+
+def _llm_providers() -> List[str]:
+    """Usable providers, primary first"""
+    providers = [LLM_PROVIDER] if LLM_PROVIDER in ("ollama", "openai") else []
+    if ollama_available and "ollama" not in providers:
+        providers.append("ollama")
+    if openai_client is not None and "openai" not in providers:
+        providers.append("openai")
+    return providers
+
+
+def _hedge_delay_ms(provider: str, stage: str) -> float:
+    """Delay before hedging to the next provider; auto-tuned to the provider's p95"""
+    configured = LLM_HEDGE_DELAY_MS.get(stage, max(LLM_HEDGE_DELAY_MS.values()))
+    if LLM_HEDGE_AUTO:
+        p95 = llm_latency.percentile(provider, stage, 95)
+        if p95 is not None and len(llm_latency.samples[(provider, stage)]) >= 20:
+            return max(LLM_HEDGE_MIN_DELAY_MS, p95)
+    return configured
+
+
+class IncrementalJSONParser:
+    """Incremental scanner for a streamed top-level JSON array or object.
+    
+    feed() takes the next chunk of model output and returns the members it
+    completed: array elements, or (key, value) pairs of an object. Container and
+    string members are returned as soon as they close; numbers at the next
+    delimiter. Text before the opening bracket (e.g. a ```json fence) is skipped,
+    and malformed members are dropped.
+    """
+    
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.kind = None  # "[" or "{" once the top-level value starts
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.start = 0
+        self.emitted = False
+        self.closed = False
+    
+    def feed(self, chunk: str) -> List[Any]:
+        self.buffer += chunk
+        out: List[Any] = []
+        buf = self.buffer
+        i = self.pos
+        while i < len(buf) and not self.closed:
+            c = buf[i]
+            if self.kind is None:
+                if c in '[{':
+                    self.kind, self.depth, self.start = c, 1, i + 1
+            elif self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self._emit(i + 1, out)
+            elif c == '"':
+                self.in_string = True
+            elif c in '[{':
+                self.depth += 1
+            elif c in ']}':
+                self.depth -= 1
+                if self.depth == 1:
+                    self._emit(i + 1, out)
+                elif self.depth == 0:
+                    self._emit(i, out)
+                    self.closed = True
+            elif c == ',' and self.depth == 1:
+                self._emit(i, out)
+                self.start, self.emitted = i + 1, False
+            i += 1
+        self.pos = i
+        return out
+    
+    def _emit(self, end: int, out: List[Any]):
+        if self.emitted:
+            return
+        text = self.buffer[self.start:end].strip()
+        if not text:
+            return
+        try:
+            value = json.loads("{" + text + "}") if self.kind == "{" else json.loads(text)
+        except ValueError:
+            return  # Incomplete (e.g. only an object key so far) or malformed
+        self.emitted = True
+        out.extend(value.items() if self.kind == "{" else [value])
+
+
+def _rerank_item(item: Any) -> Optional[tuple]:
+    """(index, score, reason) from a [i, s] / [i, s, "reason"] or {"i", "s", "r"} rerank item"""
+    if isinstance(item, list) and len(item) >= 2:
+        return item[0], item[1], item[2] if len(item) > 2 else None
+    if isinstance(item, dict):
+        return (item.get('i', item.get('index', -1)),
+                item.get('s', item.get('score', 0)),
+                item.get('r', item.get('reason')))
+    return None
+
+
+def _rerank_stop(top_k: int, min_score: float) -> Callable[[], Callable[[str], bool]]:
+    """Stop factory: generation can end once top_k items scoring >= min_score have streamed"""
+    def make() -> Callable[[str], bool]:
+        parser = IncrementalJSONParser()
+        hits = 0
+        
+        def feed(chunk: str) -> bool:
+            nonlocal hits
+            for item in parser.feed(chunk):
+                parsed = _rerank_item(item)
+                try:
+                    hits += parsed is not None and float(parsed[1]) >= min_score
+                except (TypeError, ValueError):
+                    pass
+            return hits >= top_k
+        return feed
+    return make
+
+
+def _expansion_stop() -> Callable[[str], bool]:
+    """Stop checker: generation can end once "semantic_expansion" has been parsed"""
+    parser = IncrementalJSONParser()
+    return lambda chunk: any(key == "semantic_expansion" for key, _ in parser.feed(chunk))
+
+
+def _llm_deadline_ms(stage: str, deadline_ms: Optional[float] = None) -> float:
+    """Effective deadline of an LLM call: the stage's, tightened by deadline_ms.
+    
+    A tighter deadline_ms is rounded down to LLM_DEADLINE_BUCKET_MS (deadlines
+    shorter than one step are kept as they are), so it never exceeds the caller's.
+    """
+    stage_deadline_ms = LLM_DEADLINE_MS.get(stage, LLM_DEFAULT_DEADLINE_MS)
+    if deadline_ms is None or deadline_ms >= stage_deadline_ms:
+        return stage_deadline_ms
+    if LLM_DEADLINE_BUCKET_MS > 0 and deadline_ms >= LLM_DEADLINE_BUCKET_MS:
+        return deadline_ms // LLM_DEADLINE_BUCKET_MS * LLM_DEADLINE_BUCKET_MS
+    return deadline_ms
+
+
+async def call_llm(prompt: str, max_tokens: int = 500, stage: str = "generic", deadline_ms: Optional[float] = None,
+                   stop: Optional[Callable[[], Callable[[str], bool]]] = None, stop_key: str = "") -> str:
+    """Call LLM, coalescing identical prompts that are already in flight.
+    
+    deadline_ms tightens (never extends) the stage's configured deadline. stop is a
+    factory for a checker that is fed each streamed chunk and returns True once the
+    output so far is enough; generation is then cancelled and the partial text
+    returned. stop_key identifies the stop condition for coalescing.
+    
+    The effective deadline (see _llm_deadline_ms) is part of the coalescing key, so
+    only calls with the same deadline share a provider call, and a caller with more
+    time never inherits the "" of a tighter call that missed.
+    """
+    if not LLM_EARLY_STOP:
+        stop, stop_key = None, ""
+    call_deadline_ms = _llm_deadline_ms(stage, deadline_ms)
+    key = hashlib.sha256(f"{stage}|{max_tokens}|{stop_key}|{call_deadline_ms:g}|{prompt}".encode()).hexdigest()[:32]
+    try:
+        return await llm_flight.do(key, lambda: _call_llm_provider(prompt, max_tokens, stage, call_deadline_ms, stop),
+                                   timeout=call_deadline_ms / 1000)
+    except asyncio.TimeoutError:
+        llm_deadline_misses[stage] = llm_deadline_misses.get(stage, 0) + 1
+        print(f"LLM {stage} deadline exceeded (joined in-flight call)")
+        return ""
+
+
+async def _timed_provider_call(provider: str, prompt: str, max_tokens: int, stage: str,
+                               stop: Optional[Callable[[], Callable[[str], bool]]] = None) -> str:
+    start = time.perf_counter()
+    stopped = False
+    check = stop() if stop is not None else None  # Each provider call streams into its own parser
+    
+    def track_stop(chunk: str) -> bool:
+        nonlocal stopped
+        stopped = stopped or check(chunk)
+        return stopped
+    
+    should_stop = track_stop if check is not None else None
+    try:
+        if provider == "ollama":
+            result = await call_ollama(prompt, max_tokens, should_stop)
+        else:
+            result = await call_openai(prompt, max_tokens, should_stop)
+    except asyncio.CancelledError:
+        llm_latency.count(provider, stage, "cancelled")
+        raise
+    llm_latency.record(provider, stage, (time.perf_counter() - start) * 1000, bool(result))
+    if stopped:
+        llm_latency.count(provider, stage, "stopped")
+    return result
+
+
+async def _call_llm_provider(prompt: str, max_tokens: int = 500, stage: str = "generic",
+                             deadline_ms: Optional[float] = None,
+                             stop: Optional[Callable[[], Callable[[str], bool]]] = None) -> str:
+    """Call LLM - Ollama (preferred for speed) or OpenAI, hedged and deadline-bounded.
+    
+    The primary provider starts immediately. If it has not produced a valid answer
+    within the stage's hedge delay (or fails earlier), the next provider is started
+    as well, and the first non-empty response wins; the loser is cancelled. Nothing
+    is returned after the stage deadline: the caller gets "" and falls back.
+    """
+    providers = _llm_providers()
+    if not providers:
+        return ""
+    
+    loop = asyncio.get_running_loop()
+    stage_deadline_ms = LLM_DEADLINE_MS.get(stage, LLM_DEFAULT_DEADLINE_MS)
+    if deadline_ms is not None:
+        stage_deadline_ms = min(stage_deadline_ms, deadline_ms)
+    deadline = loop.time() + stage_deadline_ms / 1000
+    pending: Dict[asyncio.Task, str] = {}
+    waiting = list(providers)
+    
+    def start_next(hedged: bool):
+        provider = waiting.pop(0)
+        if hedged:
+            llm_latency.count(provider, stage, "hedged")
+        task = asyncio.ensure_future(_timed_provider_call(provider, prompt, max_tokens, stage, stop))
+        pending[task] = provider
+    
+    start_next(hedged=False)
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            
+            # Until a hedge is due, only wait for the hedge delay of the oldest provider
+            timeout = remaining
+            can_hedge = LLM_HEDGE_ENABLED and waiting
+            if can_hedge:
+                oldest = next(iter(pending.values()))
+                timeout = min(remaining, _hedge_delay_ms(oldest, stage) / 1000)
+            
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    print(f"LLM {provider} error: {e}")
+                    result = ""
+                if result:
+                    if len(providers) > 1:
+                        llm_latency.count(provider, stage, "wins")
+                    return result
+            
+            if loop.time() >= deadline:
+                break
+            if waiting and (not pending or (can_hedge and not done)):
+                # Primary failed (fall back) or is slow (hedge)
+                start_next(hedged=bool(pending))
+        
+        if pending or waiting:
+            llm_deadline_misses[stage] = llm_deadline_misses.get(stage, 0) + 1
+            print(f"LLM {stage} deadline exceeded")
+        return ""
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_openai(prompt: str, max_tokens: int = 500, stop: Optional[Callable[[str], bool]] = None) -> str:
+    """Call OpenAI API, streaming; closing the stream early when stop(chunk) returns True"""
+    parts: List[str] = []
+    try:
+        stream = await openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.2,  # Lower = faster, more deterministic
+            max_tokens=max_tokens,
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content or ""
+                parts.append(text)
+                if stop is not None and text and stop(text):
+                    break
+        finally:
+            await stream.close()
+        return "".join(parts).strip()
+    except Exception as e:
+        print(f"OpenAI error: {e}")
+        return ""
+
+
+async def call_ollama(prompt: str, max_tokens: int = 500, stop: Optional[Callable[[str], bool]] = None) -> str:
+    """Call local Ollama model - optimized for speed.
+    
+    Streams the response; when stop(chunk) returns True the connection is closed,
+    which makes Ollama abort the generation.
+    """
+    parts: List[str] = []
+    try:
+        async with http_client.stream(
+            "POST",
+            f"{OLLAMA_URL}/api/generate",
+            json={
+                "model": OLLAMA_MODEL,
+                "prompt": prompt,
+                "stream": True,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                "options": {
+                    "temperature": 0.3,
+                    "num_predict": max_tokens,
+                    "num_ctx": 4096,  # Larger context for detailed prompts
+                    "top_k": 40,
+                    "top_p": 0.9
+                }
+            },
+            timeout=OLLAMA_TIMEOUT,
+            extensions={"trace": ollama_stats.trace()}
+        ) as response:
+            if response.status_code != 200:
+                return ""
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                text = chunk.get("response", "")
+                parts.append(text)
+                if chunk.get("done"):
+                    # Read to the end of the body so the connection goes back to the pool
+                    ollama_stats.record_load(chunk.get("load_duration"))
+                    continue
+                if stop is not None and text and stop(text):
+                    break
+        return "".join(parts).strip()
+    except Exception as e:
+        print(f"Ollama error: {e}")
+    return ""
+
+
+# ============================================================
+# Encoder - runs off the event loop
+# ============================================================
+
+async def encode_texts(texts: List[str]):
+    """Encode texts with the SentenceTransformer in the bounded encoder pool.
+    
+    encoder.encode is CPU-bound and holds the worker for the whole forward pass,
+    so calling it directly from a coroutine would stall every other request.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(encoder_executor, encoder.encode, texts)
+
+
+class Histogram:
+    """Fixed-bucket histogram for tuning knobs like batch size and queue wait"""
+    
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is the overflow bucket
+        self.total = 0
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        """Record one observation"""
+        idx = len(self.buckets)
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                idx = i
+                break
+        self.counts[idx] += 1
+        self.total += 1
+        self.sum += value
+    
+    def stats(self) -> Dict:
+        """Bucket counts keyed by upper bound ("le"), plus count and mean"""
+        buckets = {f"le_{upper:g}": count for upper, count in zip(self.buckets, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.total,
+            "mean": round(self.sum / self.total, 3) if self.total else 0.0,
+            "buckets": buckets
+        }
+
+
+class EncoderBatcher:
+    """Collects concurrent query encodes into one encoder.encode call.
+    
+    The first text to arrive opens a batch window; the batch is flushed when the
+    window elapses or max_batch texts are waiting, whichever comes first. Each
+    caller awaits its own future and receives just its vector.
+    """
+    
+    def __init__(self, window_ms: float = 3.0, max_batch: int = 32):
+        self.window = max(window_ms, 0.0) / 1000
+        self.max_batch = max(max_batch, 1)
+        self._pending: List[tuple] = []  # (text, future, enqueued_at)
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.texts = 0
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.queue_wait_ms = Histogram([0.5, 1, 2, 3, 5, 10, 25, 50, 100])
+    
+    async def encode(self, text: str):
+        """Return the embedding for a single text, batched with concurrent callers"""
+        if self.window == 0:
+            return (await encode_texts([text]))[0]
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future, time.perf_counter()))
+        
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        """Hand everything waiting to the encoder pool as one batch"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, batch: List[tuple]):
+        started = time.perf_counter()
+        for _, _, enqueued_at in batch:
+            self.queue_wait_ms.observe((started - enqueued_at) * 1000)
+        
+        # Identical texts in the same window are encoded once
+        unique_texts = list(dict.fromkeys(text for text, _, _ in batch))
+        self.batches += 1
+        self.texts += len(batch)
+        self.batch_sizes.observe(len(batch))
+        
+        try:
+            vectors = await encode_texts(unique_texts)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        by_text = dict(zip(unique_texts, vectors))
+        for text, future, _ in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+    
+    def stats(self) -> Dict:
+        """Batching statistics for tuning the window"""
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "texts": self.texts,
+            "avg_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "batch_size": self.batch_sizes.stats(),
+            "queue_wait_ms": self.queue_wait_ms.stats()
+        }
+
+
+encoder_batcher = EncoderBatcher(window_ms=ENCODER_BATCH_WINDOW_MS, max_batch=ENCODER_MAX_BATCH)
+
+
+async def embed_texts(texts: List[str]) -> List[np.ndarray]:
+    """Embeddings for several texts: embedding-cache hits plus one encoder call for the rest"""
+    vectors: Dict[str, Any] = {}
+    for text in texts:
+        if text not in vectors:
+            vectors[text] = embedding_cache.get(text) if embedding_cache is not None else None
+    
+    missing = [text for text, vector in vectors.items() if vector is None]
+    if missing:
+        for text, vector in zip(missing, await encode_texts(missing)):
+            vectors[text] = vector
+            if embedding_cache is not None:
+                embedding_cache.set(text, vector)
+    return [vectors[text] for text in texts]
+
+
+async def embed_query(search_text: str):
+    """Embedding for the final search text, served from the embedding cache when possible"""
+    vector = embedding_cache.get(search_text) if embedding_cache is not None else None
+    if vector is None:
+        vector = await encoder_batcher.encode(search_text)
+        if embedding_cache is not None:
+            embedding_cache.set(search_text, vector)
+    return vector
+
+
+# ============================================================
+# Local vector search over a memory-mapped catalog snapshot
+# ============================================================
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def _spherical_kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> tuple:
+    """(centroids, assignment) for L2-normalized vectors, clustering by cosine similarity"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(k):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = _normalize_rows(members.mean(axis=0))
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+class LocalVectorIndex:
+    """Brute-force cosine search over a snapshot of the collection, memory-mapped from disk.
+    
+    A snapshot directory holds vectors.npy (float32, L2-normalized rows), price.npy
+    (float32, NaN when missing), product_type.npy (code into meta "productTypes",
+    -1 when missing), recipients.npy and aesthetics.npy (bool, one column per entry
+    of the same-named meta vocabulary), payloads.jsonl and meta.json (point ids, vocabularies). With IVF it also holds
+    centroids.npy and the rows of each cluster (ivf_rows.npy / ivf_offsets.npy), and
+    a search only scores the clusters nearest to the query.
+    
+    Filters are boolean masks over these arrays and mirror _build_query_filter:
+    price range (points without a price never match one) and any-of matches on
+    product_type, recipients and aesthetics. Qdrant stays the
+    source of truth: snapshots are re-exported from it on a schedule.
+    """
+    
+    LIST_FIELDS = ("recipients", "aesthetics")
+    
+    def __init__(self, path: str, ivf_probe: int = 8):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.path = path
+        self.ids: List[str] = meta["ids"]
+        self.product_types: List[str] = meta["productTypes"]
+        self.created_at = meta.get("createdAt", 0)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.price = np.load(os.path.join(path, "price.npy"), mmap_mode="r")
+        self.type_codes = np.load(os.path.join(path, "product_type.npy"), mmap_mode="r")
+        # field -> (vocabulary, bool matrix); snapshots without a field match nothing on it
+        self.list_fields: Dict[str, tuple] = {}
+        for field in self.LIST_FIELDS:
+            if field in meta:
+                self.list_fields[field] = (meta[field], np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r"))
+            else:
+                self.list_fields[field] = ([], np.zeros((len(self.ids), 0), dtype=bool))
+        with open(os.path.join(path, "payloads.jsonl"), encoding="utf-8") as f:
+            self.payloads = [json.loads(line) for line in f]
+        
+        self.ivf_probe = ivf_probe
+        self.centroids = None
+        if os.path.exists(os.path.join(path, "centroids.npy")):
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self.ivf_rows = np.load(os.path.join(path, "ivf_rows.npy"), mmap_mode="r")
+            self.ivf_offsets = np.load(os.path.join(path, "ivf_offsets.npy"))
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    @staticmethod
+    def write_snapshot(path: str, ids: List[str], vectors: np.ndarray, payloads: List[Dict], ivf_lists: int = 0):
+        """Write a snapshot directory (blocking; vectors are normalized here)"""
+        os.makedirs(path, exist_ok=True)
+        vectors = _normalize_rows(np.asarray(vectors, dtype=np.float32)).astype(np.float32)
+        
+        product_types = sorted({p.get('product_type') for p in payloads if p.get('product_type')})
+        type_index = {t: i for i, t in enumerate(product_types)}
+        meta = {"ids": ids, "productTypes": product_types}
+        
+        for field in LocalVectorIndex.LIST_FIELDS:
+            names = sorted({v for p in payloads for v in (p.get(field) or [])})
+            index = {v: i for i, v in enumerate(names)}
+            matrix = np.zeros((len(payloads), len(names)), dtype=bool)
+            for row, p in enumerate(payloads):
+                for v in p.get(field) or []:
+                    matrix[row, index[v]] = True
+            np.save(os.path.join(path, f"{field}.npy"), matrix)
+            meta[field] = names
+        
+        np.save(os.path.join(path, "vectors.npy"), vectors)
+        np.save(os.path.join(path, "price.npy"), np.array(
+            [_safe_float(p.get('price'), np.nan) for p in payloads], dtype=np.float32))
+        np.save(os.path.join(path, "product_type.npy"), np.array(
+            [type_index.get(p.get('product_type'), -1) for p in payloads], dtype=np.int32))
+        with open(os.path.join(path, "payloads.jsonl"), "w", encoding="utf-8") as f:
+            for p in payloads:
+                f.write(json.dumps(p, default=_json_default) + "\n")
+        
+        if ivf_lists and len(vectors) > ivf_lists:
+            centroids, assignment = _spherical_kmeans(vectors, ivf_lists)
+            np.save(os.path.join(path, "centroids.npy"), centroids.astype(np.float32))
+            np.save(os.path.join(path, "ivf_rows.npy"), np.argsort(assignment, kind="stable").astype(np.int64))
+            np.save(os.path.join(path, "ivf_offsets.npy"), np.concatenate(
+                [[0], np.cumsum(np.bincount(assignment, minlength=ivf_lists))]).astype(np.int64))
+        
+        # meta.json last: a snapshot without it is incomplete and never loaded
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({**meta, "createdAt": time.time()}, f)
+    
+    def _probe_rows(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """Rows of the clusters nearest to the query (None = exhaustive search)"""
+        if self.centroids is None:
+            return None
+        nearest = np.argsort(-(self.centroids @ query))[:self.ivf_probe]
+        return np.concatenate([self.ivf_rows[self.ivf_offsets[c]:self.ivf_offsets[c + 1]] for c in nearest])
+    
+    def _mask(self, rows: Optional[np.ndarray], price_min: Optional[float], price_max: Optional[float],
+              intent: Dict[str, List[str]]) -> Optional[np.ndarray]:
+        """Boolean mask over `rows` (or all rows) for the filters; None when there are none"""
+        mask = None
+        
+        def combine(condition: np.ndarray):
+            nonlocal mask
+            mask = condition if mask is None else mask & condition
+        
+        if price_min is not None or price_max is not None:
+            price = self.price if rows is None else self.price[rows]
+            combine((price >= (price_min or 0)) & (price <= (price_max or 1000000)))
+        if intent.get('product_type'):
+            codes = [self.product_types.index(t) for t in intent['product_type'] if t in self.product_types]
+            type_codes = self.type_codes if rows is None else self.type_codes[rows]
+            combine(np.isin(type_codes, codes))
+        for field, (names, matrix) in self.list_fields.items():
+            if intent.get(field):
+                columns = [names.index(v) for v in intent[field] if v in names]
+                matrix = matrix if rows is None else matrix[rows]
+                combine(matrix[:, columns].any(axis=1) if columns else np.zeros(len(matrix), dtype=bool))
+        return mask
+    
+    def search(self, vector, limit: int, price_min: Optional[float] = None, price_max: Optional[float] = None,
+               intent: Optional[Dict[str, List[str]]] = None) -> List[Dict]:
+        """Top `limit` candidates ({product, score, id}) by cosine similarity among rows passing the filters.
+        
+        intent maps product_type / recipients / aesthetics to accepted payload values.
+        """
+        query = _normalize_rows(np.asarray(vector, dtype=np.float32))
+        rows = self._probe_rows(query)
+        scores = (self.vectors if rows is None else self.vectors[rows]) @ query
+        
+        mask = self._mask(rows, price_min, price_max, intent or {})
+        positions = np.flatnonzero(mask) if mask is not None else np.arange(len(scores))
+        if positions.size > limit:
+            positions = positions[np.argpartition(-scores[positions], limit - 1)[:limit]]
+        positions = positions[np.argsort(-scores[positions], kind="stable")]
+        
+        result = []
+        for pos in positions:
+            row = int(pos if rows is None else rows[pos])
+            result.append({'product': self.payloads[row], 'score': float(scores[pos]), 'id': self.ids[row]})
+        return result
+    
+    def stats(self) -> Dict:
+        return {
+            "products": len(self.ids),
+            "ivfLists": len(self.centroids) if self.centroids is not None else 0,
+            "ivfProbe": self.ivf_probe if self.centroids is not None else None,
+            "ageSeconds": round(time.time() - self.created_at, 1),
+            "path": self.path
+        }
+
+
+def _load_local_index() -> Optional[LocalVectorIndex]:
+    """Open the snapshot named in LOCAL_INDEX_DIR/CURRENT, if there is one"""
+    try:
+        with open(os.path.join(LOCAL_INDEX_DIR, "CURRENT"), encoding="utf-8") as f:
+            name = f.read().strip()
+        return LocalVectorIndex(os.path.join(LOCAL_INDEX_DIR, name), LOCAL_INDEX_IVF_PROBE)
+    except FileNotFoundError:
+        return None
+
+
+async def refresh_local_index():
+    """Export the collection into a new snapshot and swap it in.
+    
+    The snapshot is written to its own directory; CURRENT is replaced atomically
+    once it is complete, and older snapshots are removed.
+    """
+    global local_index
+    ids, vectors, payloads = [], [], []
+    async for point in _scroll_collection(page_size=512, with_vectors=True):
+        vector = point.vector
+        if isinstance(vector, dict):  # Named vectors: use the first one
+            vector = next(iter(vector.values()))
+        ids.append(str(point.id))
+        vectors.append(vector)
+        payloads.append(point.payload or {})
+    if not ids:
+        return
+    
+    name = f"snapshot-{int(time.time() * 1000)}"
+    path = os.path.join(LOCAL_INDEX_DIR, name)
+    await asyncio.to_thread(LocalVectorIndex.write_snapshot, path, ids, np.asarray(vectors, dtype=np.float32),
+                            payloads, LOCAL_INDEX_IVF_LISTS)
+    
+    current = os.path.join(LOCAL_INDEX_DIR, "CURRENT")
+    with open(current + ".tmp", "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(current + ".tmp", current)
+    local_index = LocalVectorIndex(path, LOCAL_INDEX_IVF_PROBE)
+    print(f"Local index: {len(local_index)} products" +
+          (f", IVF {LOCAL_INDEX_IVF_LISTS} lists" if local_index.centroids is not None else ""))
+    
+    for entry in os.listdir(LOCAL_INDEX_DIR):
+        if entry.startswith("snapshot-") and entry != name:
+            shutil.rmtree(os.path.join(LOCAL_INDEX_DIR, entry), ignore_errors=True)
+
+
+async def _local_index_refresher():
+    """Re-export the local index now and then every LOCAL_INDEX_REFRESH_INTERVAL seconds"""
+    while True:
+        try:
+            await refresh_local_index()
+        except Exception as e:
+            print(f"Local index refresh failed: {e}")
+        await asyncio.sleep(LOCAL_INDEX_REFRESH_INTERVAL)
 
 
 # ============================================================
-# Ollama Helper Functions
+# Lexical search - BM25 over title, tags, product type and headline
 # ============================================================
 
-def check_ollama_available() -> bool:
-    """Check if Ollama is running and model is available"""
-    try:
-        resp = requests.get(f"{OLLAMA_URL}/api/tags", timeout=2)
-        if resp.status_code == 200:
-            models = resp.json().get("models", [])
-            model_names = [m.get("name", "").split(":")[0] for m in models]
-            return OLLAMA_MODEL.split(":")[0] in model_names
-    except Exception:
-        # Silently fail - Ollama not available is a valid state, will fall back to OpenAI or simple search
-        pass
-    return False
+# Query words that carry no product meaning for keyword matching
+_LEXICAL_STOPWORDS = {
+    'a', 'an', 'the', 'for', 'of', 'and', 'or', 'with', 'to', 'in', 'on', 'at', 'by', 'from',
+    'my', 'me', 'i', 'her', 'him', 'his', 'their', 'who', 'that', 'some', 'any', 'best', 'good', 'nice'
+}
 
+# Gifting words that match many products but never say which one; a query made of
+# them needs the LLM stages even when the catalog happens to match every term
+_LEXICAL_GENERIC_TERMS = {
+    'gift', 'present', 'idea', 'birthday', 'anniversary', 'occasion', 'special', 'cool', 'cute', 'unique',
+    'men', 'man', 'women', 'woman', 'guy', 'girl', 'boy', 'kid', 'everyone'
+}
 
-def pull_ollama_model():
-    """Pull Ollama model if not available"""
-    try:
-        print(f"Pulling Ollama model: {OLLAMA_MODEL}...")
-        resp = requests.post(
-            f"{OLLAMA_URL}/api/pull",
-            json={"name": OLLAMA_MODEL},
-            timeout=300  # 5 min timeout for download
-        )
-        return resp.status_code == 200
-    except Exception as e:
-        print(f"Failed to pull model: {e}")
-        return False
 
+def _payload_text(value) -> str:
+    if isinstance(value, list):
+        return ' '.join(str(v) for v in value)
+    return str(value or '')
 
-# ============================================================
-# LLM Functions - Optimized for Speed
-# ============================================================
 
-def call_llm(prompt: str, max_tokens: int = 500) -> str:
-    """Call LLM - Ollama (preferred for speed) or OpenAI"""
-    if LLM_PROVIDER == "ollama":
-        result = call_ollama(prompt, max_tokens)
-        if result:
-            return result
-        # Fallback to OpenAI if Ollama fails
-        if OPENAI_API_KEY:
-            return call_openai(prompt, max_tokens)
-    elif LLM_PROVIDER == "openai":
-        return call_openai(prompt, max_tokens)
-    return ""
+class BM25Index:
+    """Inverted index over product title, tags, product type and headline, scored with BM25.
+    
+    Terms are normalized like canonical query text (lowercase, t-shirt -> tshirt,
+    singular nouns). Fields are weighted into one term frequency (BM25F-style), and
+    the per-posting BM25 weights are precomputed, so a query is a few scatter-adds.
+    Term IDFs and brand terms are kept for the specificity check of strong matches.
+    Per-value document masks of the intent fields (product_type, recipients,
+    aesthetics) filter candidates like _build_query_filter does for Qdrant.
+    """
+    
+    FIELD_WEIGHTS = {'title': 3.0, 'product_type': 3.0, 'brand': 2.0, 'tags': 2.0, 'headline': 1.0}
+    INTENT_FIELDS = ("product_type", "recipients", "aesthetics")
+    
+    def __init__(self, ids: List[str], payloads: List[Dict], k1: float = 1.2, b: float = 0.75):
+        self.ids = ids
+        self.payloads = payloads
+        self.price = np.array([_safe_float(p.get('price'), np.nan) for p in payloads], dtype=np.float32)
+        
+        # field -> payload value -> bool mask over documents
+        self.intent_masks: Dict[str, Dict[str, np.ndarray]] = {field: {} for field in self.INTENT_FIELDS}
+        for doc, p in enumerate(payloads):
+            for field in self.INTENT_FIELDS:
+                values = p.get(field)
+                for value in (values if isinstance(values, list) else [values] if values else []):
+                    masks = self.intent_masks[field]
+                    if value not in masks:
+                        masks[value] = np.zeros(len(payloads), dtype=bool)
+                    masks[value][doc] = True
+        
+        term_freqs: Dict[str, Dict[int, float]] = {}
+        doc_len = np.zeros(len(payloads), dtype=np.float32)
+        self.brand_terms = set()
+        for doc, p in enumerate(payloads):
+            fields = {
+                'title': p.get('title') or p.get('name'),
+                'product_type': p.get('product_type'),
+                'brand': p.get('brand'),
+                'tags': p.get('tags') or p.get('auto_tags'),
+                'headline': p.get('headline'),
+            }
+            for field, value in fields.items():
+                weight = self.FIELD_WEIGHTS[field]
+                for term in _normalize_text(_payload_text(value)).split():
+                    postings = term_freqs.setdefault(term, {})
+                    postings[doc] = postings.get(doc, 0.0) + weight
+                    doc_len[doc] += weight
+                    if field == 'brand':
+                        self.brand_terms.add(term)
+        
+        avg_len = float(doc_len.mean()) if len(payloads) else 1.0
+        norm = k1 * (1 - b + b * doc_len / max(avg_len, 1e-6))
+        n = len(payloads)
+        self.postings: Dict[str, tuple] = {}
+        self.idf: Dict[str, float] = {}
+        for term, postings in term_freqs.items():
+            docs = np.fromiter(postings.keys(), dtype=np.int32, count=len(postings))
+            tf = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            self.idf[term] = float(idf)
+            self.postings[term] = (docs, (idf * tf * (k1 + 1) / (tf + norm[docs])).astype(np.float32))
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def is_specific(self, term: str, min_idf: float) -> bool:
+        """A brand name, or a term rare enough in the catalog to pick out a product"""
+        return term in self.brand_terms or self.idf.get(term, 0.0) >= min_idf
+    
+    @staticmethod
+    def query_terms(text: str) -> List[str]:
+        """Distinct non-stopword terms of canonical query text"""
+        return [t for t in dict.fromkeys(text.split()) if t not in _LEXICAL_STOPWORDS]
+    
+    def _intent_mask(self, intent: Dict[str, List[str]]) -> Optional[np.ndarray]:
+        """Documents matching any of the values of every intent field; None when there is no intent"""
+        mask = None
+        for field, values in intent.items():
+            masks = [self.intent_masks.get(field, {}).get(v) for v in values]
+            field_mask = np.zeros(len(self.ids), dtype=bool)
+            for m in masks:
+                if m is not None:
+                    field_mask |= m
+            mask = field_mask if mask is None else mask & field_mask
+        return mask
+    
+    def search(self, text: str, limit: int, price_min: Optional[float] = None,
+               price_max: Optional[float] = None, intent: Optional[Dict[str, List[str]]] = None,
+               min_results: int = 0) -> tuple:
+        """(top `limit` candidates by BM25, ids of every product matching all query terms).
+        
+        `text` is canonical query text. Candidate scores are BM25 divided by the best
+        score, so they stay in [0, 1] like similarity scores. Price ranges follow the
+        Qdrant filter (products without a price never match one). The intent is
+        relaxed exactly like _search_vector: while fewer than min_results match,
+        fields are dropped (_relaxed_intents) and the looser matches fill the rest
+        after the stricter ones. Full matches are limited to the levels used.
+        """
+        terms = self.query_terms(text)
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        matched = np.zeros(len(self.ids), dtype=np.int16)
+        for term in terms:
+            if term in self.postings:
+                docs, weights = self.postings[term]
+                scores[docs] += weights
+                matched[docs] += 1
+        
+        base = scores > 0
+        if price_min is not None or price_max is not None:
+            base &= (self.price >= (price_min or 0)) & (self.price <= (price_max or 1000000))
+        
+        selected = np.zeros(0, dtype=np.int64)
+        used = np.zeros(len(self.ids), dtype=bool)  # Documents admitted by the levels searched so far
+        for n, level in enumerate(_relaxed_intents(intent or {})):
+            if n and (selected.size >= min_results or selected.size >= limit):
+                break
+            intent_mask = self._intent_mask(level)
+            level_mask = base if intent_mask is None else base & intent_mask
+            positions = np.flatnonzero(level_mask & ~used)
+            used |= level_mask
+            take = limit - selected.size
+            if positions.size > take:
+                positions = positions[np.argpartition(-scores[positions], take - 1)[:take]]
+            selected = np.concatenate([selected, positions[np.argsort(-scores[positions], kind="stable")]])
+        
+        best = float(scores[selected].max()) if selected.size else 1.0
+        candidates = [
+            {'product': self.payloads[pos], 'score': float(scores[pos]) / best, 'id': self.ids[pos]}
+            for pos in selected
+        ]
+        full_matches = {self.ids[pos] for pos in np.flatnonzero(used & (matched == len(terms)))} if terms else set()
+        return candidates, full_matches
+    
+    def stats(self) -> Dict:
+        return {"products": len(self.ids), "terms": len(self.postings)}
 
 
-def call_openai(prompt: str, max_tokens: int = 500) -> str:
-    """Call OpenAI API"""
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,  # Lower = faster, more deterministic
-            max_tokens=max_tokens
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"OpenAI error: {e}")
-        return ""
+async def refresh_lexical_index():
+    """Build the BM25 index from the local snapshot if one is loaded, else from a collection scan"""
+    global lexical_index
+    if local_index is not None:
+        ids, payloads = local_index.ids, local_index.payloads
+    else:
+        ids, payloads = [], []
+        async for point in _scroll_collection(page_size=1024):
+            ids.append(str(point.id))
+            payloads.append(point.payload or {})
+    lexical_index = await asyncio.to_thread(BM25Index, ids, payloads, BM25_K1, BM25_B)
+    print(f"Lexical index: {len(lexical_index)} products, {len(lexical_index.postings)} terms")
 
 
-def call_ollama(prompt: str, max_tokens: int = 500) -> str:
-    """Call local Ollama model - optimized for speed"""
-    try:
-        response = requests.post(
-            f"{OLLAMA_URL}/api/generate",
-            json={
-                "model": OLLAMA_MODEL,
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.3,
-                    "num_predict": max_tokens,
-                    "num_ctx": 4096,  # Larger context for detailed prompts
-                    "top_k": 40,
-                    "top_p": 0.9
-                }
-            },
-            timeout=60  # 60 second timeout for complex prompts
-        )
-        if response.status_code == 200:
-            return response.json().get("response", "").strip()
-    except Exception as e:
-        print(f"Ollama error: {e}")
-    return ""
+async def _lexical_index_refresher():
+    """Rebuild the lexical index now and then every LEXICAL_INDEX_REFRESH_INTERVAL seconds"""
+    while True:
+        try:
+            await refresh_lexical_index()
+        except Exception as e:
+            print(f"Lexical index refresh failed: {e}")
+        await asyncio.sleep(LEXICAL_INDEX_REFRESH_INTERVAL)
+
+
+def _specific_term(term: str) -> bool:
+    """A query term that names a product: a product type or brand, or a rare catalog term.
+    
+    Gifting words and recipients never count, however the catalog is tagged.
+    """
+    if term in _LEXICAL_GENERIC_TERMS or recipient_matcher.match(term):
+        return False
+    return term in product_type_matcher.tokens or lexical_index.is_specific(term, LEXICAL_STRONG_MIN_IDF)
+
+
+def _strong_lexical_match(terms: List[str], full_matches: set, limit: int) -> bool:
+    """A short, specific keyword query that at least `limit` products match on every term"""
+    return bool(LEXICAL_SKIP_LLM and terms and len(terms) <= LEXICAL_STRONG_MAX_TERMS
+                and len(full_matches) >= limit and all(_specific_term(t) for t in terms))
 
 
 # ============================================================
 # OPTIMIZED Prompts - Shorter = Faster
 # ============================================================
 
-def expand_query(user_query: str) -> Dict[str, Any]:
+def _expansion_signature(cache_text: str) -> tuple:
+    """Intents two queries must share to reuse one expansion: product types, recipients
+    and aesthetics. Prices are not part of it: expansions are generated from the
+    price-stripped query and the price range is applied as a search filter."""
+    intent = detect_query_intent(cache_text)
+    # Canonical types rather than payload values, so types the catalog lacks still tell queries apart
+    intent['product_type'] = product_type_matcher.match(cache_text)
+    return tuple(sorted((field, tuple(sorted(values))) for field, values in intent.items() if values))
+
+
+async def expand_query(user_query: str, cache_text: Optional[str] = None, deadline_ms: Optional[float] = None) -> Dict[str, Any]:
     """
     Use LLM to expand query - matches algorithm from src/search.py.
-    Uses cache to avoid repeated LLM calls.
+    Uses cache to avoid repeated LLM calls, keyed on the canonical query text.
+    
+    deadline_ms bounds the LLM call; 0 means cache only, returning None on a miss.
     """
+    if cache_text is None:
+        cache_text = canonicalize_query(user_query)["text"]
+    
     # Check cache first
-    cached = query_expansion_cache.get(user_query, 1)
+    cached = await query_expansion_cache.get_async(cache_text, 1)
     if cached:
         return cached
     
+    # Then look for an already-expanded query that means the same thing
+    query_vector = None
+    signature = None
+    if semantic_expansion_cache is not None:
+        query_vector = await embed_query(user_query)
+        signature = _expansion_signature(cache_text)
+        match = semantic_expansion_cache.lookup(query_vector, signature)
+        if match:
+            expansion, similarity, matched_query = match
+            print(f"Semantic cache hit: '{user_query}' ~ '{matched_query}' ({similarity:.3f})")
+            query_expansion_cache.set(cache_text, 1, expansion)
+            return expansion
+    
+    if deadline_ms is not None and deadline_ms <= 0:
+        return None
+    
     # Full prompt matching src/search.py with examples
     prompt = f"""You are an e-commerce search expert. Your job is to understand what users are REALLY looking for when they search.
 
@@ -314,39 +2323,39 @@ Analyze this query deeply and return a JSON object that helps find the right pro
 
 Your JSON must have these fields:
 
-1. "search_intent": One sentence describing what the user actually wants
-2. "product_categories": List of product types/categories that would satisfy this (be specific, 5-10 items)
-3. "key_attributes": Important product qualities/features the user cares about (e.g., style, use case, quality level)
-4. "context_clues": Any implicit context (occasion, recipient, urgency, price sensitivity, etc.)
-5. "semantic_expansion": A rich 40-60 word text that represents this search intent, written to match against product descriptions (include synonyms, related terms, use cases)
+1. "semantic_expansion": A rich 40-60 word text that represents this search intent, written to match against product descriptions (include synonyms, related terms, use cases)
+2. "search_intent": One sentence describing what the user actually wants
+3. "product_categories": List of product types/categories that would satisfy this (be specific, 5-10 items)
+4. "key_attributes": Important product qualities/features the user cares about (e.g., style, use case, quality level)
+5. "context_clues": Any implicit context (occasion, recipient, urgency, price sensitivity, etc.)
 
 Examples to guide you:
 
 Query: "gifts for my girlfriend"
 {{
+  "semantic_expansion": "romantic elegant jewelry beautiful necklace bracelet ring feminine accessories thoughtful gift girlfriend partner love special occasion anniversary birthday present beautiful fragrance beauty products stylish handbag fashion items personal care premium quality giftable",
   "search_intent": "User wants to buy a thoughtful, romantic gift for their romantic partner",
   "product_categories": ["jewelry", "necklaces", "bracelets", "rings", "accessories", "beauty products", "fragrances", "handbags", "fashion items", "personal care"],
   "key_attributes": ["romantic", "elegant", "feminine", "thoughtful", "beautiful", "high-quality", "giftable", "special"],
-  "context_clues": "Romantic relationship, wants to impress, likely birthday or anniversary or spontaneous gesture, willing to spend reasonably, needs gift packaging",
-  "semantic_expansion": "romantic elegant jewelry beautiful necklace bracelet ring feminine accessories thoughtful gift girlfriend partner love special occasion anniversary birthday present beautiful fragrance beauty products stylish handbag fashion items personal care premium quality giftable"
+  "context_clues": "Romantic relationship, wants to impress, likely birthday or anniversary or spontaneous gesture, willing to spend reasonably, needs gift packaging"
 }}
 
 Query: "workout equipment for home"
 {{
+  "semantic_expansion": "home workout equipment fitness gear exercise dumbbells weights resistance bands yoga mat gym equipment training accessories compact space-saving durable quality functional versatile strength training cardio home gym setup",
   "search_intent": "User wants to set up home gym or fitness area",
   "product_categories": ["dumbbells", "resistance bands", "yoga mats", "fitness equipment", "weights", "exercise gear", "workout accessories", "home gym equipment"],
   "key_attributes": ["durable", "compact", "effective", "versatile", "quality", "space-saving", "functional"],
-  "context_clues": "Work from home or limited gym access, wants convenience, likely beginner to intermediate, needs space-efficient solutions",
-  "semantic_expansion": "home workout equipment fitness gear exercise dumbbells weights resistance bands yoga mat gym equipment training accessories compact space-saving durable quality functional versatile strength training cardio home gym setup"
+  "context_clues": "Work from home or limited gym access, wants convenience, likely beginner to intermediate, needs space-efficient solutions"
 }}
 
 Query: "minimalist desk accessories"
 {{
+  "semantic_expansion": "minimalist desk accessories office simple clean design modern workspace organizer aesthetic functional stationery pen holder cable management sleek desk lamp organization tools workspace decor contemporary style productivity clutter-free",
   "search_intent": "User wants clean, simple desk items with aesthetic appeal",
   "product_categories": ["desk organizers", "pen holders", "cable management", "desk lamps", "stationery", "office accessories", "desk decor", "workspace items"],
   "key_attributes": ["minimalist", "clean design", "functional", "aesthetic", "simple", "organized", "modern", "sleek"],
-  "context_clues": "Values aesthetics and organization, likely remote worker or student, prefers quality over quantity, willing to pay for good design",
-  "semantic_expansion": "minimalist desk accessories office simple clean design modern workspace organizer aesthetic functional stationery pen holder cable management sleek desk lamp organization tools workspace decor contemporary style productivity clutter-free"
+  "context_clues": "Values aesthetics and organization, likely remote worker or student, prefers quality over quantity, willing to pay for good design"
 }}
 
 Now analyze: "{user_query}"
@@ -354,26 +2363,33 @@ Now analyze: "{user_query}"
 Return ONLY valid JSON, no other text."""
 
     try:
-        response = call_llm(prompt, max_tokens=400)
+        llm_start = time.time()
+        response = await call_llm(prompt, max_tokens=400, stage="expansion", deadline_ms=deadline_ms,
+                                  stop=_expansion_stop, stop_key="semantic_expansion")
+        stage_latency.record("pipeline", "expansion", (time.time() - llm_start) * 1000, bool(response))
         if not response:
             raise ValueError("Empty response")
         
-        # Clean markdown
-        text = response.replace('```json', '').replace('```', '').strip()
-        # Find JSON in response
-        start = text.find('{')
-        end = text.rfind('}') + 1
-        if start >= 0 and end > start:
-            text = text[start:end]
-        
-        # Fix common JSON issues
-        # Fix trailing commas
-        text = re.sub(r',\s*}', '}', text)
-        text = re.sub(r',\s*]', ']', text)
-        # Fix missing quotes around keys
-        text = re.sub(r'(\{|\,)\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', text)
+        # Members parsed so far; generation may have stopped right after semantic_expansion
+        expanded = dict(IncrementalJSONParser().feed(response))
         
-        expanded = json.loads(text)
+        if not expanded:
+            # Clean markdown
+            text = response.replace('```json', '').replace('```', '').strip()
+            # Find JSON in response
+            start = text.find('{')
+            end = text.rfind('}') + 1
+            if start >= 0 and end > start:
+                text = text[start:end]
+            
+            # Fix common JSON issues
+            # Fix trailing commas
+            text = re.sub(r',\s*}', '}', text)
+            text = re.sub(r',\s*]', ']', text)
+            # Fix missing quotes around keys
+            text = re.sub(r'(\{|\,)\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', text)
+            
+            expanded = json.loads(text)
         
         # Normalize field names
         result = {
@@ -385,7 +2401,9 @@ Return ONLY valid JSON, no other text."""
         }
         
         # Cache the result
-        query_expansion_cache.set(user_query, 1, result)
+        query_expansion_cache.set(cache_text, 1, result)
+        if query_vector is not None:
+            semantic_expansion_cache.add(user_query, query_vector, result, signature)
         
         return result
         
@@ -400,126 +2418,303 @@ Return ONLY valid JSON, no other text."""
         }
 
 
-def rerank_with_llm(user_query: str, expanded_context: Dict, candidates: List[Dict], top_k: int = 10) -> List[Dict]:
+def _batch_expansion_key(cache_text: str) -> str:
+    """Expansion-cache text for the short expansions of expand_queries_batch"""
+    return f"batch:{cache_text}"
+
+
+async def expand_queries_batch(queries: List[str], cache_texts: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Expand several queries with as few LLM calls as possible.
+    
+    Cached expansions are reused; the rest are packed EXPANSION_BATCH_SIZE to a
+    prompt that asks only for a short semantic_expansion per query, and the
+    chunks run concurrently. Queries whose expansion fails fall back to the
+    query itself (not cached).
+    
+    Short expansions are cached under their own key (_batch_expansion_key), so
+    expand_query never mistakes one for a full expansion; batches prefer a full
+    expansion when one is cached.
+    """
+    if cache_texts is None:
+        cache_texts = [canonicalize_query(q)["text"] for q in queries]
+    
+    async def cached(text: str) -> Optional[Dict[str, Any]]:
+        return (await query_expansion_cache.get_async(text, 1)
+                or await query_expansion_cache.get_async(_batch_expansion_key(text), 1))
+    
+    results: List[Optional[Dict[str, Any]]] = list(await asyncio.gather(*(cached(text) for text in cache_texts)))
+    pending = [i for i, result in enumerate(results) if result is None]
+    
+    async def expand_chunk(indices: List[int]):
+        numbered = "\n".join(f'{n}: "{queries[i]}"' for n, i in enumerate(indices))
+        prompt = f"""You are an e-commerce search expert. For each numbered search query below, write a rich 20-40 word text that represents what the user is REALLY looking for, written to match against product descriptions (include synonyms, related terms, use cases).
+
+Queries:
+{numbered}
+
+Return a JSON array with one string per query, in the same order.
+
+JSON only:"""
+        response = await call_llm(prompt, max_tokens=70 * len(indices) + 20, stage="expansion")
+        expansions = [e for e in IncrementalJSONParser().feed(response) if isinstance(e, str)] if response else []
+        if len(expansions) != len(indices):
+            print(f"Batch expansion returned {len(expansions)}/{len(indices)} expansions")
+        for n, i in enumerate(indices):
+            if n < len(expansions) and expansions[n].strip():
+                results[i] = {
+                    "search_intent": f"Find products related to: {queries[i]}",
+                    "product_categories": [],
+                    "key_attributes": [],
+                    "context_clues": "",
+                    "semantic_expansion": expansions[n].strip()
+                }
+                query_expansion_cache.set(_batch_expansion_key(cache_texts[i]), 1, results[i])
+    
+    # Identical canonical queries share one slot in the prompt
+    first_index: Dict[str, int] = {}
+    unique = [i for i in pending if first_index.setdefault(cache_texts[i], i) == i]
+    chunks = [unique[j:j + EXPANSION_BATCH_SIZE] for j in range(0, len(unique), EXPANSION_BATCH_SIZE)]
+    if chunks:
+        await asyncio.gather(*(expand_chunk(chunk) for chunk in chunks))
+    
+    for i in pending:
+        results[i] = results[first_index[cache_texts[i]]] or {
+            "search_intent": f"Find products related to: {queries[i]}",
+            "product_categories": [queries[i]],
+            "key_attributes": [],
+            "context_clues": "General search",
+            "semantic_expansion": queries[i]
+        }
+    return results
+
+
+def _product_llm_repr(p: Dict) -> str:
+    """Compact one-line product description for rerank prompts: name | desc | tags.
+    
+    Handles both toastd-final schema (name, short_description) and
+    products schema (title, description).
+    """
+    name = (p.get('title') or p.get('name', '') or '')[:80]
+    desc = (p.get('description') or p.get('short_description', '') or '')[:100]
+    tags = (p.get('tags', '') or '')
+    if isinstance(tags, list):
+        tags = ', '.join(tags[:5])
+    tags = tags[:50]
+    return ' | '.join(' '.join(str(part).split()) for part in (name, desc, tags) if part)
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+def _candidate_llm_repr(candidate: Dict) -> str:
+    """Precomputed representation of a candidate, built and stored on first sight if missing"""
+    repr_line = product_llm_reprs.get(candidate['id'])
+    if repr_line is None:
+        repr_line = _product_llm_repr(candidate['product'])
+        product_llm_reprs[candidate['id']] = repr_line
+    return repr_line
+
+
+def _pack_rerank_candidates(candidates: List[Dict], token_budget: int = RERANK_TOKEN_BUDGET,
+                            max_candidates: int = RERANK_MAX_CANDIDATES) -> List[str]:
+    """Numbered prompt lines for as many leading candidates as fit the token budget (at least one)"""
+    lines = []
+    used = 0
+    for i, c in enumerate(candidates[:max_candidates]):
+        line = f"{i}: {_candidate_llm_repr(c)}"
+        cost = _estimate_tokens(line)
+        if lines and used + cost > token_budget:
+            break
+        lines.append(line)
+        used += cost
+    return lines
+
+
+async def _scroll_collection(page_size: int = 256, with_payload: Any = True, with_vectors: bool = False):
+    """Yield every point of the collection, one scroll page at a time.
+    
+    Each page is a separate awaited request, so requests keep being served in between.
+    """
+    offset = None
+    while True:
+        points, offset = await qdrant_client.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=page_size,
+            offset=offset,
+            with_payload=with_payload,
+            with_vectors=with_vectors
+        )
+        for point in points:
+            yield point
+        if offset is None:
+            break
+
+
+async def _load_product_llm_reprs():
+    """Precompute rerank representations and product-type masks for the whole collection"""
+    loaded = 0
+    try:
+        async for point in _scroll_collection():
+            payload = point.payload or {}
+            product_llm_reprs[str(point.id)] = _product_llm_repr(payload)
+            product_type_masks[str(point.id)] = product_type_matcher.mask(_product_type_text(payload))
+            loaded += 1
+        print(f"Rerank representations: {loaded} products")
+    except Exception as e:
+        print(f"Rerank representation preload stopped after {loaded} products: {e}")
+
+
+def _parse_rerank_items(text: str) -> tuple:
+    """Parse rerank output into ([(index, score, reason), ...], complete).
+    
+    Accepts the compact [[i, s], ...] / [[i, s, "reason"], ...] format and the
+    older [{"i": .., "s": .., "r": ..}, ...] one. Items of truncated (or early-
+    stopped) output are kept; complete is False when the array never closed.
+    """
+    parser = IncrementalJSONParser()
+    items = [parsed for parsed in map(_rerank_item, parser.feed(text)) if parsed is not None]
+    return items, parser.closed
+
+
+async def rerank_with_llm(user_query: str, expanded_context: Dict, candidates: List[Dict], top_k: int = 10,
+                          deadline_ms: Optional[float] = None) -> List[Dict]:
     """
     Use LLM to rerank - matches algorithm from src/search.py.
     Uses detailed product data including popularity signals.
     Only returns products that genuinely match the query.
     
-    Handles both toastd-final schema (name, short_description) and
-    products schema (title, description).
+    Candidates are sent as their precomputed one-line representations, as many
+    as RERANK_TOKEN_BUDGET allows; the reply is a compact [[i, s], ...] array.
+    Scores are cached per (canonical query, product id), so only candidates not
+    scored before for this query are sent; candidates the LLM omits score 0.
+    The reply is streamed and generation stops once top_k items above the score
+    threshold have arrived.
+    
+    If the LLM call fails, candidates with cached scores are still ranked by them
+    and only the unscored ones go through _fallback_ranking. Raises
+    StageDeadlineExceeded (carrying that ranking) when the LLM call runs out of its
+    deadline, so the caller can report the rerank as skipped.
     """
-    # Prepare product data for LLM - consider top 15 candidates
-    products_for_llm = []
-    for i, c in enumerate(candidates[:15]):
-        p = c['product']
-        # Handle both schemas
-        name = (p.get('title') or p.get('name', ''))[:80]
-        desc = (p.get('description') or p.get('short_description', '') or '')[:100]
-        tags = (p.get('tags', '') or '')
-        if isinstance(tags, list):
-            tags = ', '.join(tags[:5])
-        tags = tags[:50]
-        
-        products_for_llm.append({
-            'i': i,
-            'name': name,
-            'desc': desc,
-            'tags': tags
-        })
+    # Reuse scores from earlier reranks of the same query (other limits / price filters)
+    score_text = canonicalize_query(user_query)["text"]
+    window = candidates[:RERANK_MAX_CANDIDATES]
+    scored: Dict[str, tuple] = {}
+    for c in window:
+        cached = rerank_score_cache.get(f"{score_text}|{c['id']}", 0)
+        if cached is not None:
+            scored[c['id']] = tuple(cached)
+    
+    # Precomputed compact lines for as many unscored candidates as the token budget allows
+    unscored = [c for c in window if c['id'] not in scored]
+    product_lines = _pack_rerank_candidates(unscored) if unscored else []
+    sent = unscored[:len(product_lines)]
+    products_block = "\n".join(product_lines)
     
     # Extract primary product type from query for strict filtering
-    query_lower = user_query.lower()
-    product_type = None
-    for ptype in PRODUCT_TYPE_LIST:
-        if ptype in query_lower:
-            product_type = ptype
-            break
+    query_types = product_type_matcher.match(user_query)
+    product_type = query_types[0] if query_types else None
     
     type_instruction = ""
     if product_type:
         type_instruction = f"\nCRITICAL: User wants '{product_type}'. ONLY include products that ARE {product_type}s. Score 0 for anything else (sunscreen, tees, bags etc are NOT {product_type}s)."
     
+    # Map back to full data - FILTER OUT low relevance scores
+    # Use stricter threshold when user specifies a product type
+    min_score = 0.8 if product_type else 0.6
+    
+    if RERANK_REASONS:
+        output_format = '[[i, s, "reason"], ...]\n- i = product number\n- s = score (0.7-1.0, where 1.0 = perfect match)\n- reason = 5-10 words'
+        tokens_per_item = 24
+    else:
+        output_format = '[[i, s], ...]\n- i = product number\n- s = score (0.7-1.0, where 1.0 = perfect match)'
+        tokens_per_item = 8
+    
     prompt = f"""Rate products for query: "{user_query}"
 
-Products:
-{json.dumps(products_for_llm)}
+Products (number: name | description | tags):
+{products_block}
 {type_instruction}
-Return JSON array with ONLY products that EXACTLY match what user asked for:
-- i = index number from above
-- s = score (0.7-1.0, where 1.0 = perfect match, 0 = doesn't match)  
-- r = reason (5-10 words)
+Return a JSON array with ONLY products that EXACTLY match what user asked for:
+{output_format}
 
 Be STRICT: if user asks for hoodies, only hoodies get scores > 0.
 Skip all unrelated products completely.
 
 JSON only:"""
 
-    try:
-        response = call_llm(prompt, max_tokens=600)
-        if not response:
-            raise ValueError("Empty response")
-        
-        # Extract JSON array
-        text = response.replace('```json', '').replace('```', '').strip()
-        start = text.find('[')
-        end = text.rfind(']') + 1
-        if start >= 0 and end > start:
-            text = text[start:end]
-        
-        # Fix common JSON issues
-        text = re.sub(r',\s*]', ']', text)
-        text = re.sub(r',\s*}', '}', text)
-        if not text.endswith(']'):
-            last_brace = text.rfind('}')
-            if last_brace > 0:
-                text = text[:last_brace+1] + ']'
-        
-        reranked = json.loads(text)
-        
-        # Map back to full data - FILTER OUT low relevance scores
-        # Use stricter threshold when user specifies a product type
-        min_score = 0.8 if product_type else 0.6
-        
+    def ranked_by_score() -> List[Dict]:
+        """Scored candidates above the threshold, best first"""
         result = []
-        for item in reranked:
-            idx = item.get('i', item.get('index', -1))
-            score = float(item.get('s', item.get('score', 0)))
-            if idx >= 0 and idx < len(candidates) and score >= min_score:
+        for idx, c in enumerate(window):
+            if c['id'] not in scored:
+                continue
+            score, reason = scored[c['id']]
+            if score >= min_score:
                 # Additional validation: if product type specified, verify it's in the product
-                if product_type:
-                    p = candidates[idx]['product']
-                    # Handle both schemas
-                    name_lower = (p.get('title', '') or p.get('name', '') or '').lower()
-                    tags = p.get('tags', '') or p.get('auto_tags', [])
-                    if isinstance(tags, list):
-                        tags_lower = ', '.join(tags).lower()
-                    else:
-                        tags_lower = str(tags).lower()
-                    desc_lower = (p.get('description', '') or p.get('short_description', '') or '').lower()
-                    pt_check = product_type.rstrip('s')  # Remove plural
-                    if pt_check not in name_lower and pt_check not in tags_lower and pt_check not in desc_lower:
-                        continue  # Skip products that don't actually contain the type
+                if product_type and not _product_type_mask(c) & product_type_matcher.bits[product_type]:
+                    continue  # Skip products that don't actually contain the type
                 
                 result.append({
                     'index': idx,
-                    'product': candidates[idx]['product'],
+                    'product': c['product'],
                     'relevance_score': score,
-                    'reasoning': item.get('r', item.get('reason', 'Relevant match')),
-                    'original_score': candidates[idx]['score'],
-                    'id': candidates[idx]['id']
+                    'reasoning': reason or 'Relevant match',
+                    'original_score': c['score'],
+                    'id': c['id']
                 })
         
-        result = result[:top_k]
+        result.sort(key=lambda x: x['relevance_score'], reverse=True)
+        return result[:top_k]
+    
+    def partial_ranking() -> List[Dict]:
+        """Cached scores first, then the fallback ranking of the candidates without one"""
+        result = ranked_by_score()
+        unscored_left = [c for c in candidates if c['id'] not in scored]
+        return result + _fallback_ranking(unscored_left, top_k - len(result), user_query)
+    
+    stage_deadline_ms = _llm_deadline_ms("rerank", deadline_ms)
+    try:
+        if sent:
+            llm_start = time.perf_counter()
+            response = await call_llm(prompt, max_tokens=len(product_lines) * tokens_per_item + 20,
+                                      stage="rerank", deadline_ms=deadline_ms,
+                                      stop=_rerank_stop(top_k, min_score), stop_key=f"{top_k}|{min_score}")
+            if not response and (time.perf_counter() - llm_start) * 1000 >= stage_deadline_ms:
+                raise StageDeadlineExceeded("rerank")
+            if not response:
+                raise ValueError("Empty response")
+            
+            reranked, complete = _parse_rerank_items(response)
+            
+            # Once the whole array arrived, candidates the LLM skipped are unrelated (score 0);
+            # after an early stop or truncation they were just never reached
+            new_scores = {c['id']: (0.0, None) for c in sent} if complete else {}
+            for idx, score, reason in reranked:
+                try:
+                    idx, score = int(idx), float(score)
+                except (TypeError, ValueError):
+                    continue
+                if 0 <= idx < len(sent):
+                    new_scores[sent[idx]['id']] = (score, reason)
+            for product_id, entry in new_scores.items():
+                rerank_score_cache.set(f"{score_text}|{product_id}", 0, entry)
+            scored.update(new_scores)
         
+        result = ranked_by_score()
         if not result:
-            print(f"No results passed threshold. Sample: {reranked[:2] if reranked else 'empty'}")
+            print(f"No results passed threshold for '{user_query}' ({len(scored)} scored)")
         
         return result if result else _fallback_ranking(candidates, min(top_k, 5), user_query)
-        
+    
+    except StageDeadlineExceeded as e:
+        print(f"Reranking skipped: {e}")
+        raise StageDeadlineExceeded("rerank", partial_ranking())
     except Exception as e:
         print(f"Reranking failed: {e}")
-        return _fallback_ranking(candidates, top_k, user_query)
+        return partial_ranking()
 
 
 def _fallback_ranking(candidates: List[Dict], top_k: int, query: str = "") -> List[Dict]:
@@ -528,30 +2723,16 @@ def _fallback_ranking(candidates: List[Dict], top_k: int, query: str = "") -> Li
     Handles both toastd-final schema (name, short_description) and
     products schema (title, description).
     """
-    # Extract product type from query for basic filtering
-    query_lower = query.lower()
-    product_types = []
-    for ptype in PRODUCT_TYPE_LIST:
-        if ptype in query_lower:
-            product_types.append(ptype.rstrip('s'))  # Remove plural 's'
+    # Extract product types from query for basic filtering
+    query_mask = product_type_matcher.mask(query)
     
     results = []
     for i, candidate in enumerate(candidates):
         product = candidate['product']
-        # Handle both schemas
-        name_lower = (product.get('title', '') or product.get('name', '') or '').lower()
-        tags = product.get('tags', '') or product.get('auto_tags', [])
-        if isinstance(tags, list):
-            tags_lower = ', '.join(tags).lower()
-        else:
-            tags_lower = str(tags).lower()
-        desc_lower = (product.get('description', '') or product.get('short_description', '') or '').lower()
         
         # If we have product type requirements, check if this matches
-        if product_types:
-            matches = any(pt in name_lower or pt in tags_lower or pt in desc_lower for pt in product_types)
-            if not matches:
-                continue
+        if query_mask and not _product_type_mask(candidate) & query_mask:
+            continue
         
         results.append({
             'index': i,
@@ -568,37 +2749,290 @@ def _fallback_ranking(candidates: List[Dict], top_k: int, query: str = "") -> Li
     return results
 
 
-def apply_final_scoring(reranked: List[Dict]) -> List[Dict]:
-    """Combine AI relevance with popularity"""
-    for item in reranked:
-        product = item.get('product', {})
-        view_score = (product.get('view_count', 0) or 0) / max_views
-        vote_score = (product.get('vote_count', 0) or 0) / max_votes
+class Reranker(ABC):
+    """Reorders vector-search candidates for a query.
+    
+    rerank() returns items with product, relevance_score, reasoning, original_score
+    and id, the shape apply_final_scoring consumes. When deadline_ms (or the
+    backend's own deadline) runs out it raises StageDeadlineExceeded carrying the
+    fallback items instead, so the degraded result is reported and not cached.
+    """
+    name = "base"
+    
+    @abstractmethod
+    async def rerank(self, user_query: str, expanded_context: Dict, candidates: List[Dict], top_k: int = 10,
+                     deadline_ms: Optional[float] = None) -> List[Dict]:
+        ...
+
+
+class LLMReranker(Reranker):
+    """Rerank through the configured LLM (Ollama / OpenAI)"""
+    name = "llm"
+    
+    async def rerank(self, user_query: str, expanded_context: Dict, candidates: List[Dict], top_k: int = 10,
+                     deadline_ms: Optional[float] = None) -> List[Dict]:
+        return await rerank_with_llm(user_query, expanded_context, candidates, top_k, deadline_ms)
+
+
+class CrossEncoderReranker(Reranker):
+    """Local CPU cross-encoder scoring (query, product) pairs in one batch.
+    
+    backend is "torch", "onnx" or "onnx-int8" (a quantized ONNX export of the
+    model, loaded from onnx_file). The ONNX backends need sentence-transformers>=4
+    with the ONNX extras (sentence-transformers[onnx]). Runs in the encoder thread pool.
+    
+    Like the LLM rerank, results below min_score and, when the query names a product
+    type, products of other types are dropped (falling back if nothing is left).
+    """
+    name = "cross-encoder"
+    BACKENDS = ("torch", "onnx", "onnx-int8")
+    
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL, backend: str = "torch",
+                 onnx_file: str = CROSS_ENCODER_ONNX_FILE, max_candidates: int = CROSS_ENCODER_MAX_CANDIDATES,
+                 min_score: float = CROSS_ENCODER_MIN_SCORE):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown cross-encoder backend '{backend}' (expected one of {', '.join(self.BACKENDS)})")
+        kwargs: Dict[str, Any] = {}
+        if backend != "torch":
+            self._check_onnx_support(backend)
+            kwargs["backend"] = "onnx"
+            if backend == "onnx-int8":
+                kwargs["model_kwargs"] = {"file_name": onnx_file}
+        self.model = CrossEncoder(model_name, **kwargs)
+        self.backend = backend
+        self.max_candidates = max_candidates
+        self.min_score = min_score
+        self.logits = self._returns_logits(self.model)
+    
+    @staticmethod
+    def _check_onnx_support(backend: str):
+        import sentence_transformers
+        version = sentence_transformers.__version__
+        missing = [module for module in ("optimum", "onnxruntime") if importlib.util.find_spec(module) is None]
+        if int(version.split(".")[0]) < 4 or missing:
+            raise RuntimeError(
+                f"CROSS_ENCODER_BACKEND={backend} needs sentence-transformers>=4 with the ONNX extras "
+                f"(found sentence-transformers {version}"
+                f"{', missing ' + ', '.join(missing) if missing else ''}); "
+                f"install 'sentence-transformers[onnx]>=4.0.0' or use CROSS_ENCODER_BACKEND=torch"
+            )
+    
+    @staticmethod
+    def _returns_logits(model) -> bool:
+        """Whether predict() returns raw logits: the model's configured activation is the identity.
         
-        item['final_score'] = (
-            0.70 * item.get('relevance_score', 0.5) +
-            0.20 * vote_score +
-            0.10 * view_score
-        )
+        sentence-transformers >= 4 names it activation_fn, older versions default_activation_function.
+        """
+        activation = getattr(model, "activation_fn", None) or getattr(model, "default_activation_function", None)
+        return activation is None or type(activation).__name__ == "Identity"
+    
+    def score(self, query: str, texts: List[str]) -> np.ndarray:
+        """Relevance in [0, 1] for each text: the model's configured activation, or sigmoid for logit models"""
+        scores = np.asarray(self.model.predict([(query, t) for t in texts], batch_size=len(texts) or 1),
+                            dtype=np.float32).reshape(len(texts))
+        if self.logits:
+            scores = 1 / (1 + np.exp(-scores))
+        return scores
+    
+    async def rerank(self, user_query: str, expanded_context: Dict, candidates: List[Dict], top_k: int = 10,
+                     deadline_ms: Optional[float] = None) -> List[Dict]:
+        pool = candidates[:self.max_candidates]
+        if not pool:
+            return []
+        texts = [_candidate_llm_repr(c) for c in pool]
+        loop = asyncio.get_running_loop()
+        timeout = deadline_ms / 1000 if deadline_ms is not None else None
+        try:
+            # On timeout the batch still finishes in its worker thread; only the wait is abandoned
+            scores = await asyncio.wait_for(loop.run_in_executor(encoder_executor, self.score, user_query, texts),
+                                            timeout)
+        except asyncio.TimeoutError:
+            print(f"Cross-encoder rerank skipped: deadline of {deadline_ms:.0f}ms exceeded")
+            raise StageDeadlineExceeded("rerank", _fallback_ranking(candidates, top_k, user_query))
+        except Exception as e:
+            print(f"Cross-encoder rerank failed: {e}")
+            return _fallback_ranking(candidates, top_k, user_query)
+        
+        query_types = product_type_matcher.match(user_query)
+        type_bits = product_type_matcher.bits[query_types[0]] if query_types else 0
+        result = []
+        for i in np.argsort(-scores, kind="stable"):
+            score = float(scores[i])
+            if score < self.min_score:
+                break
+            if type_bits and not _product_type_mask(pool[i]) & type_bits:
+                continue
+            result.append({
+                'index': int(i),
+                'product': pool[i]['product'],
+                'relevance_score': score,
+                'reasoning': f"Cross-encoder relevance {score:.2f}",
+                'original_score': pool[i]['score'],
+                'id': pool[i]['id']
+            })
+            if len(result) == top_k:
+                break
+        return result if result else _fallback_ranking(candidates, min(top_k, 5), user_query)
+
+
+def _create_reranker() -> Optional[Reranker]:
+    """Reranker selected by RERANKER; defaults to the LLM when one is available"""
+    choice = (RERANKER or ("llm" if USE_LLM else "none")).lower()
+    if choice == "cross-encoder":
+        print(f"Reranker: cross-encoder ({CROSS_ENCODER_MODEL}, {CROSS_ENCODER_BACKEND})")
+        return CrossEncoderReranker(CROSS_ENCODER_MODEL, CROSS_ENCODER_BACKEND)
+    if choice == "llm" and USE_LLM:
+        return LLMReranker()
+    if choice != "none":
+        print(f"Reranker '{choice}' unavailable - reranking disabled")
+    return None
+
+
+class PopularityTable:
+    """Normalized view / vote scores for every product, indexed by product id.
+    
+    Counts are capped at the given percentile (so a few viral products do not
+    squash everyone else towards 0) and, with log scaling, compressed with log1p.
+    Scores are precomputed as NumPy arrays aligned with `index` (product id ->
+    row). Instances are immutable; refreshes build a new one and swap the global.
+    """
+    
+    def __init__(self, ids: List[str], views: np.ndarray, votes: np.ndarray,
+                 percentile: float = 99.0, scaling: str = "log"):
+        self.percentile = percentile
+        self.scaling = scaling
+        self.index = {product_id: row for row, product_id in enumerate(ids)}
+        self.view_cap = self._cap(views)
+        self.vote_cap = self._cap(votes)
+        self.view_scores = self.scale(views, self.view_cap)
+        self.vote_scores = self.scale(votes, self.vote_cap)
+        self.computed_at = time.time()
+    
+    def _cap(self, values: np.ndarray) -> float:
+        if not values.size:
+            return 0.0
+        cap = float(np.percentile(values, self.percentile))
+        return cap if cap > 0 else float(values.max())
+    
+    def scale(self, values: np.ndarray, cap: float) -> np.ndarray:
+        """Raw counts -> [0, 1] scores"""
+        if cap <= 0:
+            return np.zeros(len(values), dtype=np.float32)
+        clipped = np.clip(np.asarray(values, dtype=np.float64), 0.0, cap)
+        if self.scaling == "log":
+            return (np.log1p(clipped) / np.log1p(cap)).astype(np.float32)
+        return (clipped / cap).astype(np.float32)
+    
+    def lookup(self, items: List[Dict]) -> tuple:
+        """(view scores, vote scores) arrays for scored items.
+        
+        Products missing from the table (added since the last scan) are scaled
+        from their payload counts.
+        """
+        rows = np.fromiter((self.index.get(item.get('id'), -1) for item in items), dtype=np.int64, count=len(items))
+        known = rows >= 0
+        views = np.zeros(len(items), dtype=np.float32)
+        votes = np.zeros(len(items), dtype=np.float32)
+        views[known] = self.view_scores[rows[known]]
+        votes[known] = self.vote_scores[rows[known]]
+        
+        missing = np.flatnonzero(~known)
+        if missing.size:
+            payloads = [items[i].get('product') or {} for i in missing]
+            views[missing] = self.scale([_safe_float(p.get('view_count')) for p in payloads], self.view_cap)
+            votes[missing] = self.scale([_safe_float(p.get('vote_count')) for p in payloads], self.vote_cap)
+        return views, votes
+    
+    def stats(self) -> Dict:
+        return {
+            "products": len(self.index),
+            "percentile": self.percentile,
+            "scaling": self.scaling,
+            "viewCap": self.view_cap,
+            "voteCap": self.vote_cap,
+            "ageSeconds": round(time.time() - self.computed_at, 1)
+        }
+
+
+# Empty until the first background scan finishes: popularity contributes 0 meanwhile
+popularity = PopularityTable([], np.zeros(0), np.zeros(0), POPULARITY_PERCENTILE, POPULARITY_SCALING)
+
+
+async def refresh_popularity_stats():
+    """Scan the whole collection and atomically swap in a new popularity table"""
+    global popularity
+    ids, views, votes = [], [], []
+    async for point in _scroll_collection(page_size=1024, with_payload=["view_count", "vote_count"]):
+        payload = point.payload or {}
+        ids.append(str(point.id))
+        views.append(_safe_float(payload.get('view_count')))
+        votes.append(_safe_float(payload.get('vote_count')))
+    popularity = PopularityTable(
+        ids, np.asarray(views, dtype=np.float64), np.asarray(votes, dtype=np.float64),
+        POPULARITY_PERCENTILE, POPULARITY_SCALING
+    )
+    print(f"Popularity stats: {len(ids)} products, view cap {popularity.view_cap:g}, vote cap {popularity.vote_cap:g}")
+
+
+async def _popularity_refresher():
+    """Refresh popularity statistics now and then every POPULARITY_REFRESH_INTERVAL seconds"""
+    while True:
+        try:
+            await refresh_popularity_stats()
+        except Exception as e:
+            print(f"Popularity refresh failed: {e}")
+        await asyncio.sleep(POPULARITY_REFRESH_INTERVAL)
+
+
+def apply_final_scoring(reranked: List[Dict], top_k: Optional[int] = None) -> List[Dict]:
+    """Combine AI relevance with popularity.
+    
+    Vectorized over the batch: final = w_rel * relevance + w_votes * votes + w_views * views
+    (SCORE_WEIGHT_* settings). Items under FINAL_SCORE_MIN are dropped, and with
+    top_k only the best top_k are selected (argpartition) and sorted.
+    """
+    if not reranked:
+        return reranked
+    
+    relevance = np.fromiter((item.get('relevance_score', 0.5) for item in reranked),
+                            dtype=np.float32, count=len(reranked))
+    views, votes = popularity.lookup(reranked)
+    final = (SCORE_WEIGHT_RELEVANCE * relevance +
+             SCORE_WEIGHT_VOTES * votes +
+             SCORE_WEIGHT_VIEWS * views)
+    
+    candidates = np.flatnonzero(final >= FINAL_SCORE_MIN) if FINAL_SCORE_MIN > 0 else np.arange(len(final))
+    if top_k is not None and 0 < top_k < candidates.size:
+        candidates = candidates[np.argpartition(-final[candidates], top_k - 1)[:top_k]]
+    order = candidates[np.argsort(-final[candidates], kind="stable")]
     
-    reranked.sort(key=lambda x: x.get('final_score', 0), reverse=True)
-    return reranked
+    result = []
+    for i in order:
+        item = reranked[i]
+        item['final_score'] = float(final[i])
+        result.append(item)
+    return result
 
 
 # ============================================================
 # Startup and Endpoints
 # ============================================================
 
-def _setup_llm_provider():
+async def _setup_llm_provider():
     """Setup LLM provider and return configuration."""
     global LLM_PROVIDER, USE_LLM, openai_client, ollama_available
     
     should_try_ollama = LLM_PROVIDER == "ollama" or (LLM_PROVIDER == "none" and USE_OLLAMA)
     
+    if OPENAI_API_KEY:
+        # Created whenever a key is set: OpenAI is also the fallback/hedge for Ollama
+        from openai import AsyncOpenAI
+        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    
     if should_try_ollama:
-        ollama_available = check_ollama_available()
+        ollama_available = await check_ollama_available()
         if ollama_available:
-            print(f"LLM: Ollama ({OLLAMA_MODEL}) ✓")
+            print(f"LLM: Ollama ({OLLAMA_MODEL}) ✓" + (" + OpenAI hedge" if openai_client else ""))
             LLM_PROVIDER = "ollama"
             USE_LLM = True
             return
@@ -613,35 +3047,53 @@ def _setup_llm_provider():
     
     if LLM_PROVIDER == "openai":
         print("LLM: OpenAI (gpt-4o-mini)")
-        from openai import OpenAI
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
         USE_LLM = True
     elif LLM_PROVIDER == "none":
         print("LLM: Disabled (simple semantic search)")
         print("  To enable: start Ollama or set OPENAI_API_KEY")
 
 
-def _setup_qdrant_and_encoder():
+async def _setup_qdrant_and_encoder():
     """Setup Qdrant client and encoder."""
-    global qdrant_client, encoder, max_views, max_votes
+    global qdrant_client, encoder, encoder_executor, embedding_cache, semantic_expansion_cache, reranker
     
-    qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+    qdrant_client = AsyncQdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
     print("Loading SentenceTransformer...")
     encoder = SentenceTransformer('all-MiniLM-L6-v2')
+    encoder_executor = ThreadPoolExecutor(max_workers=ENCODER_WORKERS, thread_name_prefix="encoder")
+    embedding_cache = EmbeddingCache(
+        capacity=EMBEDDING_CACHE_SIZE,
+        dim=encoder.get_sentence_embedding_dimension(),
+        path=EMBEDDING_CACHE_PATH or None,
+        sync_interval=EMBEDDING_CACHE_SYNC_INTERVAL
+    )
+    print(f"Embedding cache: {len(embedding_cache.slots)}/{EMBEDDING_CACHE_SIZE} vectors loaded")
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_expansion_cache = SemanticExpansionCache(
+            dim=embedding_cache.dim,
+            capacity=SEMANTIC_CACHE_SIZE,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            ttl=query_expansion_cache.ttl
+        )
     
-    info = qdrant_client.get_collection(COLLECTION_NAME)
-    print(f"Connected! {info.points_count} products")
-    
-    sample = qdrant_client.scroll(
-        collection_name=COLLECTION_NAME,
-        limit=500,
-        with_payload=True
-    )[0]
+    reranker = _create_reranker()
     
-    views = [p.payload.get('view_count', 0) or 0 for p in sample]
-    votes = [p.payload.get('vote_count', 0) or 0 for p in sample]
-    max_views = max(views) if views and max(views) > 0 else 1
-    max_votes = max(votes) if votes and max(votes) > 0 else 1
+    info = await qdrant_client.get_collection(COLLECTION_NAME)
+    print(f"Connected! {info.points_count} products")
+    await _ensure_payload_indexes(info)
+
+
+async def _ensure_payload_indexes(info):
+    """Create the PAYLOAD_INDEXES the collection is missing, so filtered searches stay fast"""
+    existing = info.payload_schema or {}
+    for field, schema in PAYLOAD_INDEXES.items():
+        if field in existing:
+            continue
+        try:
+            await qdrant_client.create_payload_index(COLLECTION_NAME, field_name=field, field_schema=schema)
+            print(f"Payload index created: {field} ({schema.value})")
+        except Exception as e:
+            print(f"Payload index {field} not created: {e}")
 
 
 @app.on_event("startup")
@@ -652,23 +3104,71 @@ async def startup_event():
     print(f"Qdrant: {QDRANT_URL}")
     print(f"Collection: {COLLECTION_NAME}")
     
-    _setup_llm_provider()
+    global http_client, cache_sweeper_task, product_repr_task, ollama_warmup_task, popularity_task
+    global local_index, local_index_task, lexical_index_task, intent_vocabulary_task
+    http_client = _create_http_client()
+    cache_sweeper_task = asyncio.ensure_future(_cache_sweeper())
+    
+    await _setup_llm_provider()
+    if ollama_available and OLLAMA_WARMUP:
+        ollama_warmup_task = asyncio.ensure_future(warm_up_ollama())
     print(f"Cache: {CACHE_SIZE} queries, {CACHE_TTL}s TTL")
     
     try:
-        _setup_qdrant_and_encoder()
+        await _setup_qdrant_and_encoder()
+        popularity_task = asyncio.ensure_future(_popularity_refresher())
+        if SEARCH_BACKEND == "local":
+            # Serve from the last snapshot right away; the refresher re-exports it from Qdrant
+            local_index = await asyncio.to_thread(_load_local_index)
+            if local_index is not None:
+                print(f"Local index: {len(local_index)} products from {local_index.path}")
+            local_index_task = asyncio.ensure_future(_local_index_refresher())
+        if LEXICAL_SEARCH:
+            lexical_index_task = asyncio.ensure_future(_lexical_index_refresher())
+        if INTENT_FILTERS:
+            intent_vocabulary_task = asyncio.ensure_future(_intent_vocabulary_refresher())
+        if reranker is not None:
+            product_repr_task = asyncio.ensure_future(_load_product_llm_reprs())
         print("=" * 60)
     except Exception as e:
         print(f"Startup failed: {e}")
         raise
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if cache_sweeper_task is not None:
+        cache_sweeper_task.cancel()
+    if product_repr_task is not None:
+        product_repr_task.cancel()
+    if ollama_warmup_task is not None:
+        ollama_warmup_task.cancel()
+    if popularity_task is not None:
+        popularity_task.cancel()
+    if local_index_task is not None:
+        local_index_task.cancel()
+    if lexical_index_task is not None:
+        lexical_index_task.cancel()
+    if intent_vocabulary_task is not None:
+        intent_vocabulary_task.cancel()
+    if http_client is not None:
+        await http_client.aclose()
+    if qdrant_client is not None:
+        await qdrant_client.close()
+    if encoder_executor is not None:
+        encoder_executor.shutdown(wait=False)
+    if embedding_cache is not None:
+        await embedding_cache.persist(force=True)
+    for tier in _persistent_tiers():
+        await asyncio.to_thread(tier.close)
+
+
 @app.get("/health")
 async def health():
     if qdrant_client is None:
         raise HTTPException(status_code=503, detail="Not ready")
     
-    info = qdrant_client.get_collection(COLLECTION_NAME)
+    info = await qdrant_client.get_collection(COLLECTION_NAME)
     
     return {
         "status": "healthy",
@@ -679,7 +3179,28 @@ async def health():
         "searchMode": "advanced" if USE_LLM else "simple",
         "cache": {
             "expansion": query_expansion_cache.stats(),
-            "results": search_results_cache.stats()
+            "results": search_results_cache.stats(),
+            "embedding": embedding_cache.stats() if embedding_cache is not None else None
+        },
+        "encoder": encoder_batcher.stats(),
+        "reranker": reranker.name if reranker is not None else None,
+        "ollama": ollama_stats.stats() if ollama_available else None,
+        "popularity": popularity.stats(),
+        "searchBackend": {
+            "configured": SEARCH_BACKEND,
+            "active": "local" if local_index is not None else "qdrant",
+            "localIndex": local_index.stats() if local_index is not None else None
+        },
+        "lexicalIndex": lexical_index.stats() if lexical_index is not None else None,
+        "intentFilters": {
+            "enabled": INTENT_FILTERS,
+            "productTypes": product_type_values,
+            "aesthetics": aesthetic_matcher.types if aesthetic_matcher is not None else []
+        },
+        "latencyBudget": {
+            "defaultMs": SEARCH_LATENCY_BUDGET_MS,
+            "stageEstimatesMs": {stage: _stage_estimate_ms(stage) for stage in STAGE_LATENCY_DEFAULTS_MS},
+            "stages": stage_latency.stats().get("pipeline", {})
         }
     }
 
@@ -746,10 +3267,204 @@ def _parse_price_from_query(query: str) -> tuple:
                 clean_query = re.sub(pattern, '', query, flags=re.IGNORECASE)
             break
     
-    # Clean up extra whitespace
-    clean_query = ' '.join(clean_query.split()).strip()
+    # Clean up extra whitespace
+    clean_query = ' '.join(clean_query.split()).strip()
+    
+    return (price_min, price_max, clean_query)
+
+
+# Currency words left behind after price extraction ("gift under 2000 rupees")
+_CURRENCY_TOKEN_RE = re.compile(r'(?:₹|\brs\.?(?=\s|$|\d)|\binr\b|\brupees?\b|/-)', re.IGNORECASE)
+
+
+# Plurals whose singular ends in -ie rather than -y
+_IE_PLURALS = {'hoodies', 'cookies', 'goodies', 'beanies', 'movies', 'selfies', 'onesies', 'brownies', 'smoothies', 'ties', 'pies'}
+
+
+def _singularize(token: str) -> str:
+    """Cheap plural folding for cache keys (hoodies -> hoodie, watches -> watch)"""
+    if len(token) <= 3 or not token.isalpha():
+        return token
+    if token in _IE_PLURALS:
+        return token[:-1]
+    if token.endswith('ies') and len(token) > 4:
+        return token[:-3] + 'y'
+    if token.endswith(('sses', 'shes', 'ches', 'xes', 'zes')):
+        return token[:-2]
+    if token.endswith('s') and not token.endswith(('ss', 'us', 'is')):
+        return token[:-1]
+    return token
+
+
+def _normalize_text(text: str) -> str:
+    """Lowercase, drop possessives and punctuation, join hyphenated words, singularize"""
+    text = re.sub(r"'s\b", '', text.lower())
+    text = re.sub(r'(?<=\w)-(?=\w)', '', text)  # t-shirt -> tshirt
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(_singularize(token) for token in text.split())
+
+
+def _format_price_key(price: Optional[float]) -> str:
+    return "" if price is None else f"{float(price):g}"
+
+
+def canonicalize_query(query: str, price_min: Optional[float] = None, price_max: Optional[float] = None) -> Dict:
+    """
+    Reduce a query plus explicit price filters to one canonical search intent.
+    Runs before every cache lookup so that equivalent phrasings share entries.
+    
+    Returns a dict with:
+    - text: normalized query text (lowercase, no punctuation/currency, singular nouns)
+    - search_query: the price-stripped query to actually search with
+    - price_min / price_max: effective price range (explicit filters win over parsed)
+    - key: "text|min|max" structured cache key
+    
+    Examples (all -> "hoodie||1000"):
+    - "Hoodies under 1000"
+    - "hoodies  below ₹1,000"
+    - "hoodies" with priceMax=1000
+    """
+    query = unicodedata.normalize('NFKC', query)
+    parsed_min, parsed_max, clean_query = _parse_price_from_query(query)
+    
+    effective_min = price_min if price_min is not None else parsed_min
+    effective_max = price_max if price_max is not None else parsed_max
+    search_query = clean_query if (parsed_min or parsed_max) else query
+    
+    text = _normalize_text(_CURRENCY_TOKEN_RE.sub(' ', search_query))
+    
+    return {
+        "text": text,
+        "search_query": search_query,
+        "price_min": effective_min,
+        "price_max": effective_max,
+        "key": f"{text}|{_format_price_key(effective_min)}|{_format_price_key(effective_max)}"
+    }
+
+
+class PhraseMatcher:
+    """Multi-pattern phrase matcher over a token trie, compiled once (product types,
+    recipients, aesthetics).
+    
+    Text and patterns are normalized the same way (_normalize_text: lowercase,
+    t-shirt -> tshirt, singular nouns), so matching is by whole tokens: "tee" no
+    longer matches "steel", and plural and hyphenated spellings need no extra
+    patterns. Each canonical value gets one bit; mask() ORs the bits of every value
+    found, so type checks against precomputed product masks are a single AND.
+    """
     
-    return (price_min, price_max, clean_query)
+    def __init__(self, synonyms: Dict[str, List[str]]):
+        self.types = list(synonyms)
+        self.bits = {ptype: 1 << i for i, ptype in enumerate(self.types)}
+        self.trie: Dict = {}
+        self.tokens = set()  # Every token of every pattern
+        for ptype, patterns in synonyms.items():
+            for pattern in [ptype, *patterns]:
+                node = self.trie
+                for token in _normalize_text(pattern).split():
+                    self.tokens.add(token)
+                    node = node.setdefault(token, {})
+                node[None] = ptype  # None marks the end of a pattern
+    
+    def match(self, text: str) -> List[str]:
+        """Canonical types found in text, in order of first appearance"""
+        tokens = _normalize_text(text).split()
+        found: Dict[str, None] = {}
+        for start in range(len(tokens)):
+            node = self.trie
+            for token in tokens[start:]:
+                node = node.get(token)
+                if node is None:
+                    break
+                if None in node:
+                    found.setdefault(node[None])
+        return list(found)
+    
+    def mask(self, text: str) -> int:
+        result = 0
+        for ptype in self.match(text):
+            result |= self.bits[ptype]
+        return result
+    
+    def names(self, mask: int) -> List[str]:
+        return [ptype for ptype in self.types if mask & self.bits[ptype]]
+
+
+product_type_matcher = PhraseMatcher(PRODUCT_TYPE_SYNONYMS)
+
+
+def _product_type_text(product: Dict) -> str:
+    """Title, tags, description and product type of a product, for type matching (both schemas)"""
+    tags = product.get('tags', '') or product.get('auto_tags', [])
+    return ' | '.join([
+        product.get('title', '') or product.get('name', '') or '',
+        ', '.join(tags) if isinstance(tags, list) else str(tags),
+        product.get('description', '') or product.get('short_description', '') or '',
+        str(product.get('product_type') or '')
+    ])
+
+
+def _product_type_mask(candidate: Dict) -> int:
+    """Type bitmask of a candidate, precomputed at startup (computed and stored on a miss)"""
+    mask = product_type_masks.get(candidate['id'])
+    if mask is None:
+        mask = product_type_matcher.mask(_product_type_text(candidate['product']))
+        product_type_masks[candidate['id']] = mask
+    return mask
+
+
+# Query intent -> payload values. Recipients are a fixed vocabulary (upsert_toastd.py RECIPIENT_MAP);
+# product_type and aesthetics values come from the collection (refresh_intent_vocabulary)
+recipient_matcher = PhraseMatcher(RECIPIENT_SYNONYMS)
+product_type_values: Dict[str, List[str]] = {}  # canonical product type -> payload product_type values
+aesthetic_matcher: Optional[PhraseMatcher] = None
+
+
+def detect_query_intent(text: str) -> Dict[str, List[str]]:
+    """Payload values named by the query, per filterable field (product_type, recipients, aesthetics).
+    
+    `text` is canonical query text. Fields the query says nothing about are omitted.
+    """
+    intent = {}
+    product_types = [v for ptype in product_type_matcher.match(text) for v in product_type_values.get(ptype, [])]
+    if product_types:
+        intent['product_type'] = product_types
+    recipients = recipient_matcher.match(text)
+    if recipients:
+        intent['recipients'] = recipients
+    aesthetics = aesthetic_matcher.match(text) if aesthetic_matcher is not None else []
+    if aesthetics:
+        intent['aesthetics'] = aesthetics
+    return intent
+
+
+async def refresh_intent_vocabulary():
+    """Map canonical product types to the collection's product_type values, and compile
+    the aesthetics values into a matcher (facet counts over the payload indexes)"""
+    global product_type_values, aesthetic_matcher
+    types = await qdrant_client.facet(COLLECTION_NAME, key="product_type", limit=INTENT_VOCABULARY_LIMIT)
+    mapping: Dict[str, List[str]] = {}
+    for hit in types.hits:
+        for ptype in product_type_matcher.match(str(hit.value)):
+            mapping.setdefault(ptype, []).append(str(hit.value))
+    product_type_values = mapping
+    
+    aesthetics = await qdrant_client.facet(COLLECTION_NAME, key="aesthetics", limit=INTENT_VOCABULARY_LIMIT)
+    aesthetic_matcher = PhraseMatcher({
+        str(hit.value): [] for hit in aesthetics.hits if str(hit.value).lower() not in INTENT_IGNORED_VALUES
+    })
+    print(f"Intent vocabulary: {sum(map(len, mapping.values()))} product types mapped, "
+          f"{len(aesthetic_matcher.types)} aesthetics")
+
+
+async def _intent_vocabulary_refresher():
+    """Refresh the intent vocabulary now and then every INTENT_VOCABULARY_REFRESH_INTERVAL seconds"""
+    while True:
+        try:
+            await refresh_intent_vocabulary()
+        except Exception as e:
+            print(f"Intent vocabulary refresh failed: {e}")
+        await asyncio.sleep(INTENT_VOCABULARY_REFRESH_INTERVAL)
 
 
 def _format_product_result(item: Dict) -> ProductResult:
@@ -798,90 +3513,516 @@ def _format_product_result(item: Dict) -> ProductResult:
     )
 
 
-def _build_price_filter(price_min: Optional[float], price_max: Optional[float]) -> Optional[Dict]:
-    """Build price filter for Qdrant query.
+def _build_query_filter(price_min: Optional[float], price_max: Optional[float],
+                        intent: Optional[Dict[str, List[str]]] = None) -> Optional[models.Filter]:
+    """Build the Qdrant filter: price range plus any-of matches for the query intent.
     
     Uses 'price' field for toastd-final collection.
     """
-    if price_min is None and price_max is None:
-        return None
+    must = []
+    if price_min is not None or price_max is not None:
+        must.append(models.FieldCondition(
+            key="price",
+            range=models.Range(gte=price_min or 0, lte=price_max or 1000000)
+        ))
+    for field, values in (intent or {}).items():
+        must.append(models.FieldCondition(key=field, match=models.MatchAny(any=values)))
+    return models.Filter(must=must) if must else None
+
+
+def _relaxed_intents(intent: Dict[str, List[str]]) -> List[Dict[str, List[str]]]:
+    """The intent, then progressively looser versions of it (fields dropped in INTENT_RELAX_ORDER)"""
+    levels = [intent]
+    for field in INTENT_RELAX_ORDER:
+        if field in levels[-1]:
+            levels.append({k: v for k, v in levels[-1].items() if k != field})
+    return levels
+
+
+def _build_search_response(request: SearchRequest, items: List[Dict], start_time: float, search_mode: str,
+                           stages: Optional[List[str]] = None, skipped: Optional[List[str]] = None) -> Dict:
+    """Format scored items into SearchResponse data"""
+    formatted_results = [_format_product_result(item) for item in items]
+    processing_time = (time.time() - start_time) * 1000
+    
     return {
-        "must": [{
-            "key": "price",
-            "range": {
-                "gte": price_min or 0,
-                "lte": price_max or 1000000
-            }
-        }]
+        "query": request.query,
+        "totalResults": len(formatted_results),
+        "results": formatted_results,
+        "processingTimeMs": round(processing_time, 2),
+        "searchMode": search_mode,
+        "cached": False,
+        "stages": stages or [],
+        "skippedStages": skipped or []
     }
 
 
-def _perform_search(request: SearchRequest) -> Dict:
-    """Perform the search and return response data."""
+def _raw_candidate_items(candidates: List[Dict], limit: int) -> List[Dict]:
+    """Vector-search candidates as result items, ranked by similarity alone"""
+    return [
+        {
+            'product': c['product'],
+            'final_score': c['score'],
+            'relevance_score': c['score'],
+            'reasoning': None,
+            'id': c['id']
+        }
+        for c in candidates[:limit]
+    ]
+
+
+async def _search_vector_once(vector, price_min: Optional[float], price_max: Optional[float], limit: int,
+                              intent: Dict[str, List[str]]) -> List[Dict]:
+    """Nearest neighbours of a query vector passing the filters, as candidates.
+    
+    Served from the local snapshot when SEARCH_BACKEND is "local" and one is loaded,
+    otherwise (or if the local search fails) from Qdrant.
+    """
+    index = local_index
+    if index is not None:
+        try:
+            return await asyncio.to_thread(index.search, vector, limit, price_min, price_max, intent)
+        except Exception as e:
+            print(f"Local vector search failed, using Qdrant: {e}")
+    results = (await qdrant_client.query_points(
+        collection_name=COLLECTION_NAME,
+        query=vector.tolist(),
+        limit=limit,
+        query_filter=_build_query_filter(price_min, price_max, intent),
+        with_payload=True
+    )).points
+    return [
+        {'product': r.payload, 'score': r.score, 'id': str(r.id)}
+        for r in results
+    ]
+
+
+async def _search_vector(vector, price_min: Optional[float], price_max: Optional[float], limit: int,
+                         intent: Optional[Dict[str, List[str]]] = None, min_results: int = 0,
+                         strict: Optional[List[Dict]] = None) -> List[Dict]:
+    """Nearest neighbours within the price range that match the query intent.
+    
+    While fewer than min_results match, the search is repeated with looser intents
+    (_relaxed_intents); the stricter matches stay first and the looser ones fill the
+    rest up to limit. `strict` is the result of the full-intent search if the caller
+    already has it.
+    """
+    levels = _relaxed_intents(intent or {})
+    candidates = strict if strict is not None else await _search_vector_once(vector, price_min, price_max,
+                                                                             limit, levels[0])
+    for level in levels[1:]:
+        if len(candidates) >= min_results:
+            break
+        seen = {c['id'] for c in candidates}
+        looser = await _search_vector_once(vector, price_min, price_max, limit, level)
+        candidates = candidates + [c for c in looser if c['id'] not in seen][:limit - len(candidates)]
+    return candidates
+
+
+async def _vector_candidates(text: str, price_min: Optional[float], price_max: Optional[float], limit: int,
+                             intent: Optional[Dict[str, List[str]]] = None, min_results: int = 0) -> List[Dict]:
+    """Embed text and return its nearest neighbours within the price range and intent as candidates"""
+    return await _search_vector(await embed_query(text), price_min, price_max, limit, intent, min_results)
+
+
+def _rrf_fuse(candidate_lists: List[List[Dict]], k: int = RRF_K) -> List[Dict]:
+    """Reciprocal-rank fusion: order by sum of 1 / (k + rank) over the lists.
+    
+    Each fused candidate keeps the similarity score from the first list it appears in.
+    """
+    fused: Dict[str, Dict] = {}
+    for candidates in candidate_lists:
+        for rank, c in enumerate(candidates, start=1):
+            entry = fused.setdefault(c['id'], {**c, 'rrf_score': 0.0})
+            entry['rrf_score'] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda c: c['rrf_score'], reverse=True)
+
+
+def _fuse_candidates(candidate_lists: List[List[Dict]], limit: int, only_ids: Optional[set] = None) -> List[Dict]:
+    """RRF-fuse the non-empty candidate lists (a single list is kept as is), optionally
+    keeping only the given ids, and cut to limit"""
+    candidate_lists = [c for c in candidate_lists if c]
+    if len(candidate_lists) == 1 and only_ids is None:
+        return candidate_lists[0][:limit]
+    fused = _rrf_fuse(candidate_lists)
+    if only_ids is not None:
+        fused = [c for c in fused if c['id'] in only_ids]
+    return fused[:limit]
+
+
+async def _perform_search(request: SearchRequest,
+                          on_candidates: Optional[Callable[[Dict], Awaitable[None]]] = None) -> Dict:
+    """Perform the search and return response data.
+    
+    If on_candidates is given and a rerank follows, it is awaited with the raw
+    vector-search results as soon as Qdrant returns, before the rerank starts.
+    
+    Under a latency budget, expansion runs only from cache or if its estimate still
+    leaves time for the vector search, and the rerank only if its estimate fits the
+    rest; skipped stages are listed in skippedStages.
+    
+    With RAW_QUERY_FUSION the raw query is searched while the expansion is in
+    flight; the expanded results are fused with it, or the raw results used alone
+    when the expansion is skipped or fails. BM25 matches are fused in as well; a
+    strong lexical match (see _strong_lexical_match) skips expansion and rerank and
+    returns only products matching every query term, in fused order.
+    """
     start_time = time.time()
-    search_mode = "advanced" if USE_LLM else "simple"
+    search_mode = "advanced" if USE_LLM or reranker is not None else "simple"
+    budget_ms = request.latencyBudgetMs if request.latencyBudgetMs is not None else SEARCH_LATENCY_BUDGET_MS
+    budget = LatencyBudget(budget_ms, start_time)
+    stages: List[str] = []
+    skipped: List[str] = []
     
-    # Parse price from natural language query
-    parsed_min, parsed_max, clean_query = _parse_price_from_query(request.query)
+    # Parse price from natural language query; explicit filters win over parsed ones
+    canonical = canonicalize_query(request.query, request.priceMin, request.priceMax)
+    effective_min = canonical["price_min"]
+    effective_max = canonical["price_max"]
+    search_query = canonical["search_query"]
     
-    # Use parsed prices if not explicitly provided in request
-    effective_min = request.priceMin if request.priceMin is not None else parsed_min
-    effective_max = request.priceMax if request.priceMax is not None else parsed_max
-    search_query = clean_query if (parsed_min or parsed_max) else request.query
+    # Vector search - get top 30 candidates for reranking (matching src/search.py),
+    # filtered inside the search by the intent the query names
+    candidate_limit = 30 if reranker is not None else request.limit
+    intent = detect_query_intent(canonical["text"]) if INTENT_FILTERS else {}
     
-    # Query expansion
-    if USE_LLM:
-        expanded = expand_query(search_query)
-        search_text = expanded.get('semantic_expansion', search_query)
-    else:
-        expanded = {"search_intent": search_query}
-        search_text = search_query
+    async def vector_candidates(text: str) -> List[Dict]:
+        return await _vector_candidates(text, effective_min, effective_max, candidate_limit, intent, request.limit)
     
-    # Vector search - get top 30 candidates for reranking (matching src/search.py)
-    query_embedding = encoder.encode([search_text])[0].tolist()
-    filter_conditions = _build_price_filter(effective_min, effective_max)
-    candidate_limit = 30 if USE_LLM else request.limit
+    # Lexical search is in-process and cheap, so it runs first and can make the LLM stages unnecessary
+    lexical_candidates: List[Dict] = []
+    lexical_match = False
+    if lexical_index is not None:
+        lexical_candidates, full_matches = lexical_index.search(canonical["text"], candidate_limit,
+                                                                effective_min, effective_max, intent, request.limit)
+        lexical_match = _strong_lexical_match(BM25Index.query_terms(canonical["text"]), full_matches,
+                                              request.limit)
+        stages.append("lexical")
+    use_llm = USE_LLM and not lexical_match
+    if lexical_match:
+        search_mode = "lexical"
     
-    results = qdrant_client.query_points(
-        collection_name=COLLECTION_NAME,
-        query=query_embedding,
-        limit=candidate_limit,
-        query_filter=filter_conditions,
-        with_payload=True
-    ).points
+    raw_task = None
+    if use_llm and RAW_QUERY_FUSION:
+        raw_task = asyncio.ensure_future(vector_candidates(search_query))
     
-    candidates = [
-        {'product': r.payload, 'score': r.score, 'id': str(r.id)}
-        for r in results
-    ]
+    try:
+        # Query expansion
+        expanded = None
+        if use_llm:
+            expanded = await expand_query(search_query, cache_text=canonical["text"],
+                                          deadline_ms=budget.deadline_ms("expansion", "vector_search"))
+            (stages if expanded is not None else skipped).append("expansion")
+        if expanded is not None:
+            search_text = expanded.get('semantic_expansion', search_query)
+        else:
+            expanded = {"search_intent": search_query}
+            search_text = search_query
+        
+        vector_start = time.time()
+        if raw_task is None:
+            candidate_lists = [await vector_candidates(search_text)]
+        elif search_text == search_query:
+            # Expansion skipped or failed (its fallback is the raw query)
+            candidate_lists = [await raw_task]
+        else:
+            candidate_lists = list(await asyncio.gather(vector_candidates(search_text), raw_task))
+    except BaseException:
+        if raw_task is not None:
+            raw_task.cancel()
+        raise
+    stage_latency.record("pipeline", "vector_search", (time.time() - vector_start) * 1000, True)
+    stages.append("vector_search")
+    candidates = _fuse_candidates(candidate_lists + [lexical_candidates], candidate_limit,
+                                  full_matches if lexical_match else None)
     
     # Rerank with LLM or use simple results
-    if USE_LLM and candidates and not request.skipRerank:
-        reranked = rerank_with_llm(search_query, expanded, candidates, top_k=request.limit)
-        final_results = apply_final_scoring(reranked)
+    rerank = bool(reranker is not None and candidates and not request.skipRerank and not lexical_match)
+    rerank_deadline = budget.deadline_ms("rerank") if rerank else None
+    if rerank and rerank_deadline == 0:
+        skipped.append("rerank")
+        rerank = False
+    
+    if rerank:
+        if on_candidates is not None:
+            await on_candidates(_build_search_response(
+                request, _raw_candidate_items(candidates, request.limit), start_time, "candidates", stages, skipped
+            ))
+        rerank_start = time.time()
+        try:
+            reranked = await reranker.rerank(search_query, expanded, candidates, top_k=request.limit,
+                                             deadline_ms=rerank_deadline)
+            stages.append("rerank")
+        except StageDeadlineExceeded as e:
+            reranked = e.fallback
+            skipped.append("rerank")
+        stage_latency.record("pipeline", "rerank", (time.time() - rerank_start) * 1000, "rerank" in stages)
+        final_results = apply_final_scoring(reranked, request.limit)
     else:
-        final_results = [
-            {
-                'product': c['product'],
-                'final_score': c['score'],
-                'relevance_score': c['score'],
-                'reasoning': None,
-                'id': c['id']
-            }
-            for c in candidates[:request.limit]
+        final_results = _raw_candidate_items(candidates, request.limit)
+    
+    return _build_search_response(request, final_results, start_time, search_mode, stages, skipped)
+
+
+# Background refreshes (stale-while-revalidate / refresh-ahead)
+_background_tasks = set()
+refresh_stats = {"staleServed": 0, "staleRefreshes": 0, "aheadRefreshes": 0, "refreshFailures": 0}
+
+
+def _search_cache_args(request: SearchRequest) -> tuple:
+    """(text, limit, price_min, price_max) of the canonical results-cache key"""
+    canonical = canonicalize_query(request.query, request.priceMin, request.priceMax)
+    return canonical["text"], request.limit, canonical["price_min"], canonical["price_max"]
+
+
+def _search_flight_key(request: SearchRequest) -> str:
+    cache_key = search_results_cache._make_key(*_search_cache_args(request))
+    return f"{cache_key}|{request.skipRerank}|{request.latencyBudgetMs}"
+
+
+async def _search_and_cache(request: SearchRequest,
+                            on_candidates: Optional[Callable[[Dict], Awaitable[None]]] = None) -> Dict:
+    """Compute a search (coalesced with identical in-flight ones) and cache it.
+    
+    on_candidates only fires if this call starts the computation; callers that
+    join an in-flight search just receive the final result. Results degraded by
+    the latency budget are not cached, so the next request gets the full pipeline.
+    """
+    async def compute() -> Dict:
+        response_data = await _perform_search(request, on_candidates)
+        if not response_data["skippedStages"]:
+            text, limit, price_min, price_max = _search_cache_args(request)
+            search_results_cache.set(text, limit, response_data, price_min, price_max)
+        return response_data
+    
+    return await search_flight.do(_search_flight_key(request), compute)
+
+
+def _schedule_refresh(request: SearchRequest, reason: str):
+    """Recompute a cached search in the background unless it is already in flight"""
+    if search_flight.in_flight(_search_flight_key(request)):
+        return
+    refresh_stats["staleRefreshes" if reason == "stale" else "aheadRefreshes"] += 1
+    
+    async def refresh():
+        try:
+            await _search_and_cache(request)
+        except Exception as e:
+            refresh_stats["refreshFailures"] += 1
+            print(f"Background refresh failed for '{request.query}': {e}")
+    
+    task = asyncio.ensure_future(refresh())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _lookup_cached_search(request: SearchRequest) -> Optional[Dict]:
+    """Results-cache lookup that schedules stale / refresh-ahead recomputation"""
+    if request.skipCache:
+        return None
+    
+    entry = await search_results_cache.get_entry_async(*_search_cache_args(request))
+    if not entry:
+        return None
+    
+    cached, state, age, hits = entry
+    if state == "stale":
+        refresh_stats["staleServed"] += 1
+        _schedule_refresh(request, "stale")
+    elif age >= REFRESH_AHEAD_FRACTION * search_results_cache.ttl and hits >= REFRESH_AHEAD_MIN_HITS:
+        _schedule_refresh(request, "ahead")
+    return {**cached, "query": request.query, "cached": True, "processingTimeMs": 0.1}
+
+
+async def _cached_search(request: SearchRequest,
+                         on_candidates: Optional[Callable[[Dict], Awaitable[None]]] = None) -> Dict:
+    """Search through the results cache, coalescing identical concurrent misses.
+    
+    Shared by /search and /api/chat/message: when a popular entry expires, the
+    first request computes it and every identical request in flight awaits it.
+    Entries past their TTL are served stale during the grace period while a
+    background task recomputes them; hot entries are refreshed before expiry.
+    """
+    # Check cache first
+    cached = await _lookup_cached_search(request)
+    if cached:
+        return cached
+    
+    # Each caller gets its own copy of the shared result (equivalent phrasings share one)
+    return {**(await _search_and_cache(request, on_candidates)), "query": request.query}
+
+
+async def _batch_search(requests: List[SearchRequest]) -> List[Dict]:
+    """Run several searches together, sharing the expensive steps.
+    
+    Every query goes through the results cache first (stale / refresh-ahead rules
+    included). Misses are coalesced through search_flight like /search: identical
+    misses are computed once, a miss already in flight elsewhere is joined, and
+    concurrent /search calls join the batch's own misses. The rest are computed
+    together by _compute_batch. Latency budgets are not applied here.
+    """
+    start_time = time.time()
+    responses: List[Optional[Dict]] = list(await asyncio.gather(*(_lookup_cached_search(r) for r in requests)))
+    
+    groups: Dict[str, List[int]] = {}
+    for i, r in enumerate(requests):
+        if responses[i] is None:
+            groups.setdefault(_search_flight_key(r), []).append(i)
+    if not groups:
+        return responses
+    
+    work_keys = [key for key in groups if not search_flight.in_flight(key)]
+    batch = asyncio.ensure_future(_compute_batch([requests[groups[key][0]] for key in work_keys], start_time))
+    position = {key: n for n, key in enumerate(work_keys)}
+    
+    async def batch_item(n: int) -> Dict:
+        return (await batch)[n]
+    
+    computed = await asyncio.gather(*(
+        search_flight.do(key, lambda n=position.get(key): batch_item(n)) for key in groups
+    ))
+    if not batch.done():
+        batch.cancel()  # Every key was joined elsewhere after all
+    for indices, data in zip(groups.values(), computed):
+        for i in indices:
+            responses[i] = {**data, "query": requests[i].query}
+    return responses
+
+
+async def _compute_batch(work: List[SearchRequest], start_time: float) -> List[Dict]:
+    """Compute distinct uncached searches together and cache their results.
+    
+    The queries are expanded with packed LLM prompts, embedded in one encoder call
+    and searched with one Qdrant batch query (or the local index); reranks run
+    concurrently. BM25 matches are fused in, and strong lexical matches skip
+    expansion and rerank, as in _perform_search.
+    """
+    if not work:
+        return []
+    search_mode = "advanced" if USE_LLM or reranker is not None else "simple"
+    canonicals = [canonicalize_query(r.query, r.priceMin, r.priceMax) for r in work]
+    search_queries = [c["search_query"] for c in canonicals]
+    limits = [30 if reranker is not None else r.limit for r in work]
+    
+    intents = [detect_query_intent(c["text"]) if INTENT_FILTERS else {} for c in canonicals]
+    
+    lexical = [([], None)] * len(work)
+    if lexical_index is not None:
+        lexical = []
+        for r, c, limit, intent in zip(work, canonicals, limits, intents):
+            lexical_candidates, full_matches = lexical_index.search(c["text"], limit, c["price_min"], c["price_max"],
+                                                                    intent, r.limit)
+            strong = _strong_lexical_match(BM25Index.query_terms(c["text"]), full_matches, r.limit)
+            lexical.append((lexical_candidates, full_matches if strong else None))
+    use_llm = [USE_LLM and only_ids is None for _, only_ids in lexical]
+    
+    expansions = [{"search_intent": q} for q in search_queries]
+    search_texts = list(search_queries)
+    expand = [i for i in range(len(work)) if use_llm[i]]
+    if expand:
+        expanded = await expand_queries_batch([search_queries[i] for i in expand],
+                                              [canonicals[i]["text"] for i in expand])
+        for i, e in zip(expand, expanded):
+            expansions[i] = e
+            search_texts[i] = e.get('semantic_expansion', search_queries[i])
+    
+    # One encoder call and one Qdrant batch for every text (plus the raw query when fusing)
+    fuse = [use_llm[i] and RAW_QUERY_FUSION and search_texts[i] != search_queries[i] for i in range(len(work))]
+    texts, owners = [], []
+    for i, (text, query) in enumerate(zip(search_texts, search_queries)):
+        texts.extend([text, query] if fuse[i] else [text])
+        owners.extend([i, i] if fuse[i] else [i])
+    vectors = await embed_texts(texts)
+    
+    candidate_lists: List[List[List[Dict]]] = [[] for _ in work]
+    
+    def search(vector, i: int, strict: Optional[List[Dict]] = None):
+        c = canonicals[i]
+        return _search_vector(vector, c["price_min"], c["price_max"], limits[i], intents[i], work[i].limit, strict)
+    
+    if local_index is not None:
+        results = await asyncio.gather(*(search(vector, i) for vector, i in zip(vectors, owners)))
+    else:
+        filters = [
+            _build_query_filter(c["price_min"], c["price_max"], intent) for c, intent in zip(canonicals, intents)
         ]
+        batch = await qdrant_client.query_batch_points(
+            collection_name=COLLECTION_NAME,
+            requests=[
+                models.QueryRequest(query=vector.tolist(), filter=filters[i], limit=limits[i], with_payload=True)
+                for vector, i in zip(vectors, owners)
+            ]
+        )
+        # Searches whose full intent matched too few products are relaxed individually
+        results = await asyncio.gather(*(
+            search(vector, i, [{'product': r.payload, 'score': r.score, 'id': str(r.id)} for r in response.points])
+            for vector, response, i in zip(vectors, batch, owners)
+        ))
+    for candidates, i in zip(results, owners):
+        candidate_lists[i].append(candidates)
     
-    formatted_results = [_format_product_result(item) for item in final_results]
-    processing_time = (time.time() - start_time) * 1000
+    async def finish(i: int) -> Dict:
+        request = work[i]
+        lexical_candidates, only_ids = lexical[i]
+        candidates = _fuse_candidates(candidate_lists[i] + [lexical_candidates], limits[i], only_ids)
+        stages = ["lexical"] if lexical_index is not None else []
+        stages += ["expansion", "vector_search"] if use_llm[i] else ["vector_search"]
+        skipped: List[str] = []
+        if only_ids is None and reranker is not None and candidates and not request.skipRerank:
+            try:
+                reranked = await reranker.rerank(search_queries[i], expansions[i], candidates, top_k=request.limit)
+                stages.append("rerank")
+            except StageDeadlineExceeded as e:
+                reranked = e.fallback
+                skipped.append("rerank")
+            items = apply_final_scoring(reranked, request.limit)
+        else:
+            items = _raw_candidate_items(candidates, request.limit)
+        
+        data = _build_search_response(request, items, start_time,
+                                      "lexical" if only_ids is not None else search_mode, stages, skipped)
+        if not skipped:
+            text, limit, price_min, price_max = _search_cache_args(request)
+            search_results_cache.set(text, limit, data, price_min, price_max)
+        return data
     
-    return {
-        "query": request.query,
-        "totalResults": len(formatted_results),
-        "results": formatted_results,
-        "processingTimeMs": round(processing_time, 2),
-        "searchMode": search_mode,
-        "cached": False
-    }
+    return list(await asyncio.gather(*(finish(i) for i in range(len(work)))))
+
+
+def _sse_event(event: str, data: Any) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, default=_json_default)}\n\n"
+
+
+async def _stream_search(request: SearchRequest, to_event: Callable[[str, Dict], tuple]):
+    """Run a search and yield SSE events as stages complete.
+    
+    Emits "candidates" with raw vector-search results as soon as Qdrant returns
+    (only when a rerank follows), then "results" with the final ranking, then
+    "done". Cache hits go straight to "results". to_event maps (stage, search data)
+    to the (event name, payload) actually sent.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    
+    async def on_candidates(preliminary: Dict):
+        await events.put(("candidates", preliminary))
+    
+    task = asyncio.ensure_future(_cached_search(request, on_candidates))
+    task.add_done_callback(lambda _: events.put_nowait(None))
+    
+    try:
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            yield _sse_event(*to_event(*item))
+        
+        result = task.result()
+        yield _sse_event(*to_event("results", result))
+        yield _sse_event("done", {"processingTimeMs": result.get("processingTimeMs")})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        yield _sse_event("error", {"detail": str(e)})
 
 
 @app.post("/search", response_model=SearchResponse)
@@ -890,25 +4031,7 @@ async def search(request: SearchRequest):
         raise HTTPException(status_code=503, detail="Not ready")
     
     try:
-        # Check cache first
-        if not request.skipCache:
-            cached = search_results_cache.get(
-                request.query, request.limit, 
-                request.priceMin, request.priceMax
-            )
-            if cached:
-                cached['cached'] = True
-                cached['processingTimeMs'] = 0.1
-                return SearchResponse(**cached)
-        
-        response_data = _perform_search(request)
-        
-        # Cache the result
-        search_results_cache.set(
-            request.query, request.limit, response_data,
-            request.priceMin, request.priceMax
-        )
-        
+        response_data = await _cached_search(request)
         return SearchResponse(**response_data)
     
     except Exception as e:
@@ -917,11 +4040,55 @@ async def search(request: SearchRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/search/stream")
+async def search_stream(request: SearchRequest):
+    """Progressive search over Server-Sent Events: raw candidates first, reranked results after"""
+    if qdrant_client is None or encoder is None:
+        raise HTTPException(status_code=503, detail="Not ready")
+    
+    def to_event(stage: str, data: Dict) -> tuple:
+        return stage, SearchResponse(**data)
+    
+    return StreamingResponse(
+        _stream_search(request, to_event),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/search/batch", response_model=BatchSearchResponse)
+async def search_batch(request: BatchSearchRequest):
+    """Search many queries at once; results come back in request order"""
+    if qdrant_client is None or encoder is None:
+        raise HTTPException(status_code=503, detail="Not ready")
+    
+    start_time = time.time()
+    try:
+        responses = await _batch_search(request.searches)
+        return BatchSearchResponse(
+            results=[SearchResponse(**data) for data in responses],
+            totalQueries=len(responses),
+            cachedQueries=sum(1 for data in responses if data.get("cached")),
+            processingTimeMs=round((time.time() - start_time) * 1000, 2)
+        )
+    
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.delete("/cache")
 async def clear_cache():
     """Clear all caches"""
-    query_expansion_cache.clear()
-    search_results_cache.clear()
+    await asyncio.to_thread(query_expansion_cache.clear)
+    await asyncio.to_thread(search_results_cache.clear)
+    rerank_score_cache.clear()
+    if embedding_cache is not None:
+        embedding_cache.clear()
+        await embedding_cache.persist(force=True)
+    if semantic_expansion_cache is not None:
+        semantic_expansion_cache.clear()
     return {"status": "cleared", "message": "All caches cleared"}
 
 
@@ -930,10 +4097,106 @@ async def cache_stats():
     """Get cache statistics"""
     return {
         "expansion_cache": query_expansion_cache.stats(),
-        "results_cache": search_results_cache.stats()
+        "results_cache": search_results_cache.stats(),
+        "rerank_score_cache": rerank_score_cache.stats(),
+        "embedding_cache": embedding_cache.stats() if embedding_cache is not None else None,
+        "semantic_expansion_cache": semantic_expansion_cache.stats() if semantic_expansion_cache is not None else None,
+        "refresh": {**refresh_stats, "inProgress": len(_background_tasks)},
+        "singleflight": {
+            "search": search_flight.stats(),
+            "llm": llm_flight.stats()
+        }
+    }
+
+
+def _persistent_tiers() -> List[SQLiteCacheTier]:
+    """Persistent tiers that are enabled (they share one database file)"""
+    return [c.store for c in (query_expansion_cache, search_results_cache) if c.store is not None]
+
+
+def _snapshot_tiers(tiers: List[SQLiteCacheTier], path: str):
+    """Flush every tier's queue, then back up the database file they share (blocking)"""
+    for tier in tiers:
+        tier.flush()
+    tiers[0].snapshot(path)
+
+
+def _restore_tiers(tiers: List[SQLiteCacheTier], path: str):
+    """Restore the shared database file (blocking).
+    
+    Every tier drops its queued rows first, so none are flushed over the restored
+    file; every tier recounts its rows afterwards.
+    """
+    for tier in tiers:
+        tier.discard_pending()
+    tiers[0].restore(path)
+    for tier in tiers[1:]:
+        tier.recount()
+
+
+def _snapshot_path(name: str) -> str:
+    """Resolve a snapshot name to a file inside CACHE_SNAPSHOT_DIR"""
+    if not re.fullmatch(r'[\w.-]+', name) or name.startswith('.'):
+        raise HTTPException(status_code=400, detail="Invalid snapshot name")
+    return os.path.join(CACHE_SNAPSHOT_DIR, name)
+
+
+@app.post("/cache/snapshot")
+async def snapshot_cache(request: CacheSnapshotRequest):
+    """Snapshot the persistent cache tier to CACHE_SNAPSHOT_DIR"""
+    tiers = _persistent_tiers()
+    if not tiers:
+        raise HTTPException(status_code=400, detail="Persistent cache tier is disabled")
+    
+    name = request.name or f"cache-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    path = _snapshot_path(name)
+    os.makedirs(CACHE_SNAPSHOT_DIR, exist_ok=True)
+    await asyncio.to_thread(_snapshot_tiers, tiers, path)
+    return {"status": "saved", "name": name, "bytes": os.path.getsize(path)}
+
+
+@app.post("/cache/restore")
+async def restore_cache(request: CacheSnapshotRequest):
+    """Restore the persistent cache tier from a snapshot; memory tiers refill lazily"""
+    tiers = _persistent_tiers()
+    if not tiers:
+        raise HTTPException(status_code=400, detail="Persistent cache tier is disabled")
+    if not request.name:
+        raise HTTPException(status_code=400, detail="Snapshot name is required")
+    
+    path = _snapshot_path(request.name)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    
+    await asyncio.to_thread(_restore_tiers, tiers, path)
+    query_expansion_cache.clear_memory()
+    search_results_cache.clear_memory()
+    return {"status": "restored", "name": request.name}
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    """Per-provider, per-stage LLM latency (p50/p95) and hedging outcomes"""
+    providers = _llm_providers()
+    return {
+        "providers": providers,
+        "hedging": LLM_HEDGE_ENABLED and len(providers) > 1,
+        "hedgeDelayMs": {
+            stage: _hedge_delay_ms(providers[0], stage) if providers else None
+            for stage in LLM_HEDGE_DELAY_MS
+        },
+        "deadlineMs": LLM_DEADLINE_MS,
+        "deadlineMisses": llm_deadline_misses,
+        "latency": llm_latency.stats()
     }
 
 
+@app.get("/encoder/stats")
+async def encoder_stats():
+    """Get query-embedding batch-size and queue-wait histograms"""
+    return encoder_batcher.stats()
+
+
 @app.get("/")
 async def root():
     return {
@@ -954,12 +4217,19 @@ async def root():
         "endpoints": {
             "health": "GET /health",
             "search": "POST /search",
+            "search_stream": "POST /search/stream",
+            "search_batch": "POST /search/batch",
             "chat": "POST /api/chat/message",
+            "chat_stream": "POST /api/chat/message/stream",
             "sessions": "GET /api/sessions/user/{userId}",
             "messages": "GET /api/sessions/messages/{sessionId}",
             "feedback": "POST /api/feedback/product",
             "cache_stats": "GET /cache/stats",
-            "clear_cache": "DELETE /cache"
+            "clear_cache": "DELETE /cache",
+            "cache_snapshot": "POST /cache/snapshot",
+            "cache_restore": "POST /cache/restore",
+            "encoder_stats": "GET /encoder/stats",
+            "llm_stats": "GET /llm/stats"
         }
     }
 
@@ -1059,16 +4329,11 @@ def _generate_assistant_response(query: str, products: List[Dict]) -> str:
     return random.choice(responses)
 
 
-@app.post("/api/chat/message", response_model=ChatMessageResponse)
-async def chat_message(request: ChatMessageRequest):
-    """Handle chat messages - integrates with ai_chat_frontend"""
-    if qdrant_client is None or encoder is None:
-        raise HTTPException(status_code=503, detail="Search service not ready")
-    
+def _start_chat_session(request: ChatMessageRequest) -> tuple:
+    """Resolve (user_id, session_id), initializing the session if new"""
     # Generate or use existing session/user IDs
     user_id = request.userId or str(uuid.uuid4())
     session_id = request.sessionId or str(uuid.uuid4())
-    message_id = str(uuid.uuid4())
     
     # Initialize session if new
     if session_id not in sessions_store:
@@ -1086,56 +4351,67 @@ async def chat_message(request: ChatMessageRequest):
         if session_id not in user_sessions[user_id]:
             user_sessions[user_id].append(session_id)
     
+    return user_id, session_id
+
+
+def _chat_search_request(request: ChatMessageRequest) -> SearchRequest:
     # Perform search using existing search logic
-    search_request = SearchRequest(
+    return SearchRequest(
         query=request.message,
         limit=10,
         skipCache=False
     )
+
+
+def _products_for_frontend(search_results: Dict) -> List[Dict]:
+    """Transform search results into ranked frontend products"""
+    products = []
+    for idx, result in enumerate(search_results.get("results", [])):
+        product = _transform_product_for_frontend(result)
+        product["rank"] = idx + 1
+        products.append(product)
+    return products
+
+
+def _complete_chat_message(request: ChatMessageRequest, user_id: str, session_id: str,
+                           search_results: Dict) -> ChatMessageResponse:
+    """Build the assistant reply for finished search results and store the message"""
+    message_id = str(uuid.uuid4())
+    products = _products_for_frontend(search_results)
+    
+    # Generate assistant response
+    assistant_response = _generate_assistant_response(request.message, products)
+    
+    # Store message
+    message_data = {
+        "id": message_id,
+        "user_content": request.message,
+        "assistant_content": assistant_response,
+        "products": products,
+        "created_at": datetime.now().isoformat()
+    }
+    messages_store[session_id].append(message_data)
+    
+    return ChatMessageResponse(
+        sessionId=session_id,
+        userId=user_id,
+        assistantResponse=assistant_response,
+        products=products,
+        messageId=message_id
+    )
+
+
+@app.post("/api/chat/message", response_model=ChatMessageResponse)
+async def chat_message(request: ChatMessageRequest):
+    """Handle chat messages - integrates with ai_chat_frontend"""
+    if qdrant_client is None or encoder is None:
+        raise HTTPException(status_code=503, detail="Search service not ready")
+    
+    user_id, session_id = _start_chat_session(request)
     
     try:
-        # Check cache first
-        cached = search_results_cache.get(
-            search_request.query, search_request.limit,
-            search_request.priceMin, search_request.priceMax
-        )
-        
-        if cached:
-            search_results = cached
-        else:
-            search_results = _perform_search(search_request)
-            search_results_cache.set(
-                search_request.query, search_request.limit, search_results,
-                search_request.priceMin, search_request.priceMax
-            )
-        
-        # Transform products for frontend
-        products = []
-        for idx, result in enumerate(search_results.get("results", [])):
-            product = _transform_product_for_frontend(result)
-            product["rank"] = idx + 1
-            products.append(product)
-        
-        # Generate assistant response
-        assistant_response = _generate_assistant_response(request.message, products)
-        
-        # Store message
-        message_data = {
-            "id": message_id,
-            "user_content": request.message,
-            "assistant_content": assistant_response,
-            "products": products,
-            "created_at": datetime.now().isoformat()
-        }
-        messages_store[session_id].append(message_data)
-        
-        return ChatMessageResponse(
-            sessionId=session_id,
-            userId=user_id,
-            assistantResponse=assistant_response,
-            products=products,
-            messageId=message_id
-        )
+        search_results = await _cached_search(_chat_search_request(request))
+        return _complete_chat_message(request, user_id, session_id, search_results)
         
     except Exception as e:
         import traceback
@@ -1143,6 +4419,30 @@ async def chat_message(request: ChatMessageRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/chat/message/stream")
+async def chat_message_stream(request: ChatMessageRequest):
+    """Chat message over Server-Sent Events.
+    
+    Emits "candidates" ({sessionId, userId, products}) from the raw vector search,
+    then "message" with the full ChatMessageResponse once reranking finishes.
+    """
+    if qdrant_client is None or encoder is None:
+        raise HTTPException(status_code=503, detail="Search service not ready")
+    
+    user_id, session_id = _start_chat_session(request)
+    
+    def to_event(stage: str, data: Dict) -> tuple:
+        if stage == "candidates":
+            return stage, {"sessionId": session_id, "userId": user_id, "products": _products_for_frontend(data)}
+        return "message", _complete_chat_message(request, user_id, session_id, data)
+    
+    return StreamingResponse(
+        _stream_search(_chat_search_request(request), to_event),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/api/sessions/user/{user_id}")
 async def get_user_sessions(user_id: str):
     """Get all sessions for a user"""